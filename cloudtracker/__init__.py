@@ -24,15 +24,34 @@ USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
 """
 __version__ = "2.1.5"
 
+import contextlib
+import copy
+import io
 import json
 import logging
+import multiprocessing
+import os
 import pkg_resources
 import re
+import sys
+import threading
+from array import array
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from enum import IntEnum
 
 from colors import color
 import jmespath
 
-cloudtrail_supported_actions = None
+from cloudtracker.cache import (
+    get_cache_dir,
+    get_cache_path,
+    get_content_hash,
+    load_json,
+    save_json,
+)
+from cloudtracker.profiling import profiler
+from cloudtracker.snapshots import IamSnapshot
+
 
 logging.basicConfig(level=logging.INFO, format="%(levelname)-8s %(message)s")
 
@@ -55,6 +74,11 @@ EVENT_RENAMES = {
     "s3:setbucketloggingstatus": "s3:putbucketlogging",
 }
 
+# Translate Cloudtrail name -> IAM name
+IAM_NAMES = {
+    cloudtrail_name: iam_name for iam_name, cloudtrail_name in EVENT_RENAMES.items()
+}
+
 # List of actions seen in CloudTrail logs for which no IAM policies exist.
 # These are allowed by default.
 NO_IAM = {
@@ -68,17 +92,34 @@ NO_IAM = {
 }
 
 
+class Classification(IntEnum):
+    """How an action or actor is classified when comparing what was allowed with what was done"""
+
+    PERFORMED_AND_ALLOWED = 1
+    PERFORMED_BUT_NOT_ALLOWED = 2
+    ALLOWED_BUT_NOT_PERFORMED = 3
+    ALLOWED_BUT_NOT_KNOWN_IF_PERFORMED = 4
+
+
+# The fewest policies to expand at once that are worth starting worker processes for
+MIN_PARALLEL_POLICIES = 16
+
+
 class Privileges(object):
     """Keep track of privileges an actor has been granted"""
 
     stmts = None
     roles = None
     aws_api_list = None
+    policies = None
+    expansions = None
 
-    def __init__(self, aws_api_list):
+    def __init__(self, aws_api_list, expansions=None):
         self.stmts = []
         self.roles = []
+        self.policies = []
         self.aws_api_list = aws_api_list
+        self.expansions = expansions
 
     def add_stmt(self, stmt):
         """Adds a statement from an IAM policy"""
@@ -87,6 +128,12 @@ class Privileges(object):
             return
         self.stmts.append(stmt)
 
+    def add_policy(self, policy):
+        """Adds all the statements of an IAM policy document"""
+        stmts = [stmt for stmt in make_list(policy["Statement"]) if "Action" in stmt]
+        self.stmts.extend(stmts)
+        self.policies.append(stmts)
+
     def get_actions_from_statement(self, stmt):
         """Figures out what API calls have been granted from a statement"""
         actions = {}
@@ -104,10 +151,20 @@ class Privileges(object):
                 if re.match(action, possible_action):
                     actions[possible_action] = True
 
+        profiler.count(
+            "regex_matches", len(make_list(stmt["Action"])) * len(self.aws_api_list)
+        )
         return actions
 
     def determine_allowed(self):
         """After statements have been added from IAM policiies, find all the allowed API calls"""
+        with profiler.span("determine_allowed"):
+            if self.expansions is not None:
+                return self.determine_allowed_from_policies()
+            return self.determine_allowed_from_statements()
+
+    def determine_allowed_from_statements(self):
+        """Find all the allowed API calls by expanding every statement"""
         actions = {}
 
         # Look at alloweds first
@@ -135,6 +192,211 @@ class Privileges(object):
 
         return list(actions)
 
+    def get_policies(self):
+        """
+        Return the statements of each policy added, with statements added on their own
+        treated as one more policy
+        """
+        policies = list(self.policies)
+        policy_stmt_ids = {id(stmt) for stmts in policies for stmt in stmts}
+        loose_stmts = [stmt for stmt in self.stmts if id(stmt) not in policy_stmt_ids]
+        if loose_stmts:
+            policies.append(loose_stmts)
+        return policies
+
+    def determine_allowed_from_policies(self):
+        """
+        Find all the allowed API calls using the expansion cache, one policy at a time
+        """
+        allowed = {}
+        denied = set()
+        for stmts in self.get_policies():
+            policy_allowed, policy_denied = self.expansions.get_policy_actions(stmts)
+            allowed.update(dict.fromkeys(policy_allowed))
+            denied.update(policy_denied)
+
+        return [action for action in allowed if action not in denied]
+
+
+class ExpansionCache(object):
+    """
+    Remember the API calls that IAM statements and policies grant, so that a policy attached
+    to many users and roles, such as an AWS managed policy, is only expanded once.  The
+    expansions are keyed by a hash of the policy and saved in the cache directory, under
+    the version of the API list they were expanded against.
+
+    Expanding policies is CPU bound, so many policies can be expanded at once on a pool of
+    worker processes with expand_policies.
+    """
+
+    aws_api_list = None
+    version = None
+    path = None
+    statements = None
+    policies = None
+    changed = False
+    workers = None
+    executor = None
+
+    def __init__(self, aws_api_list, cache_dir=None, workers=None):
+        self.aws_api_list = aws_api_list
+        self.version = get_content_hash([sorted(aws_api_list), EVENT_RENAMES])
+        self.workers = workers or os.cpu_count() or 1
+        self.lock = threading.Lock()
+
+        cached = {}
+        if cache_dir is not None:
+            self.path = get_cache_path(
+                cache_dir, "expansions", "{}.json".format(self.version)
+            )
+            cached = load_json(self.path, {})
+        self.statements = cached.get("statements", {})
+        self.policies = cached.get("policies", {})
+
+    def get_statement_actions(self, stmt):
+        """Return the API calls matched by the actions of a statement"""
+        key = get_content_hash(make_list(stmt["Action"]))
+        actions = self.statements.get(key)
+        profiler.count(
+            "statement_cache_misses" if actions is None else "statement_cache_hits"
+        )
+        if actions is None:
+            privileges = Privileges(self.aws_api_list)
+            actions = list(privileges.get_actions_from_statement(stmt))
+            self.statements[key] = actions
+            self.changed = True
+        return actions
+
+    def get_policy_actions(self, stmts):
+        """
+        Return the API calls the statements of a policy allow, and those it denies outright,
+        that is with a Resource of * and no Condition
+        """
+        key = get_content_hash(stmts)
+        actions = self.policies.get(key)
+        profiler.count("policy_cache_misses" if actions is None else "policy_cache_hits")
+        if actions is None:
+            allowed = {}
+            denied = {}
+            for stmt in stmts:
+                if stmt["Effect"] == "Allow":
+                    allowed.update(dict.fromkeys(self.get_statement_actions(stmt)))
+                elif (
+                    stmt["Effect"] == "Deny"
+                    and "*" in make_list(stmt.get("Resource", None))
+                    and stmt.get("Condition", None) is None
+                ):
+                    denied.update(dict.fromkeys(self.get_statement_actions(stmt)))
+            actions = [list(allowed), list(denied)]
+            self.policies[key] = actions
+            self.changed = True
+        return actions
+
+    def expand_policies(self, policies):
+        """
+        Expand the policies given (each a list of statements) that haven't been already, on a
+        pool of worker processes, so that get_policy_actions then finds them in the cache
+        """
+        pending = {}
+        for stmts in policies:
+            key = get_content_hash(stmts)
+            if key not in self.policies:
+                pending[key] = stmts
+        if self.workers < 2 or len(pending) < MIN_PARALLEL_POLICIES:
+            # Not worth starting processes for, so leave these to be expanded when needed
+            return
+
+        with self.lock:
+            if self.executor is None:
+                # This may be called from the threads of --accounts, and forking a process
+                # that is running other threads can deadlock its children, so the workers
+                # are started afresh
+                self.executor = ProcessPoolExecutor(
+                    max_workers=self.workers,
+                    mp_context=multiprocessing.get_context("spawn"),
+                    initializer=init_expansion_worker,
+                    initargs=(self.aws_api_list,),
+                )
+
+        # Split the policies so each worker gets a few batches, to even out the load
+        items = list(pending.items())
+        batch_size = max(1, len(items) // (self.workers * 4))
+        batches = [
+            items[i : i + batch_size] for i in range(0, len(items), batch_size)
+        ]
+
+        action_names = get_iam_action_names(self.aws_api_list)
+        with profiler.span("expand_policies", policies=len(items)):
+            for results in self.executor.map(expand_policy_batch, batches):
+                for key, allowed_ids, denied_ids in results:
+                    self.policies[key] = [
+                        [action_names[i] for i in allowed_ids],
+                        [action_names[i] for i in denied_ids],
+                    ]
+        profiler.count("policies_expanded_in_workers", len(items))
+        self.changed = True
+
+    def close(self):
+        """Stop any worker processes"""
+        with self.lock:
+            if self.executor is not None:
+                self.executor.shutdown()
+                self.executor = None
+
+    def save(self):
+        """Save the expansions to the cache directory, if any new ones were made"""
+        if self.path is None or not self.changed:
+            return
+        with self.lock:
+            # Copy the expansions, as other threads may be adding to them
+            save_json(
+                self.path,
+                {
+                    "statements": self.statements.copy(),
+                    "policies": self.policies.copy(),
+                },
+            )
+            self.changed = False
+
+
+# The expansion cache of a worker process, and the position of each API call in the API
+# list it is started with
+worker_expansions = None
+worker_action_ids = None
+
+
+def get_iam_action_names(aws_api_list):
+    """Return the IAM name of each API call in the list, in the same order"""
+    return [get_iam_name(action) for action in aws_api_list]
+
+
+def init_expansion_worker(aws_api_list):
+    """Set up a worker process to expand policies against the API list"""
+    global worker_expansions, worker_action_ids
+    worker_expansions = ExpansionCache(aws_api_list)
+    worker_action_ids = {
+        action: i for i, action in enumerate(get_iam_action_names(aws_api_list))
+    }
+
+
+def expand_policy_batch(batch):
+    """
+    Expand a batch of (key, statements) policies in a worker process.  The API calls each
+    allows and denies are returned as arrays of their positions in the API list, which are
+    much smaller to send back than their names.
+    """
+    results = []
+    for key, stmts in batch:
+        allowed, denied = worker_expansions.get_policy_actions(stmts)
+        results.append(
+            (
+                key,
+                array("I", (worker_action_ids[action] for action in allowed)),
+                array("I", (worker_action_ids[action] for action in denied)),
+            )
+        )
+    return results
+
 
 def make_list(obj):
     """Convert an object to a list if it is not already"""
@@ -158,9 +420,15 @@ def normalize_api_call(service, eventName):
     return "{}:{}".format(service, eventName)
 
 
-def get_account_iam(account):
-    """Given account data from the config file, open the IAM file for the account"""
-    return json.load(open(account["iam"]))
+def get_account_iam(account, policy_store=None):
+    """
+    Given account data from the config file, open the IAM file for the account.  With a
+    policy store, the managed policy documents are shared with the other accounts loaded.
+    """
+    with profiler.span("load_iam", account=str(account["id"])):
+        if policy_store is not None:
+            return policy_store.load_account_iam(account["iam"])
+        return json.load(open(account["iam"]))
 
 
 def get_allowed_users(account_iam):
@@ -173,34 +441,37 @@ def get_allowed_roles(account_iam):
     return jmespath.search("RoleDetailList[].RoleName", account_iam)
 
 
-def print_actor_diff(performed_actors, allowed_actors, use_color):
+def classify_actors(performed_actors, allowed_actors):
     """
     Given a list of actors that have performed actions, and a list that exist in the account,
-    print the actors and whether they are still active.
+    return the Classification of each actor
     """
-    PERFORMED_AND_ALLOWED = 1
-    PERFORMED_BUT_NOT_ALLOWED = 2
-    ALLOWED_BUT_NOT_PERFORMED = 3
-
     actors = {}
     for actor in performed_actors:
         if actor in allowed_actors:
-            actors[actor] = PERFORMED_AND_ALLOWED
+            actors[actor] = Classification.PERFORMED_AND_ALLOWED
         else:
-            actors[actor] = PERFORMED_BUT_NOT_ALLOWED
+            actors[actor] = Classification.PERFORMED_BUT_NOT_ALLOWED
 
     for actor in allowed_actors:
         if actor not in actors:
-            actors[actor] = ALLOWED_BUT_NOT_PERFORMED
+            actors[actor] = Classification.ALLOWED_BUT_NOT_PERFORMED
+    return actors
+
 
-    for actor in sorted(actors.keys()):
-        if actors[actor] == PERFORMED_AND_ALLOWED:
-            colored_print("  {}".format(actor), use_color, "white")
-        elif actors[actor] == PERFORMED_BUT_NOT_ALLOWED:
+def print_actor_diff(diff, use_color, output=None):
+    """
+    Given the Diff of the actors that have performed actions with those that exist in the
+    account, print the actors and whether they are still active.
+    """
+    for actor, classification in diff:
+        if classification == Classification.PERFORMED_AND_ALLOWED:
+            colored_print("  {}".format(actor), use_color, "white", output)
+        elif classification == Classification.PERFORMED_BUT_NOT_ALLOWED:
             # Don't show users that existed but have since been deleted
             continue
-        elif actors[actor] == ALLOWED_BUT_NOT_PERFORMED:
-            colored_print("- {}".format(actor), use_color, "red")
+        elif classification == Classification.ALLOWED_BUT_NOT_PERFORMED:
+            colored_print("- {}".format(actor), use_color, "red", output)
         else:
             raise Exception("Unknown constant")
 
@@ -225,12 +496,19 @@ def get_role_iam(rolename, account_iam):
     return role_iam
 
 
-def get_user_allowed_actions(aws_api_list, user_iam, account_iam):
+def get_user_allowed_actions(aws_api_list, user_iam, account_iam, expansions=None):
     """Return the privileges granted to a user by IAM"""
+    return get_user_privileges(
+        aws_api_list, user_iam, account_iam, expansions
+    ).determine_allowed()
+
+
+def get_user_privileges(aws_api_list, user_iam, account_iam, expansions=None):
+    """Return the policies attached to a user, directly or through groups, as Privileges"""
     groups = user_iam["GroupList"]
     managed_policies = user_iam["AttachedManagedPolicies"]
 
-    privileges = Privileges(aws_api_list)
+    privileges = Privileges(aws_api_list, expansions)
 
     # Get permissions from groups
     for group in groups:
@@ -247,14 +525,12 @@ def get_user_allowed_actions(aws_api_list, user_iam, account_iam):
             )
             if policy is None:
                 continue
-            for stmt in make_list(policy["Statement"]):
-                privileges.add_stmt(stmt)
+            privileges.add_policy(policy)
 
         # Get privileges from in-line policies attached to the group
         for inline_policy in group_iam["GroupPolicyList"]:
             policy = inline_policy["PolicyDocument"]
-            for stmt in make_list(policy["Statement"]):
-                privileges.add_stmt(stmt)
+            privileges.add_policy(policy)
 
     # Get privileges from managed policies attached to the user
     for managed_policy in managed_policies:
@@ -264,21 +540,25 @@ def get_user_allowed_actions(aws_api_list, user_iam, account_iam):
         )
         if policy is None:
             continue
-        for stmt in make_list(policy["Statement"]):
-            privileges.add_stmt(stmt)
+        privileges.add_policy(policy)
 
     # Get privileges from inline policies attached to the user
-    for stmt in (
-        jmespath.search("UserPolicyList[].PolicyDocument.Statement", user_iam) or []
-    ):
-        privileges.add_stmt(stmt)
+    for policy in jmespath.search("UserPolicyList[].PolicyDocument", user_iam) or []:
+        privileges.add_policy(policy)
 
-    return privileges.determine_allowed()
+    return privileges
 
 
-def get_role_allowed_actions(aws_api_list, role_iam, account_iam):
+def get_role_allowed_actions(aws_api_list, role_iam, account_iam, expansions=None):
     """Return the privileges granted to a role by IAM"""
-    privileges = Privileges(aws_api_list)
+    return get_role_privileges(
+        aws_api_list, role_iam, account_iam, expansions
+    ).determine_allowed()
+
+
+def get_role_privileges(aws_api_list, role_iam, account_iam, expansions=None):
+    """Return the policies attached to a role as Privileges"""
+    privileges = Privileges(aws_api_list, expansions)
 
     # Get privileges from managed policies
     for managed_policy in role_iam["AttachedManagedPolicies"]:
@@ -288,94 +568,139 @@ def get_role_allowed_actions(aws_api_list, role_iam, account_iam):
         )
         if policy is None:
             continue
-        for stmt in make_list(policy["Statement"]):
-            privileges.add_stmt(stmt)
+        privileges.add_policy(policy)
 
     # Get privileges from attached policies
     for policy in role_iam["RolePolicyList"]:
-        for stmt in make_list(policy["PolicyDocument"]["Statement"]):
-            privileges.add_stmt(stmt)
+        privileges.add_policy(policy["PolicyDocument"])
+
+    return privileges
+
 
-    return privileges.determine_allowed()
+def get_policy_versions(account_iam):
+    """Return the default version ID of each managed policy in an account, by ARN"""
+    return {
+        policy["Arn"]: policy.get("DefaultVersionId")
+        for policy in account_iam.get("Policies") or []
+    }
 
 
-def is_recorded_by_cloudtrail(action):
-    """Given an action, return True if it would be logged by CloudTrail"""
-    if action in cloudtrail_supported_actions:
-        return True
-    return False
+def get_policy_fingerprint(actor_iam, policy_versions):
+    """
+    Return a hash of everything that decides what a user or role in an account is allowed to
+    do: its groups, the versions of its managed policies, and its inline policy documents.
+    Within an account, users or roles with the same fingerprint are allowed the same actions.
+    """
+    inline_policies = actor_iam.get("UserPolicyList", actor_iam.get("RolePolicyList"))
+    return get_content_hash(
+        {
+            "groups": sorted(actor_iam.get("GroupList") or []),
+            "managed": sorted(
+                [policy["PolicyArn"], policy_versions.get(policy["PolicyArn"])]
+                for policy in actor_iam.get("AttachedManagedPolicies") or []
+            ),
+            "inline": sorted(
+                get_content_hash(policy["PolicyDocument"])
+                for policy in inline_policies or []
+            ),
+        }
+    )
 
 
-def colored_print(text, use_color=True, color_name="white"):
-    """Print with or without color codes"""
+def colored_print(text, use_color=True, color_name="white", output=None):
+    """Print with or without color codes, to stdout or the given output file"""
     if use_color:
-        print(color(text, fg=color_name))
+        print(color(text, fg=color_name), file=output)
     else:
-        print(text)
+        print(text, file=output)
 
 
-def print_diff(performed_actions, allowed_actions, printfilter, use_color):
+def get_iam_name(action):
+    """Given an action as CloudTrail records it, return its IAM name"""
+    return IAM_NAMES.get(action, action)
+
+
+def classify_actions(performed_actions, allowed_actions, is_recorded):
     """
     For an actor, given the actions they performed, and the privileges they were granted,
-    print what they were allowed to do but did not, and other differences.
+    return the Classification of each action.  is_recorded(action) says whether an action
+    would be recorded by CloudTrail.
     """
-    PERFORMED_AND_ALLOWED = 1
-    PERFORMED_BUT_NOT_ALLOWED = 2
-    ALLOWED_BUT_NOT_PERFORMED = 3
-    ALLOWED_BUT_NOT_KNOWN_IF_PERFORMED = 4
-
     actions = {}
 
     for action in performed_actions:
-        # Convert to IAM names
-        for iam_name, cloudtrail_name in EVENT_RENAMES.items():
-            if action == cloudtrail_name:
-                action = iam_name
+        action = get_iam_name(action)
 
         # See if this was allowed or not
         if action in allowed_actions:
-            actions[action] = PERFORMED_AND_ALLOWED
+            actions[action] = Classification.PERFORMED_AND_ALLOWED
         else:
             if action in NO_IAM:
                 # Ignore actions in cloudtrail such as sts:getcalleridentity that are allowed
                 # whether or not they are in IAM
                 continue
-            actions[action] = PERFORMED_BUT_NOT_ALLOWED
+            actions[action] = Classification.PERFORMED_BUT_NOT_ALLOWED
 
     # Find actions that were allowed, but there is no record of them being used
     for action in allowed_actions:
         if action not in actions:
-            if not is_recorded_by_cloudtrail(action):
-                actions[action] = ALLOWED_BUT_NOT_KNOWN_IF_PERFORMED
+            if not is_recorded(action):
+                actions[action] = Classification.ALLOWED_BUT_NOT_KNOWN_IF_PERFORMED
             else:
-                actions[action] = ALLOWED_BUT_NOT_PERFORMED
+                actions[action] = Classification.ALLOWED_BUT_NOT_PERFORMED
 
-    for action in sorted(actions.keys()):
-        # Convert CloudTrail name back to IAM name
-        display_name = action
+    return actions
 
-        if not printfilter.get("show_benign", True):
-            # Ignore actions that won't exfil or modify resources
-            if ":list" in display_name or ":describe" in display_name:
-                continue
 
-        if actions[action] == PERFORMED_AND_ALLOWED:
-            colored_print("  {}".format(display_name), use_color, "white")
-        elif actions[action] == PERFORMED_BUT_NOT_ALLOWED:
-            colored_print("+ {}".format(display_name), use_color, "green")
-        elif actions[action] == ALLOWED_BUT_NOT_PERFORMED:
-            if printfilter.get("show_used", True):
-                # Ignore this as it wasn't used
-                continue
-            colored_print("- {}".format(display_name), use_color, "red")
-        elif actions[action] == ALLOWED_BUT_NOT_KNOWN_IF_PERFORMED:
-            if printfilter.get("show_used", True):
-                # Ignore this as it wasn't used
+def print_diff(diff, printfilter, use_color, output=None, last_used=None):
+    """
+    For an actor, given the Diff of the actions they performed with the privileges they were
+    granted, print what they were allowed to do but did not, and other differences.  Given
+    the last time each action was used, such as from a LastUsedIndex, this is shown with the
+    action.
+    """
+    with profiler.span("print_diff"):
+        for action, classification in diff:
+            if not is_action_shown(action, classification, printfilter):
                 continue
-            if printfilter.get("show_unknown", True):
-                colored_print("? {}".format(display_name), use_color, "yellow")
-        else:
-            raise Exception("Unknown constant")
+
+            text = action
+            if last_used:
+                # The index has the names CloudTrail records, rather than the IAM names
+                last_used_time = last_used.get(EVENT_RENAMES.get(action, action))
+                if last_used_time is not None:
+                    text = "{}  (last used {})".format(action, last_used_time[:10])
+
+            if classification == Classification.PERFORMED_AND_ALLOWED:
+                colored_print("  {}".format(text), use_color, "white", output)
+            elif classification == Classification.PERFORMED_BUT_NOT_ALLOWED:
+                colored_print("+ {}".format(text), use_color, "green", output)
+            elif classification == Classification.ALLOWED_BUT_NOT_PERFORMED:
+                colored_print("- {}".format(text), use_color, "red", output)
+            elif classification == Classification.ALLOWED_BUT_NOT_KNOWN_IF_PERFORMED:
+                colored_print("? {}".format(text), use_color, "yellow", output)
+            else:
+                raise Exception("Unknown constant")
+
+
+def is_action_shown(action, classification, printfilter):
+    """Return whether an action with the given Classification is shown, given the filters"""
+    if not printfilter.get("show_benign", True):
+        # Ignore actions that won't exfil or modify resources
+        if ":list" in action or ":describe" in action:
+            return False
+
+    if classification in (
+        Classification.ALLOWED_BUT_NOT_PERFORMED,
+        Classification.ALLOWED_BUT_NOT_KNOWN_IF_PERFORMED,
+    ):
+        if printfilter.get("show_used", True):
+            # Ignore this as it wasn't used
+            return False
+
+    if classification == Classification.ALLOWED_BUT_NOT_KNOWN_IF_PERFORMED:
+        return printfilter.get("show_unknown", True)
+    return True
 
 
 def get_account(accounts, account_name):
@@ -418,12 +743,167 @@ def read_aws_api_list(aws_api_list_file="aws_api_list.txt"):
     return aws_api_list
 
 
-def run(args, config, start, end):
-    """Perform the requested command"""
-    use_color = args.use_color
+def print_all_actor_diffs(
+    datasource,
+    actor_type,
+    analyzer,
+    account_iam,
+    printfilter,
+    use_color,
+    output=None,
+    snapshot=None,
+    usage=None,
+    writer=None,
+    account_name=None,
+):
+    """
+    For every user or role in an account, print what they were allowed to do but did not,
+    and other differences, as the Analyzer finds them.  Datasources that can look up many
+    actors at once are asked for all of them in a single batch.  With a snapshot of the
+    account's IAM data, the allowed actions of actors unaffected by any IAM changes are taken
+    from it.  With a UsageMatrix, the actors are added to it for reporting, rather than
+    printed, and with a DiffWriter, their diffs are written as records.
+    """
+    search_query = datasource.get_search_query()
+    get_last_used = getattr(datasource, "get_last_used", None)
+    aws_api_list = analyzer.aws_api_list
+    expansions = analyzer.expansions
+
+    if actor_type == "users":
+        actors_iam = jmespath.search("UserDetailList[]", account_iam) or []
+        get_allowed_actions = get_user_allowed_actions
+        get_privileges = get_user_privileges
+        name_key = "UserName"
+        batch_lookup = getattr(datasource, "get_performed_event_names_by_users", None)
+        single_lookup = datasource.get_performed_event_names_by_user
+        frame_lookup = getattr(datasource, "get_event_frame_by_users", None)
+    elif actor_type == "roles":
+        actors_iam = jmespath.search("RoleDetailList[]", account_iam) or []
+        get_allowed_actions = get_role_allowed_actions
+        get_privileges = get_role_privileges
+        name_key = "RoleName"
+        batch_lookup = getattr(datasource, "get_performed_event_names_by_roles", None)
+        single_lookup = datasource.get_performed_event_names_by_role
+        frame_lookup = getattr(datasource, "get_event_frame_by_roles", None)
+    else:
+        exit("ERROR: --all argument must be one of 'users' or 'roles'")
+
+    with profiler.span("lookup_performed", actors=len(actors_iam)):
+        # For a report, datasources that hold the events in an EventFrame hand it to the
+        # UsageMatrix as it is, rather than as dicts of each actor's API calls
+        frame = None
+        if usage is not None and frame_lookup is not None:
+            frame = frame_lookup(search_query, actors_iam)
+        if frame is not None:
+            performed_by_arn = {}
+        elif batch_lookup is not None:
+            performed_by_arn = batch_lookup(search_query, actors_iam)
+        else:
+            performed_by_arn = {}
+            for actor_iam in actors_iam:
+                performed_by_arn[actor_iam["Arn"]] = single_lookup(
+                    search_query, actor_iam
+                )
 
-    account = get_account(config["accounts"], args.account)
+    # Actors with the same policies, such as roles created from the same template, are
+    # allowed the same actions, so these are only worked out once for each set of policies
+    policy_versions = get_policy_versions(account_iam)
+    allowed_by_fingerprint = {}
 
+    def get_actor_allowed_actions(actor_iam):
+        fingerprint = get_policy_fingerprint(actor_iam, policy_versions)
+        if fingerprint not in allowed_by_fingerprint:
+            allowed_by_fingerprint[fingerprint] = get_allowed_actions(
+                aws_api_list, actor_iam, account_iam, expansions
+            )
+        return allowed_by_fingerprint[fingerprint]
+
+    # Expand the policies of every actor whose allowed actions need working out up front,
+    # so that they can be spread over many processes
+    policies = []
+    fingerprints = set()
+    for actor_iam in actors_iam:
+        if snapshot is not None and actor_iam["Arn"] in snapshot.allowed:
+            continue
+        fingerprint = get_policy_fingerprint(actor_iam, policy_versions)
+        if fingerprint in fingerprints:
+            continue
+        fingerprints.add(fingerprint)
+        policies.extend(
+            get_privileges(aws_api_list, actor_iam, account_iam, expansions).get_policies()
+        )
+    expansions.expand_policies(policies)
+
+    for actor_iam in actors_iam:
+        with profiler.span("allowed_actions"):
+            if snapshot is not None:
+                allowed_actions = snapshot.get_allowed_actions(
+                    actor_iam, get_actor_allowed_actions
+                )
+            else:
+                allowed_actions = get_actor_allowed_actions(actor_iam)
+        profiler.count("actors")
+
+        if usage is not None:
+            usage.add_principal(
+                actor_iam["Arn"],
+                allowed_actions,
+                performed_by_arn.get(actor_iam["Arn"], {}),
+                frame=frame,
+            )
+            continue
+
+        diff = analyzer.diff_actions(
+            performed_by_arn.get(actor_iam["Arn"], {}), allowed_actions
+        )
+        if writer is not None:
+            writer.write_actions(
+                account_name, actor_iam["Arn"], diff.classifications, printfilter
+            )
+            continue
+
+        print("Getting info for {}".format(actor_iam[name_key]), file=output)
+        print_diff(
+            diff,
+            printfilter,
+            use_color,
+            output,
+            get_last_used(actor_type, actor_iam["Arn"]) if get_last_used else None,
+        )
+
+
+def read_cloudtrail_supported_actions():
+    """Read in the list of AWS API calls that are recorded by CloudTrail"""
+    ct_actions_path = pkg_resources.resource_filename(
+        __name__, "data/{}".format("cloudtrail_supported_actions.txt")
+    )
+    supported_actions = {}
+    with open(ct_actions_path) as f:
+        lines = f.readlines()
+    for line in lines:
+        (service, event) = line.rstrip().split(":")
+        supported_actions[normalize_api_call(service, event)] = True
+    return supported_actions
+
+
+def uses_athena(config):
+    """Returns True if the config file asks for the Athena datasource"""
+    return "athena" in config and not any(
+        source in config for source in ("elasticsearch", "local", "stream", "sqlite")
+    )
+
+
+def get_datasource(
+    args,
+    config,
+    account,
+    start,
+    end,
+    athena_clients=None,
+    scan_ledger=None,
+    scheduler=None,
+):
+    """Open the datasource the config file asks for"""
     if "elasticsearch" in config:
         try:
             from cloudtracker.datasources.es import ElasticSearch
@@ -435,43 +915,150 @@ def run(args, config, start, end):
                 "'pip install git+https://github.com/duo-labs/cloudtracker.git#egg=cloudtracker[es6]' for "
                 "elasticsearch 6 support"
             )
-        datasource = ElasticSearch(config["elasticsearch"], start, end)
+        datasource = ElasticSearch(
+            config["elasticsearch"], start, end, cache_dir=get_cache_dir(config)
+        )
+        if config["elasticsearch"].get("last_used_index"):
+            return get_last_used_datasource(
+                datasource, config, "elasticsearch-{}".format(datasource.index), start, end
+            )
+        return datasource
+    elif "local" in config:
+        logging.debug("Using local CloudTrail log files")
+        from cloudtracker.datasources.local import LocalFiles
+
+        return LocalFiles(config["local"], account, start, end)
+    elif "stream" in config:
+        logging.debug("Using the stream state")
+        from cloudtracker.datasources.stream import Stream
+
+        return Stream(config["stream"], account, start, end)
+    elif "sqlite" in config:
+        logging.debug("Using SQLite")
+        from cloudtracker.datasources.sqlite import SQLite
+
+        return SQLite(config["sqlite"], account, start, end)
     else:
         logging.debug("Using Athena")
         from cloudtracker.datasources.athena import Athena
 
-        datasource = Athena(config["athena"], account, start, end, args)
+        datasource = Athena(
+            config["athena"],
+            account,
+            start,
+            end,
+            args,
+            clients=athena_clients,
+            ledger=scan_ledger,
+            scheduler=scheduler,
+        )
+        if config["athena"].get("last_used_index"):
+            return get_last_used_datasource(
+                datasource, config, "athena-{}".format(account["id"]), start, end
+            )
+        return datasource
 
-    # Read AWS actions
-    aws_api_list = read_aws_api_list()
 
-    # Read cloudtrail_supported_events
-    global cloudtrail_supported_actions
-    ct_actions_path = pkg_resources.resource_filename(
-        __name__, "data/{}".format("cloudtrail_supported_actions.txt")
+def get_last_used_datasource(datasource, config, name, start, end):
+    """
+    Answer queries of a datasource from the index of when each API call was last used, kept
+    in the cache directory under name, after extending it to cover the date range
+    """
+    from cloudtracker.datasources.lastused import LastUsed
+    from cloudtracker.lastused import LastUsedIndex
+
+    if get_cache_dir(config) is None:
+        exit("ERROR: last_used_index requires a cache_dir in the config, or --cache-dir")
+    path = get_cache_path(get_cache_dir(config), "last_used", "{}.json".format(name))
+    index = LastUsedIndex.load(path)
+    with profiler.span("update_last_used"):
+        if index.update(datasource.get_last_used_rows, start, end):
+            index.save(path)
+    logging.info(
+        "Using the last used index for {} through {}".format(index.start, index.end)
     )
-    cloudtrail_supported_actions = {}
-    with open(ct_actions_path) as f:
-        lines = f.readlines()
-    for line in lines:
-        (service, event) = line.rstrip().split(":")
-        cloudtrail_supported_actions[normalize_api_call(service, event)] = True
+    return LastUsed(datasource, index, start, end)
+
+
+def get_printfilter(args):
+    """Return the filters for print_diff from the command line arguments"""
+    printfilter = {}
+    printfilter["show_unknown"] = args.show_unknown
+    printfilter["show_benign"] = args.show_benign
+    printfilter["show_used"] = args.show_used
+    return printfilter
+
+
+def run_account(
+    args,
+    config,
+    account,
+    datasource,
+    analyzer,
+    output=None,
+    usage=None,
+    writer=None,
+):
+    """
+    Perform the requested command for one account with an Analyzer, printing its Diffs to
+    stdout or the given output file, or with a DiffWriter, writing them to it as records
+    """
+    use_color = args.use_color
+    if writer is not None:
+        # The writer has stdout, so any progress goes to stderr
+        output = sys.stderr
 
-    account_iam = get_account_iam(account)
+    account_iam = analyzer.get_account_iam(account)
 
     if args.list:
         actor_type = args.list
 
         if actor_type == "users":
-            allowed_actors = get_allowed_users(account_iam)
-            performed_actors = datasource.get_performed_users()
+            diff = analyzer.diff_users(datasource, account_iam)
         elif actor_type == "roles":
-            allowed_actors = get_allowed_roles(account_iam)
-            performed_actors = datasource.get_performed_roles()
+            diff = analyzer.diff_roles(datasource, account_iam)
         else:
             exit("ERROR: --list argument must be one of 'users' or 'roles'")
 
-        print_actor_diff(performed_actors, allowed_actors, use_color)
+        if writer is not None:
+            writer.write_actors(account["name"], diff.classifications)
+        else:
+            print_actor_diff(diff, use_color, output)
+
+    elif args.all:
+        if args.destrole:
+            exit("ERROR: --destrole can not be used with --all")
+
+        # Compare the IAM data with the last time the account was looked at, so only the
+        # actors affected by any changes need their allowed actions worked out again
+        snapshot = None
+        if get_cache_dir(config) is not None:
+            snapshot = IamSnapshot(
+                get_cache_path(
+                    get_cache_dir(config),
+                    "snapshots",
+                    "{}.json".format(account["id"]),
+                ),
+                analyzer.expansions.version,
+            )
+            snapshot.update(account_iam)
+
+        print_all_actor_diffs(
+            datasource,
+            args.all,
+            analyzer,
+            account_iam,
+            get_printfilter(args),
+            use_color,
+            output,
+            snapshot,
+            usage,
+            writer,
+            account["name"],
+        )
+
+        if snapshot is not None:
+            snapshot.save()
 
     else:
         if args.destaccount:
@@ -479,65 +1066,338 @@ def run(args, config, start, end):
         else:
             destination_account = account
 
-        destination_iam = get_account_iam(destination_account)
+        destination_iam = analyzer.get_account_iam(destination_account)
 
         search_query = datasource.get_search_query()
+        dest_role_iam = None
+        get_last_used = getattr(datasource, "get_last_used", None)
+        last_used = None
 
         if args.user:
             username = args.user
 
             user_iam = get_user_iam(username, account_iam)
+            actor_iam = user_iam
             print(
                 "Getting info on {}, user created {}".format(
                     args.user, user_iam["CreateDate"]
-                )
+                ),
+                file=output,
             )
 
             if args.destrole:
                 dest_role_iam = get_role_iam(args.destrole, destination_iam)
-                print("Getting info for AssumeRole into {}".format(args.destrole))
+                print(
+                    "Getting info for AssumeRole into {}".format(args.destrole),
+                    file=output,
+                )
 
-                allowed_actions = get_role_allowed_actions(
-                    aws_api_list, dest_role_iam, destination_iam
+                allowed_actions = analyzer.get_role_allowed_actions(
+                    dest_role_iam, destination_iam
                 )
                 performed_actions = datasource.get_performed_event_names_by_user_in_role(
                     search_query, user_iam, dest_role_iam
                 )
             else:
-                allowed_actions = get_user_allowed_actions(
-                    aws_api_list, user_iam, account_iam
+                allowed_actions = analyzer.get_user_allowed_actions(
+                    user_iam, account_iam
                 )
                 performed_actions = datasource.get_performed_event_names_by_user(
                     search_query, user_iam
                 )
+                if get_last_used is not None:
+                    last_used = get_last_used("users", user_iam["Arn"])
         elif args.role:
             rolename = args.role
             role_iam = get_role_iam(rolename, account_iam)
-            print("Getting info for role {}".format(rolename))
+            actor_iam = role_iam
+            print("Getting info for role {}".format(rolename), file=output)
 
             if args.destrole:
                 dest_role_iam = get_role_iam(args.destrole, destination_iam)
-                print("Getting info for AssumeRole into {}".format(args.destrole))
+                print(
+                    "Getting info for AssumeRole into {}".format(args.destrole),
+                    file=output,
+                )
 
-                allowed_actions = get_role_allowed_actions(
-                    aws_api_list, dest_role_iam, destination_iam
+                allowed_actions = analyzer.get_role_allowed_actions(
+                    dest_role_iam, destination_iam
                 )
                 performed_actions = datasource.get_performed_event_names_by_role_in_role(
                     search_query, role_iam, dest_role_iam
                 )
             else:
-                allowed_actions = get_role_allowed_actions(
-                    aws_api_list, role_iam, account_iam
+                allowed_actions = analyzer.get_role_allowed_actions(
+                    role_iam, account_iam
                 )
                 performed_actions = datasource.get_performed_event_names_by_role(
                     search_query, role_iam
                 )
+                if get_last_used is not None:
+                    last_used = get_last_used("roles", role_iam["Arn"])
         else:
             exit("ERROR: Must specify a user or a role")
 
-        printfilter = {}
-        printfilter["show_unknown"] = args.show_unknown
-        printfilter["show_benign"] = args.show_benign
-        printfilter["show_used"] = args.show_used
+        diff = analyzer.diff_actions(performed_actions, allowed_actions)
+        if writer is not None:
+            writer.write_actions(
+                account["name"],
+                actor_iam["Arn"],
+                diff.classifications,
+                get_printfilter(args),
+                assumed_role=dest_role_iam["Arn"] if dest_role_iam else None,
+            )
+        else:
+            print_diff(
+                diff,
+                get_printfilter(args),
+                use_color,
+                output,
+                last_used,
+            )
+
+
+def get_accounts(accounts, account_names):
+    """
+    Gets the account structs from the config file for a comma separated list of account
+    names (or IDs), or for all of them if account_names is "all"
+    """
+    if account_names == "all":
+        account_names = [str(account["name"]) for account in accounts]
+    else:
+        account_names = [name.strip() for name in account_names.split(",")]
+    return [get_account(accounts, account_name) for account_name in account_names]
+
+
+def run_accounts(
+    args,
+    config,
+    start,
+    end,
+    analyzer,
+    usage=None,
+    writer=None,
+    scan_ledger=None,
+    scheduler=None,
+):
+    """
+    Perform the requested command for many accounts at once, on a pool of threads.  The
+    Analyzer is shared, as are the datasource connections where possible.
+    Each account's output is collected and printed together, in the order the accounts were
+    given, and an account that fails is reported without stopping the others.
+    """
+    if args.destaccount:
+        exit("ERROR: --destaccount can not be used with --accounts")
+    accounts = get_accounts(config["accounts"], args.accounts)
+
+    # ElasticSearch isn't specific to an account, so one connection serves them all.  For
+    # Athena, each account has its own table, but the AWS clients are shared.
+    shared_datasource = None
+    athena_clients = None
+    org_events = None
+    account_args = args
+    if "elasticsearch" in config:
+        shared_datasource = get_datasource(args, config, None, start, end)
+    elif uses_athena(config):
+        from cloudtracker.datasources.athena import Athena, get_clients
+
+        athena_clients = get_clients()
+
+        if config["athena"].get("org_table"):
+            # The organization table only needs setting up once, and with --all a single
+            # query of it finds what was done in every account
+            org_datasource = Athena(
+                config["athena"],
+                accounts[0],
+                start,
+                end,
+                args,
+                clients=athena_clients,
+                ledger=scan_ledger,
+                scheduler=scheduler,
+            )
+            account_args = copy.copy(args)
+            account_args.skip_setup = True
+            if args.all:
+                org_events = org_datasource.get_performed_event_names_by_accounts(
+                    [account["id"] for account in accounts], args.all
+                )
+
+    def run_one(account):
+        output = io.StringIO()
+        try:
+            with profiler.span("open_datasource"):
+                datasource = shared_datasource or get_datasource(
+                    account_args,
+                    config,
+                    account,
+                    start,
+                    end,
+                    athena_clients,
+                    scan_ledger,
+                    scheduler,
+                )
+            if org_events is not None:
+                datasource.use_performed_events(org_events[str(account["id"])])
+            with profiler.span("run_account", account=str(account["id"])):
+                run_account(
+                    account_args,
+                    config,
+                    account,
+                    datasource,
+                    analyzer,
+                    output,
+                    usage=usage,
+                    writer=writer,
+                )
+        except (Exception, SystemExit) as e:
+            return output.getvalue(), e
+        return output.getvalue(), None
+
+    with ThreadPoolExecutor(max_workers=args.workers) as executor:
+        results = list(executor.map(run_one, accounts))
+
+    failures = []
+    for account, (text, error) in zip(accounts, results):
+        if writer is None:
+            # Records from a writer say which account they are for, so they need no heading
+            colored_print(
+                "Account {} ({})".format(account["name"], account["id"]),
+                args.use_color,
+                "cyan",
+            )
+            sys.stdout.write(text)
+        if error is not None:
+            failures.append((account, error))
+
+    for account, error in failures:
+        logging.error("Account {} failed: {}".format(account["name"], error))
+    if failures and scan_ledger is not None:
+        from cloudtracker.datasources.athena import ScanBudgetExceeded
 
-        print_diff(performed_actions, allowed_actions, printfilter, use_color)
+        # The budget per run is shared by every account, so going over it ends the whole run
+        for _, error in failures:
+            if isinstance(error, ScanBudgetExceeded):
+                raise error
+    if failures:
+        exit("ERROR: {} of {} accounts failed".format(len(failures), len(accounts)))
+
+
+def run(args, config, start, end):
+    """Perform the requested command"""
+    if not getattr(args, "profile", None):
+        run_command(args, config, start, end)
+        return
+
+    # Record where the time goes, and write it out even if the run fails, as those runs are
+    # often the ones most worth looking at
+    profiler.enable()
+    try:
+        run_command(args, config, start, end)
+    finally:
+        try:
+            with open(args.profile, "w") as f:
+                profiler.write(f, getattr(args, "profile_format", "json"))
+            logging.info("Wrote the profile of the run to {}".format(args.profile))
+        finally:
+            profiler.disable()
+
+
+def run_command(args, config, start, end):
+    """Perform the requested command, for run"""
+    from cloudtracker.analyzer import Analyzer
+
+    # The Analyzer reads the API lists, and expands policies attached to many users and roles
+    # only once, and with a cache directory, only once across runs.  It also keeps the
+    # managed policy documents repeated in the IAM file of every account only once.
+    with profiler.span("read_api_lists"):
+        analyzer = Analyzer(
+            cache_dir=get_cache_dir(config), workers=getattr(args, "processes", None)
+        )
+
+    # For a report, the users or roles are collected into a matrix, rather than printed
+    usage = None
+    if getattr(args, "report", None):
+        if not args.all:
+            exit("ERROR: --report can only be used with --all")
+        try:
+            from cloudtracker.report import UsageMatrix
+        except ImportError:
+            exit(
+                "NumPy is needed for reports. Install with support via "
+                "'pip install git+https://github.com/duo-labs/cloudtracker.git#egg=cloudtracker[report]'"
+            )
+        usage = UsageMatrix(analyzer.cloudtrail_supported_actions)
+
+    # Diffs can be written as records for other tools to read, instead of as text
+    writer = None
+    if getattr(args, "format", "text") != "text":
+        from cloudtracker.output import get_writer
+
+        writer = get_writer(args.format, sys.stdout)
+
+    # The data scanned by Athena is kept within any budgets, and reported at the end.  Its
+    # queries are kept within the account's quota, and are stopped if the run is interrupted.
+    scan_ledger = None
+    scheduler = None
+    interrupt_guard = contextlib.nullcontext()
+    if uses_athena(config):
+        from cloudtracker.datasources.athena import QueryScheduler, ScanLedger
+
+        scan_ledger = ScanLedger(config["athena"])
+        scheduler = QueryScheduler(config["athena"])
+        interrupt_guard = scheduler.cancel_on_interrupt()
+
+    with interrupt_guard:
+        try:
+            if getattr(args, "accounts", None):
+                run_accounts(
+                    args,
+                    config,
+                    start,
+                    end,
+                    analyzer,
+                    usage,
+                    writer,
+                    scan_ledger,
+                    scheduler,
+                )
+            else:
+                account = get_account(config["accounts"], args.account)
+                with profiler.span("open_datasource"):
+                    datasource = get_datasource(
+                        args,
+                        config,
+                        account,
+                        start,
+                        end,
+                        scan_ledger=scan_ledger,
+                        scheduler=scheduler,
+                    )
+                with profiler.span("run_account", account=str(account["id"])):
+                    run_account(
+                        args,
+                        config,
+                        account,
+                        datasource,
+                        analyzer,
+                        usage=usage,
+                        writer=writer,
+                    )
+        finally:
+            analyzer.close()
+            if writer is not None:
+                writer.close()
+            if scan_ledger is not None:
+                scan_ledger.write_report(sys.stderr)
+
+    if usage is not None:
+        with profiler.span("write_report"):
+            usage.build()
+            with open(args.report, "w", newline="") as f:
+                usage.write_report(f)
+        logging.info(
+            "Wrote the report of {} principals to {}".format(
+                len(usage.principals), args.report
+            )
+        )
@@ -0,0 +1,179 @@
+"""
+Copyright 2018 Duo Security
+
+Redistribution and use in source and binary forms, with or without modification, are permitted provided that the
+following conditions are met:
+
+1. Redistributions of source code must retain the above copyright notice, this list of conditions and the following
+disclaimer.
+
+2. Redistributions in binary form must reproduce the above copyright notice, this list of conditions and the
+following disclaimer in the documentation and/or other materials provided with the distribution.
+
+3. Neither the name of the copyright holder nor the names of its contributors may be used to endorse or promote
+products derived from this software without specific prior written permission.
+
+THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES,
+INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL,
+SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY,
+WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE
+USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+---------------------------------------------------------------------------
+"""
+
+
+from cloudtracker import (
+    classify_actions,
+    classify_actors,
+    Classification,
+    ExpansionCache,
+    get_account_iam,
+    get_allowed_roles,
+    get_allowed_users,
+    get_role_allowed_actions,
+    get_user_allowed_actions,
+    read_aws_api_list,
+    read_cloudtrail_supported_actions,
+)
+from cloudtracker.cache import PolicyStore
+
+
+class Diff(object):
+    """The Classification of each action, or actor, when comparing what was allowed with what was done"""
+
+    classifications = None
+
+    def __init__(self, classifications):
+        self.classifications = classifications
+
+    def __iter__(self):
+        """Iterate over (name, Classification) pairs, sorted by name"""
+        return iter(sorted(self.classifications.items()))
+
+    def __len__(self):
+        return len(self.classifications)
+
+    def get(self, classification):
+        """Return the set of names with the given Classification"""
+        return {
+            name
+            for name, name_classification in self.classifications.items()
+            if name_classification == classification
+        }
+
+    @property
+    def used(self):
+        """Allowed, and performed"""
+        return self.get(Classification.PERFORMED_AND_ALLOWED)
+
+    @property
+    def not_allowed(self):
+        """Performed, but not allowed now"""
+        return self.get(Classification.PERFORMED_BUT_NOT_ALLOWED)
+
+    @property
+    def unused(self):
+        """Allowed, but not performed"""
+        return self.get(Classification.ALLOWED_BUT_NOT_PERFORMED)
+
+    @property
+    def unknown(self):
+        """Allowed, but not recorded by CloudTrail, so it is unknown if it was performed"""
+        return self.get(Classification.ALLOWED_BUT_NOT_KNOWN_IF_PERFORMED)
+
+
+class Analyzer(object):
+    """
+    Compares what users and roles are allowed to do with what they did, returning the
+    results as Diffs rather than printing them.  The API lists are read once, when the
+    Analyzer is made, and it holds no global state, so one Analyzer can be shared by many
+    threads, such as in a service, or when looking at many accounts at once.
+    """
+
+    aws_api_list = None
+    cloudtrail_supported_actions = None
+    expansions = None
+    policy_store = None
+
+    def __init__(
+        self,
+        aws_api_list=None,
+        cloudtrail_supported_actions=None,
+        cache_dir=None,
+        workers=None,
+    ):
+        if aws_api_list is None:
+            aws_api_list = read_aws_api_list()
+        if cloudtrail_supported_actions is None:
+            cloudtrail_supported_actions = read_cloudtrail_supported_actions()
+        self.aws_api_list = aws_api_list
+        self.cloudtrail_supported_actions = cloudtrail_supported_actions
+        self.expansions = ExpansionCache(aws_api_list, cache_dir, workers)
+        self.policy_store = PolicyStore(cache_dir)
+
+    def is_recorded(self, action):
+        """Given an action, return True if it would be logged by CloudTrail"""
+        return action in self.cloudtrail_supported_actions
+
+    def get_account_iam(self, account):
+        """Given account data from the config file, read the IAM data of the account"""
+        return get_account_iam(account, self.policy_store)
+
+    def get_user_allowed_actions(self, user_iam, account_iam):
+        """Return the actions a user is allowed by IAM"""
+        return get_user_allowed_actions(
+            self.aws_api_list, user_iam, account_iam, self.expansions
+        )
+
+    def get_role_allowed_actions(self, role_iam, account_iam):
+        """Return the actions a role is allowed by IAM"""
+        return get_role_allowed_actions(
+            self.aws_api_list, role_iam, account_iam, self.expansions
+        )
+
+    def diff_actions(self, performed_actions, allowed_actions):
+        """Compare the actions an actor performed with those they are allowed"""
+        return Diff(
+            classify_actions(performed_actions, allowed_actions, self.is_recorded)
+        )
+
+    def diff_actors(self, performed_actors, allowed_actors):
+        """Compare the actors that performed actions with those that exist"""
+        return Diff(classify_actors(performed_actors, allowed_actors))
+
+    def diff_users(self, datasource, account_iam):
+        """Compare the users that performed actions with those in the account"""
+        return self.diff_actors(
+            datasource.get_performed_users(), get_allowed_users(account_iam)
+        )
+
+    def diff_roles(self, datasource, account_iam):
+        """Compare the roles that performed actions with those in the account"""
+        return self.diff_actors(
+            datasource.get_performed_roles(), get_allowed_roles(account_iam)
+        )
+
+    def diff_user(self, datasource, user_iam, account_iam):
+        """Compare the actions a user performed with those they are allowed"""
+        performed_actions = datasource.get_performed_event_names_by_user(
+            datasource.get_search_query(), user_iam
+        )
+        return self.diff_actions(
+            performed_actions, self.get_user_allowed_actions(user_iam, account_iam)
+        )
+
+    def diff_role(self, datasource, role_iam, account_iam):
+        """Compare the actions a role performed with those it is allowed"""
+        performed_actions = datasource.get_performed_event_names_by_role(
+            datasource.get_search_query(), role_iam
+        )
+        return self.diff_actions(
+            performed_actions, self.get_role_allowed_actions(role_iam, account_iam)
+        )
+
+    def close(self):
+        """Stop any worker processes, and save the policy expansions for next time"""
+        self.expansions.close()
+        self.expansions.save()
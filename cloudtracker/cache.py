@@ -0,0 +1,164 @@
+"""
+Copyright 2018 Duo Security
+
+Redistribution and use in source and binary forms, with or without modification, are permitted provided that the
+following conditions are met:
+
+1. Redistributions of source code must retain the above copyright notice, this list of conditions and the following
+disclaimer.
+
+2. Redistributions in binary form must reproduce the above copyright notice, this list of conditions and the
+following disclaimer in the documentation and/or other materials provided with the distribution.
+
+3. Neither the name of the copyright holder nor the names of its contributors may be used to endorse or promote
+products derived from this software without specific prior written permission.
+
+THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES,
+INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL,
+SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY,
+WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE
+USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+---------------------------------------------------------------------------
+"""
+
+import hashlib
+import json
+import logging
+import os
+import threading
+
+# Where the checkpoint of `cloudtracker ingest` is kept, if there is no `cache_dir`
+DEFAULT_CACHE_DIR = os.path.join(os.path.expanduser("~"), ".cloudtracker")
+
+
+def get_cache_dir(config):
+    """
+    Given the config file contents, return the directory to store cached data in, or None
+    if `cache_dir` isn't set, in which case nothing is kept between runs
+    """
+    cache_dir = config.get("cache_dir")
+    if cache_dir is None:
+        return None
+    return os.path.expanduser(cache_dir)
+
+
+def get_cache_path(cache_dir, *names):
+    """Return the path of a file in the cache directory, creating any directories needed"""
+    path = os.path.join(cache_dir, *names)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    return path
+
+
+def load_json(path, default=None):
+    """Read a cached JSON file, returning default if it doesn't exist or can't be read"""
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return default
+    except ValueError:
+        logging.warning("Ignoring unreadable cache file {}".format(path))
+        return default
+
+
+def save_json(path, data):
+    """Write a cached JSON file, replacing it atomically so readers never see a partial file"""
+    tmp_path = "{}.{}.tmp".format(path, os.getpid())
+    with open(tmp_path, "w") as f:
+        json.dump(data, f)
+    os.replace(tmp_path, path)
+
+
+def get_content_hash(obj):
+    """Return a hash of the canonical JSON form of an object, such as a policy document"""
+    canonical = json.dumps(obj, sort_keys=True, separators=(",", ":"))
+    return hashlib.sha256(canonical.encode("utf-8")).hexdigest()
+
+
+class PolicyStore(object):
+    """
+    Managed policy documents, stored once by a hash of their contents and shared by the IAM
+    data of every account.  The IAM file of each account repeats the documents of all the AWS
+    managed policies, so an account's IAM data is also cached with references to the
+    documents in place of their contents, which is much quicker to read.
+    """
+
+    documents = None
+    cache_dir = None
+
+    def __init__(self, cache_dir=None):
+        self.documents = {}
+        self.cache_dir = cache_dir
+        self.lock = threading.Lock()
+
+    def add(self, document):
+        """Store a policy document, returning its hash"""
+        key = get_content_hash(document)
+        if key in self.documents:
+            return key
+
+        with self.lock:
+            if key not in self.documents:
+                if self.cache_dir is not None:
+                    path = get_cache_path(self.cache_dir, "policies", "{}.json".format(key))
+                    if not os.path.exists(path):
+                        save_json(path, document)
+                self.documents[key] = document
+        return key
+
+    def get(self, key):
+        """Return the policy document with the given hash"""
+        document = self.documents.get(key)
+        if document is None:
+            if self.cache_dir is not None:
+                document = load_json(
+                    os.path.join(self.cache_dir, "policies", "{}.json".format(key))
+                )
+            if document is None:
+                raise KeyError("Unknown policy document {}".format(key))
+            document = self.documents.setdefault(key, document)
+        return document
+
+    def get_account_cache_path(self, iam_path):
+        """Return where the IAM data of an account is cached, for this version of its IAM file"""
+        stat = os.stat(iam_path)
+        key = get_content_hash(
+            [os.path.abspath(iam_path), stat.st_size, stat.st_mtime_ns]
+        )
+        return get_cache_path(self.cache_dir, "iam", "{}.json".format(key))
+
+    def load_account_iam(self, iam_path):
+        """Read the IAM data of an account, sharing its managed policy documents"""
+        cache_path = None
+        if self.cache_dir is not None:
+            cache_path = self.get_account_cache_path(iam_path)
+            account_iam = load_json(cache_path)
+            if account_iam is not None:
+                for policy in account_iam.get("Policies") or []:
+                    for version in policy.get("PolicyVersionList") or []:
+                        version["Document"] = self.get(version.pop("DocumentHash"))
+                return account_iam
+
+        with open(iam_path) as f:
+            account_iam = json.load(f)
+
+        keys = []
+        for policy in account_iam.get("Policies") or []:
+            for version in policy.get("PolicyVersionList") or []:
+                key = self.add(version["Document"])
+                version["Document"] = self.documents[key]
+                keys.append((version, key))
+
+        if cache_path is not None:
+            # Save a copy with references in place of the documents
+            for version, key in keys:
+                del version["Document"]
+                version["DocumentHash"] = key
+            save_json(cache_path, account_iam)
+            for version, key in keys:
+                del version["DocumentHash"]
+                version["Document"] = self.documents[key]
+
+        return account_iam
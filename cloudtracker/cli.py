@@ -26,13 +26,243 @@ USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
 
 import argparse
 import datetime
+import os
+import sys
 
 import yaml
 
 from . import run
 
+# The exit code when a run stops at a scan budget in the athena config
+SCAN_BUDGET_EXIT_CODE = 3
+
+
+def read_config(config_file):
+    """Read the yaml config file"""
+    try:
+        return yaml.safe_load(config_file)
+    except yaml.YAMLError as e:
+        raise argparse.ArgumentError(
+            None,
+            "ERROR: Could not load yaml from config file {}\n{}".format(
+                config_file.name, e
+            ),
+        )
+
+
+def add_config_argument(parser):
+    parser.add_argument(
+        "--config",
+        help="Config file name (default: config.yaml)",
+        required=False,
+        default="config.yaml",
+        type=argparse.FileType("r"),
+    )
+    parser.add_argument(
+        "--cache-dir",
+        dest="cache_dir",
+        help="Directory to keep expanded policies, IAM data and indexes in between runs "
+        "(default: the cache_dir of the config file, or nothing is kept)",
+        required=False,
+        default=None,
+        type=str,
+    )
+
+
+def load_config(args):
+    """Read the config file given on the command line, with any --cache-dir"""
+    config = read_config(args.config)
+    if args.cache_dir:
+        config["cache_dir"] = args.cache_dir
+    return config
+
+
+def summarize(argv):
+    """Build or extend the ElasticSearch summary index"""
+    now = datetime.datetime.now()
+    parser = argparse.ArgumentParser(
+        prog="cloudtracker summarize",
+        description="Roll up the CloudTrail events in ElasticSearch into the summary index, "
+        "continuing from the last day already summarized",
+    )
+    add_config_argument(parser)
+    parser.add_argument(
+        "--start",
+        help="First day to summarize when the summary index is new (ex. 2018-01-21). Defaults to one year ago.",
+        default=(now - datetime.timedelta(days=365)).date().isoformat(),
+        required=False,
+        type=str,
+    )
+    parser.add_argument(
+        "--end",
+        help="Last day to summarize (ex. 2018-01-21). Defaults to yesterday, the last complete day.",
+        default=(now - datetime.timedelta(days=1)).date().isoformat(),
+        required=False,
+        type=str,
+    )
+    args = parser.parse_args(argv)
+    config = load_config(args)
+
+    if "elasticsearch" not in config:
+        exit("ERROR: The summary index requires an elasticsearch config")
+    from cloudtracker.cache import get_cache_dir
+    from cloudtracker.datasources.es import ElasticSearch
+
+    datasource = ElasticSearch(
+        config["elasticsearch"], None, None, cache_dir=get_cache_dir(config)
+    )
+    datasource.build_summary(args.start, args.end)
+
+
+def ingest(argv):
+    """Load CloudTrail log files into ElasticSearch or a SQLite database"""
+    parser = argparse.ArgumentParser(
+        prog="cloudtracker ingest",
+        description="Load CloudTrail log files (.json.gz) into ElasticSearch or a SQLite database. "
+        "Files already loaded are skipped, so loads are incremental, and an interrupted load "
+        "can be resumed by running it again.",
+    )
+    add_config_argument(parser)
+    parser.add_argument(
+        "path", help="Directory of CloudTrail log files, such as a copy of an S3 bucket"
+    )
+    parser.add_argument(
+        "--into",
+        help="Where to load the logs (default: sqlite if configured, otherwise elasticsearch)",
+        choices=["elasticsearch", "sqlite"],
+        required=False,
+        default=None,
+    )
+    parser.add_argument(
+        "--workers",
+        help="Number of processes decoding files (default: number of CPUs)",
+        required=False,
+        default=None,
+        type=int,
+    )
+    parser.add_argument(
+        "--connections",
+        help="Number of _bulk requests to send at once, for elasticsearch (default: 4)",
+        required=False,
+        default=4,
+        type=int,
+    )
+    parser.add_argument(
+        "--checkpoint",
+        help="File recording the log files already loaded into elasticsearch "
+        "(default: in the cache directory, or ~/.cloudtracker)",
+        required=False,
+        default=None,
+        type=str,
+    )
+    args = parser.parse_args(argv)
+    config = load_config(args)
+
+    into = args.into
+    if into is None:
+        into = "sqlite" if "sqlite" in config else "elasticsearch"
+    if into not in config:
+        exit("ERROR: Ingesting into {} requires a {} config".format(into, into))
+
+    if into == "sqlite":
+        from cloudtracker.datasources.sqlite import SQLite
+
+        sqlite_config = dict(config["sqlite"])
+        if args.workers:
+            sqlite_config["workers"] = args.workers
+        SQLite(sqlite_config, None, None, None).ingest(args.path)
+        return
+
+    from cloudtracker.cache import DEFAULT_CACHE_DIR, get_cache_dir, get_cache_path
+    from cloudtracker.datasources.es import ElasticSearch
+    from cloudtracker.ingest import BulkIngester, Checkpoint
+
+    # Size the connection pool for the number of requests sent at once
+    es_config = dict(config["elasticsearch"], max_concurrent_queries=args.connections)
+    datasource = ElasticSearch(es_config, None, None, cache_dir=get_cache_dir(config))
+    # Resuming a load is what the checkpoint is for, so it is always kept
+    checkpoint_path = args.checkpoint or get_cache_path(
+        get_cache_dir(config) or DEFAULT_CACHE_DIR,
+        "ingest",
+        "{}.log".format(datasource.index),
+    )
+    ingester = BulkIngester(
+        datasource.es,
+        datasource.index,
+        datasource.get_doc_type(),
+        datasource.key_prefix.rstrip("."),
+        Checkpoint(checkpoint_path),
+        workers=args.workers,
+        connections=args.connections,
+    )
+    ingester.ingest(args.path)
+
+
+def stream(argv):
+    """Keep track of the API calls each principal makes from a stream of CloudTrail records"""
+    parser = argparse.ArgumentParser(
+        prog="cloudtracker stream",
+        description="Read CloudTrail records as JSON lines on stdin, or from log files as they "
+        "are delivered to a directory, and keep the API calls of each principal up to date in "
+        "the state file used by the `stream` config.",
+    )
+    add_config_argument(parser)
+    parser.add_argument(
+        "--watch",
+        help="Directory to watch for new CloudTrail log files, instead of reading stdin",
+        required=False,
+        default=None,
+        type=str,
+    )
+    parser.add_argument(
+        "--poll-interval",
+        dest="poll_interval",
+        help="Seconds between checks for new log files (default: 10)",
+        required=False,
+        default=10,
+        type=float,
+    )
+    parser.add_argument(
+        "--checkpoint-interval",
+        dest="checkpoint_interval",
+        help="Seconds between saves of the state file (default: 60)",
+        required=False,
+        default=60,
+        type=float,
+    )
+    args = parser.parse_args(argv)
+    config = load_config(args)
+
+    if "stream" not in config:
+        exit("ERROR: Streaming requires a stream config with the state file to keep")
+    from cloudtracker.stream import UsageTracker, consume_directory, consume_lines
+
+    state_path = os.path.expanduser(config["stream"]["state"])
+    tracker = UsageTracker.load(state_path)
+    if args.watch:
+        consume_directory(
+            tracker,
+            args.watch,
+            state_path,
+            args.checkpoint_interval,
+            args.poll_interval,
+        )
+    else:
+        consume_lines(tracker, sys.stdin, state_path, args.checkpoint_interval)
+
+
+# Commands other than investigating an account, run as `cloudtracker <command> ...`
+COMMANDS = {
+    "summarize": summarize,
+    "ingest": ingest,
+    "stream": stream,
+}
+
 
 def main():
+    if len(sys.argv) > 1 and sys.argv[1] in COMMANDS:
+        return COMMANDS[sys.argv[1]](sys.argv[2:])
+
     now = datetime.datetime.now()
     parser = argparse.ArgumentParser()
 
@@ -45,14 +275,13 @@ def main():
     )
     action_group.add_argument("--user", help="User to investigate", type=str)
     action_group.add_argument("--role", help="Role to investigate", type=str)
-
-    parser.add_argument(
-        "--config",
-        help="Config file name (default: config.yaml)",
-        required=False,
-        default="config.yaml",
-        type=argparse.FileType("r"),
+    action_group.add_argument(
+        "--all",
+        help="Investigate every one of the 'users' or 'roles' in the account",
+        choices=["users", "roles"],
     )
+
+    add_config_argument(parser)
     parser.add_argument(
         "--iam",
         dest="iam_file",
@@ -61,7 +290,60 @@ def main():
         default="./data/get-account-authorization-details.json",
         type=str,
     )
-    parser.add_argument("--account", help="Account name", required=True, type=str)
+    account_group = parser.add_mutually_exclusive_group(required=True)
+    account_group.add_argument("--account", help="Account name", type=str)
+    account_group.add_argument(
+        "--accounts",
+        help="Comma separated account names to investigate together, or 'all' for every "
+        "account in the config file",
+        type=str,
+    )
+    parser.add_argument(
+        "--workers",
+        help="With --accounts, the number of accounts to investigate at once",
+        required=False,
+        default=4,
+        type=int,
+    )
+    parser.add_argument(
+        "--format",
+        help="Write the diffs as colored text (the default), or as records in a JSON array, "
+        "newline delimited JSON, or CSV",
+        choices=["text", "json", "ndjson", "csv"],
+        default="text",
+    )
+    parser.add_argument(
+        "--report",
+        help="With --all, write the number of used, unused and unknown privileges of every "
+        "user or role, overall and for each service, to this CSV file instead of their diffs",
+        required=False,
+        default=None,
+        type=str,
+    )
+    parser.add_argument(
+        "--processes",
+        help="With --all, the number of processes to expand IAM policies on. "
+        "Defaults to one per CPU.",
+        required=False,
+        default=None,
+        type=int,
+    )
+    parser.add_argument(
+        "--profile",
+        help="Write the time spent in each phase of the run, and counts such as the queries "
+        "made and the data they scanned, to this file",
+        required=False,
+        default=None,
+        type=str,
+    )
+    parser.add_argument(
+        "--profile-format",
+        dest="profile_format",
+        help="Write the profile as a JSON summary (the default), or as a Chrome trace to view "
+        "in chrome://tracing or Perfetto",
+        choices=["json", "chrome"],
+        default="json",
+    )
     parser.add_argument(
         "--start",
         help="Start of date range (ex. 2018-01-21). Defaults to one year ago.",
@@ -128,14 +410,12 @@ def main():
     args = parser.parse_args()
 
     # Read config
-    try:
-        config = yaml.load(args.config)
-    except yaml.YAMLError as e:
-        raise argparse.ArgumentError(
-            None,
-            "ERROR: Could not load yaml from config file {}\n{}".format(
-                args.config.name, e
-            ),
-        )
+    config = load_config(args)
 
-    run(args, config, args.start, args.end)
+    from cloudtracker.datasources.athena import ScanBudgetExceeded
+
+    try:
+        run(args, config, args.start, args.end)
+    except ScanBudgetExceeded as e:
+        print("ERROR: {}".format(e), file=sys.stderr)
+        sys.exit(SCAN_BUDGET_EXIT_CODE)
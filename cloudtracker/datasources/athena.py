@@ -23,14 +23,23 @@ USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
 ---------------------------------------------------------------------------
 """
 
+import calendar
+import contextlib
 import logging
 import boto3
+import random
+import re
+import signal
+import threading
 import time
 import json
 import datetime
+import uuid
+from botocore.exceptions import ClientError, ConnectionError as BotoConnectionError
 from dateutil.relativedelta import relativedelta
 
 from cloudtracker import normalize_api_call
+from cloudtracker.profiling import profiler
 
 # Much thanks to Alex Smolen (https://twitter.com/alsmola)
 # for his post "Partitioning CloudTrail Logs in Athena"
@@ -43,6 +52,327 @@ from cloudtracker import normalize_api_call
 
 NUM_MONTHS_FOR_PARTITIONS = 12
 
+# The first year the organization table's year partitions are projected for
+FIRST_ORG_TABLE_YEAR = 2013
+
+# Athena's price per TB scanned, in US dollars, unless the config sets price_per_tb.  Each
+# query is billed for at least 10 MB.
+PRICE_PER_TB = 5.0
+MIN_BILLED_BYTES = 10 * 1024 ** 2
+
+SIZE_UNITS = {"": 1, "K": 1024, "M": 1024 ** 2, "G": 1024 ** 3, "T": 1024 ** 4}
+
+# The scan of a query is estimated from the size of the logs of this day of each month it
+# reads, scaled up to the whole month, so that only one day is listed per region and month
+SCAN_SAMPLE_DAY = 15
+
+# The queries that may run at once, unless the config sets max_active_queries.  This is
+# Athena's default quota of active DML queries.
+MAX_ACTIVE_QUERIES = 20
+
+# The attempts made at a call or query that is throttled or fails in passing, unless the
+# config sets max_attempts, and the limits of the backoff between attempts, in seconds
+MAX_ATTEMPTS = 5
+BACKOFF_BASE = 1.0
+BACKOFF_MAX = 30.0
+
+# Error codes of AWS calls that was throttled or failed in passing, so are tried again
+RETRYABLE_ERRORS = (
+    "TooManyRequestsException",
+    "ThrottlingException",
+    "Throttling",
+    "RequestLimitExceeded",
+    "SlowDown",
+    "InternalServerException",
+    "InternalFailure",
+    "ServiceUnavailable",
+)
+
+# Reasons for a query failing that mean it may succeed if run again, for when Athena doesn't
+# say whether it is retryable
+RETRYABLE_QUERY_FAILURES = re.compile(
+    r"ThrottlingException|Rate exceeded|SlowDown|reduce your request rate|INTERNAL_ERROR",
+    re.IGNORECASE,
+)
+
+TABLE_COLUMNS = """
+            `eventversion` string COMMENT 'from deserializer', 
+            `useridentity` struct<type:string,principalid:string,arn:string,accountid:string,invokedby:string,accesskeyid:string,username:string,sessioncontext:struct<attributes:struct<mfaauthenticated:string,creationdate:string>,sessionissuer:struct<type:string,principalid:string,arn:string,accountid:string,username:string>>> COMMENT 'from deserializer', 
+            `eventtime` string COMMENT 'from deserializer', 
+            `eventsource` string COMMENT 'from deserializer', 
+            `eventname` string COMMENT 'from deserializer', 
+            `awsregion` string COMMENT 'from deserializer', 
+            `sourceipaddress` string COMMENT 'from deserializer', 
+            `useragent` string COMMENT 'from deserializer', 
+            `errorcode` string COMMENT 'from deserializer', 
+            `errormessage` string COMMENT 'from deserializer', 
+            `requestparameters` string COMMENT 'from deserializer', 
+            `responseelements` string COMMENT 'from deserializer', 
+            `additionaleventdata` string COMMENT 'from deserializer', 
+            `requestid` string COMMENT 'from deserializer', 
+            `eventid` string COMMENT 'from deserializer', 
+            `resources` array<struct<arn:string,accountid:string,type:string>> COMMENT 'from deserializer', 
+            `eventtype` string COMMENT 'from deserializer', 
+            `apiversion` string COMMENT 'from deserializer', 
+            `readonly` string COMMENT 'from deserializer', 
+            `recipientaccountid` string COMMENT 'from deserializer', 
+            `serviceeventdetails` string COMMENT 'from deserializer', 
+            `sharedeventid` string COMMENT 'from deserializer', 
+            `vpcendpointid` string COMMENT 'from deserializer'"""
+
+TABLE_FORMAT = """ROW FORMAT SERDE 
+            'com.amazon.emr.hive.serde.CloudTrailSerde' 
+            STORED AS INPUTFORMAT 
+            'com.amazon.emr.cloudtrail.CloudTrailInputFormat' 
+            OUTPUTFORMAT 
+            'org.apache.hadoop.hive.ql.io.HiveIgnoreKeyTextOutputFormat'"""
+
+
+def get_clients():
+    """
+    Open connections to the AWS services Athena needs.  The clients are thread-safe, so
+    they can be shared by datasources for many accounts.
+    """
+    return {
+        "sts": boto3.client("sts"),
+        "athena": boto3.client("athena"),
+        "s3": boto3.client("s3"),
+    }
+
+
+def parse_size(size):
+    """Convert a size from the config, such as 500000000 or "500 MB", to bytes"""
+    if size is None or isinstance(size, int):
+        return size
+    match = re.match(r"^([0-9.]+)\s*([KMGT]?)I?B?$", str(size).strip().upper())
+    if match is None:
+        exit("ERROR: {} is not a size, such as 500 MB or 2 TB".format(size))
+    return int(float(match.group(1)) * SIZE_UNITS[match.group(2)])
+
+
+def format_size(size):
+    """Convert bytes to a readable size, such as 1.5 GB"""
+    for unit in ("T", "G", "M", "K"):
+        if size >= SIZE_UNITS[unit]:
+            return "{:.1f} {}B".format(size / SIZE_UNITS[unit], unit)
+    return "{} B".format(size)
+
+
+def get_months(start, end):
+    """Return the (year, month) of every month from the start date through the end date"""
+    year, month = (int(part) for part in start.split("-")[:2])
+    end_year, end_month = (int(part) for part in end.split("-")[:2])
+    months = []
+    while (year, month) <= (end_year, end_month):
+        months.append((year, month))
+        year, month = (year + 1, 1) if month == 12 else (year, month + 1)
+    return months
+
+
+class QueryFailed(Exception):
+    """A query failed, was cancelled, or timed out"""
+
+    def __init__(self, message, retryable=False):
+        super().__init__(message)
+        self.retryable = retryable
+
+
+class ScanBudgetExceeded(Exception):
+    """A query would scan, or has scanned, more than is left of a budget in the config"""
+
+
+class QueryScheduler(object):
+    """
+    Run Athena queries within the quota of queries that may run at once, trying calls that
+    are throttled or fail in passing again after a jittered backoff, and stopping queries
+    that run for longer than query_timeout seconds.  The datasources of the accounts of a run
+    share one scheduler, so that together they stay within the quota, and on an interrupt
+    every query still running is stopped, so they aren't left running up a bill.
+    """
+
+    def __init__(self, config):
+        self.max_active_queries = int(
+            config.get("max_active_queries", MAX_ACTIVE_QUERIES)
+        )
+        self.max_attempts = int(config.get("max_attempts", MAX_ATTEMPTS))
+        self.query_timeout = config.get("query_timeout")
+        self.slots = threading.BoundedSemaphore(self.max_active_queries)
+        self.lock = threading.Lock()
+        # The Athena client each running query was started with, by query id
+        self.active = {}
+        self.cancelled = threading.Event()
+
+    def call(self, operation, **kwargs):
+        """Call an AWS operation, trying again if it is throttled or fails in passing"""
+        for attempt in range(1, self.max_attempts + 1):
+            self.check_cancelled()
+            try:
+                return operation(**kwargs)
+            except (ClientError, BotoConnectionError) as e:
+                if isinstance(e, ClientError):
+                    if e.response["Error"]["Code"] not in RETRYABLE_ERRORS:
+                        raise
+                if attempt == self.max_attempts:
+                    raise
+                profiler.count("athena_retries")
+                logging.debug("Trying again after {}".format(e))
+                self.backoff(attempt)
+
+    def backoff(self, attempt):
+        """Sleep for a random time, up to a limit that doubles with each attempt"""
+        time.sleep(random.uniform(0, min(BACKOFF_MAX, BACKOFF_BASE * 2 ** attempt)))
+
+    def start(self, athena, **params):
+        """Start a query once there is room for it in the quota, and return its id"""
+        with profiler.span("athena_queue"):
+            while not self.slots.acquire(timeout=1):
+                self.check_cancelled()
+        try:
+            query_id = self.call(athena.start_query_execution, **params)[
+                "QueryExecutionId"
+            ]
+        except BaseException:
+            self.slots.release()
+            raise
+        with self.lock:
+            self.active[query_id] = athena
+        return query_id
+
+    def finish(self, query_id):
+        """Give up the place in the quota of a query that has finished"""
+        with self.lock:
+            athena = self.active.pop(query_id, None)
+        if athena is not None:
+            self.slots.release()
+
+    def check_timeout(self, athena, query_id, started):
+        """Stop a query, and raise QueryFailed, if it has run for longer than the timeout"""
+        if self.query_timeout is None:
+            return
+        if time.monotonic() - started <= float(self.query_timeout):
+            return
+        self.call(athena.stop_query_execution, QueryExecutionId=query_id)
+        raise QueryFailed(
+            "Query {} timed out after {} seconds".format(query_id, self.query_timeout)
+        )
+
+    def check_cancelled(self):
+        if self.cancelled.is_set():
+            raise QueryFailed("Interrupted")
+
+    def cancel(self):
+        """Stop every query still running, and any more from starting"""
+        self.cancelled.set()
+        with self.lock:
+            active = list(self.active.items())
+        for query_id, athena in active:
+            try:
+                athena.stop_query_execution(QueryExecutionId=query_id)
+            except Exception as e:
+                logging.warning("Could not stop query {}: {}".format(query_id, e))
+        if active:
+            logging.info("Stopped {} queries that were running".format(len(active)))
+
+    @contextlib.contextmanager
+    def cancel_on_interrupt(self):
+        """On an interrupt within the with statement, stop the queries still running"""
+        if threading.current_thread() is not threading.main_thread():
+            # Signal handlers can only be set from the main thread
+            yield
+            return
+
+        previous = signal.getsignal(signal.SIGINT)
+
+        def interrupt(signum, frame):
+            # A second interrupt isn't held up by stopping the queries
+            signal.signal(signal.SIGINT, previous)
+            self.cancel()
+            raise KeyboardInterrupt()
+
+        signal.signal(signal.SIGINT, interrupt)
+        try:
+            yield
+        finally:
+            signal.signal(signal.SIGINT, previous)
+
+
+class ScanLedger(object):
+    """
+    The data scanned by the Athena queries of a run, and the budgets it is kept within.
+    With max_scan_per_query or max_scan_per_run set in the config, queries estimated to scan
+    more than is left of the budget are not started, and queries that go over it while
+    running are stopped.  The datasources of the accounts of a run share one ledger.
+    """
+
+    def __init__(self, config):
+        self.max_query_bytes = parse_size(config.get("max_scan_per_query"))
+        self.max_run_bytes = parse_size(config.get("max_scan_per_run"))
+        self.price_per_tb = float(config.get("price_per_tb", PRICE_PER_TB))
+        self.lock = threading.Lock()
+        # The (query id, query, bytes scanned) of each finished query
+        self.queries = []
+        # The region prefixes of the logs of each account, and the estimated bytes of the
+        # logs of each region and month
+        self.regions = {}
+        self.estimates = {}
+
+    def has_budget(self):
+        return self.max_query_bytes is not None or self.max_run_bytes is not None
+
+    def get_scanned(self):
+        """Return the bytes scanned by the finished queries"""
+        with self.lock:
+            return sum(scanned for _, _, scanned in self.queries)
+
+    def get_over_budget(self, scanned):
+        """Return why a query scanning this many bytes is over budget, or None if it isn't"""
+        if self.max_query_bytes is not None and scanned > self.max_query_bytes:
+            return "the budget of {} per query".format(format_size(self.max_query_bytes))
+        if (
+            self.max_run_bytes is not None
+            and self.get_scanned() + scanned > self.max_run_bytes
+        ):
+            return "the budget of {} per run, of which {} is used".format(
+                format_size(self.max_run_bytes), format_size(self.get_scanned())
+            )
+        return None
+
+    def add(self, query_id, query, scanned):
+        """Record the bytes a finished query scanned"""
+        with self.lock:
+            self.queries.append((query_id, query, scanned))
+
+    def get_cost(self, query, scanned):
+        """Return the estimated cost in dollars of a query, as Athena bills it"""
+        if not query.lstrip().lower().startswith("select"):
+            # DDL statements are free
+            return 0.0
+        billed = max(MIN_BILLED_BYTES, -(-scanned // 1024 ** 2) * 1024 ** 2)
+        return billed / SIZE_UNITS["T"] * self.price_per_tb
+
+    def write_report(self, f):
+        """Write the bytes each query scanned and its estimated cost, and the totals"""
+        with self.lock:
+            queries = list(self.queries)
+        total_cost = 0.0
+        for query_id, query, scanned in queries:
+            cost = self.get_cost(query, scanned)
+            total_cost += cost
+            print(
+                "{}  {:>10}  ${:.6f}  {}".format(
+                    query_id, format_size(scanned), cost, " ".join(query.split())[:80]
+                ),
+                file=f,
+            )
+        print(
+            "Athena scanned {} in {} queries, costing about ${:.4f}".format(
+                format_size(sum(scanned for _, _, scanned in queries)),
+                len(queries),
+                total_cost,
+            ),
+            file=f,
+        )
+
 
 class Athena(object):
     athena = None
@@ -52,47 +382,80 @@ class Athena(object):
     search_filter = ""
     table_name = ""
     workgroup = 'primary'
+    date_filter = ""
+    org_table = False
+    performed_events = None
+    ledger = None
+    scheduler = None
+    config = None
+    account_id = None
+    months = None
 
     def query_athena(
-        self, query, context={"Database": database}, do_not_wait=False, skip_header=True
+        self,
+        query,
+        context={"Database": database},
+        skip_header=True,
+        account_ids=None,
+        months=None,
     ):
         logging.debug("Making query {}".format(query))
-
-        # Make query request dependent on whether the context is None or not
-        if context is None:
-            response = self.athena.start_query_execution(
-                QueryString=query,
-                ResultConfiguration={"OutputLocation": self.output_bucket},
-                WorkGroup=self.workgroup
-            )
-        else:
-            response = self.athena.start_query_execution(
-                QueryString=query,
-                QueryExecutionContext=context,
-                ResultConfiguration={"OutputLocation": self.output_bucket},
-                WorkGroup=self.workgroup
+        if query.lower().startswith("select") and self.ledger.has_budget():
+            self.check_scan_estimate(
+                query, account_ids or [self.account_id], months or self.months
             )
+        profiler.count("athena_queries")
 
-        if do_not_wait:
-            return response["QueryExecutionId"]
+        # Make query request dependent on whether the context is None or not
+        params = {
+            "QueryString": query,
+            "ResultConfiguration": {"OutputLocation": self.output_bucket},
+            "WorkGroup": self.workgroup,
+        }
+        if context is not None:
+            params["QueryExecutionContext"] = context
+
+        # A query that fails in passing is run again
+        for attempt in range(1, self.scheduler.max_attempts + 1):
+            with profiler.span("athena_start_query"):
+                # The token lets a start that is tried again run the query only once
+                query_id = self.scheduler.start(
+                    self.athena, ClientRequestToken=uuid.uuid4().hex, **params
+                )
 
-        self.wait_for_query_to_complete(response["QueryExecutionId"])
+            try:
+                with profiler.span("athena_wait"):
+                    self.wait_for_query_to_complete(query_id, query)
+            except QueryFailed as e:
+                if not e.retryable or attempt == self.scheduler.max_attempts:
+                    raise
+                profiler.count("athena_query_retries")
+                logging.info("Running query {} again: {}".format(query_id, e))
+                self.scheduler.backoff(attempt)
+                continue
+            finally:
+                self.scheduler.finish(query_id)
+            break
 
         # Paginate results and combine them
         rows = []
-        paginator = self.athena.get_paginator("get_query_results")
-        response_iterator = paginator.paginate(
-            QueryExecutionId=response["QueryExecutionId"]
-        )
-        row_count = 0
-        for response in response_iterator:
-            for row in response["ResultSet"]["Rows"]:
-                row_count += 1
-                if row_count == 1:
-                    if skip_header:
-                        # Skip header
-                        continue
-                rows.append(self.extract_response_values(row))
+        with profiler.span("athena_results"):
+            page = {"NextToken": None}
+            row_count = 0
+            while "NextToken" in page:
+                kwargs = {"QueryExecutionId": query_id}
+                if page["NextToken"] is not None:
+                    kwargs["NextToken"] = page["NextToken"]
+                page = self.scheduler.call(self.athena.get_query_results, **kwargs)
+                profiler.count("athena_result_pages")
+                for row in page["ResultSet"]["Rows"]:
+                    row_count += 1
+                    if row_count == 1:
+                        if skip_header:
+                            # Skip header
+                            continue
+                    rows.append(self.extract_response_values(row))
+        profiler.count("athena_result_rows", len(rows))
         return rows
 
     def extract_response_values(self, row):
@@ -101,28 +464,176 @@ class Athena(object):
             result.append(column.get("VarCharValue", ""))
         return result
 
-    def wait_for_query_to_complete(self, queryExecutionId):
+    def count_statistics(self, query_execution):
+        """Add the data a finished query scanned, and the time it took, to the profile"""
+        statistics = query_execution.get("Statistics", {})
+        profiler.count(
+            "athena_data_scanned_bytes", statistics.get("DataScannedInBytes", 0)
+        )
+        profiler.count(
+            "athena_engine_ms", statistics.get("EngineExecutionTimeInMillis", 0)
+        )
+        profiler.count("athena_queue_ms", statistics.get("QueryQueueTimeInMillis", 0))
+
+    def check_scan_estimate(self, query, account_ids, months):
         """
-        Returns when the query completes successfully, or raises an exception if it fails or is canceled.
-        Waits until the query finishes running.
+        Raise ScanBudgetExceeded if a query of the table for these accounts and months would
+        scan more than the budget
+        """
+        estimate = sum(
+            self.get_scan_estimate(account_id, months) for account_id in account_ids
+        )
+        profiler.count("athena_estimated_scan_bytes", estimate)
+        over_budget = self.ledger.get_over_budget(estimate)
+        if over_budget is not None:
+            raise ScanBudgetExceeded(
+                "Not starting a query that would scan about {}, over {}. Narrow "
+                "--start and --end, or raise the budget in the athena config: {}".format(
+                    format_size(estimate), over_budget, " ".join(query.split())[:200]
+                )
+            )
+
+    def get_log_prefix(self, account_id):
+        """Return the S3 prefix of the CloudTrail logs of an account"""
+        if self.config.get("org_id"):
+            return "{path}/AWSLogs/{org_id}/{account_id}/CloudTrail/".format(
+                path=self.config["path"],
+                org_id=self.config["org_id"],
+                account_id=account_id,
+            )
+        return "{path}/AWSLogs/{account_id}/CloudTrail/".format(
+            path=self.config["path"], account_id=account_id
+        )
+
+    def get_prefix_size(self, prefix):
+        """Return the total size of the objects under an S3 prefix"""
+        size = 0
+        paginator = self.s3.get_paginator("list_objects_v2")
+        for page in paginator.paginate(Bucket=self.config["s3_bucket"], Prefix=prefix):
+            profiler.count("s3_list_requests")
+            size += sum(item["Size"] for item in page.get("Contents", []))
+        return size
+
+    def get_log_regions(self, account_id):
+        """Return the prefixes of the regions under the log prefix of an account"""
+        prefix = self.get_log_prefix(account_id)
+        if prefix not in self.ledger.regions:
+            response = self.scheduler.call(
+                self.s3.list_objects_v2,
+                Bucket=self.config["s3_bucket"],
+                Prefix=prefix,
+                Delimiter="/",
+            )
+            profiler.count("s3_list_requests")
+            self.ledger.regions[prefix] = [
+                common_prefix["Prefix"]
+                for common_prefix in response.get("CommonPrefixes", [])
+            ]
+        return self.ledger.regions[prefix]
+
+    def get_month_estimate(self, region_prefix, year, month):
+        """
+        Estimate the size of the logs of a region in a month, from the size of the logs of
+        one complete day.  The current month is only counted through today, and as today's
+        logs are still being written, a day before today is listed, which on the first of the
+        month is the last day of the month before.
+        """
+        today = datetime.date.today()
+        if (year, month) > (today.year, today.month):
+            return 0
+        days = calendar.monthrange(year, month)[1]
+        if (year, month) == (today.year, today.month):
+            days = today.day
+        sample_day = datetime.date(year, month, min(SCAN_SAMPLE_DAY, days))
+        if sample_day >= today:
+            sample_day = today - datetime.timedelta(days=1)
+        prefix = "{}{}/{:0>2}/{:0>2}/".format(
+            region_prefix, sample_day.year, sample_day.month, sample_day.day
+        )
+        if prefix not in self.ledger.estimates:
+            self.ledger.estimates[prefix] = self.get_prefix_size(prefix) * days
+        return self.ledger.estimates[prefix]
+
+    def get_scan_estimate(self, account_id, months):
+        """
+        Estimate the bytes a query of an account's logs in these months scans.  The
+        partitions are pruned by region, year and month, but every file in the partitions read
+        is scanned, so this is the size of the logs in S3 for those months, extrapolated from
+        one day of each.
+        """
+        estimate = sum(
+            self.get_month_estimate(region_prefix, year, month)
+            for region_prefix in self.get_log_regions(account_id)
+            for year, month in months
+        )
+        logging.debug(
+            "Logs of account {} in the months queried are about {}".format(
+                account_id, format_size(estimate)
+            )
+        )
+        return estimate
+
+    def check_scanned(self, query_execution):
+        """
+        Stop a running query, and raise ScanBudgetExceeded, if the data it has scanned so far
+        is over the budget
+        """
+        scanned = query_execution.get("Statistics", {}).get("DataScannedInBytes", 0)
+        over_budget = self.ledger.get_over_budget(scanned)
+        if over_budget is None:
+            return
+        query_id = query_execution["QueryExecutionId"]
+        self.scheduler.call(self.athena.stop_query_execution, QueryExecutionId=query_id)
+        self.ledger.add(query_id, query_execution.get("Query", ""), scanned)
+        raise ScanBudgetExceeded(
+            "Stopped query {} after it scanned {}, over {}".format(
+                query_id, format_size(scanned), over_budget
+            )
+        )
+
+    def get_query_failure(self, query_execution):
+        """Return a QueryFailed for a query that failed or was cancelled"""
+        status = query_execution["Status"]
+        reason = status.get("StateChangeReason", "")
+        retryable = status["State"] == "FAILED" and status.get("AthenaError", {}).get(
+            "Retryable", RETRYABLE_QUERY_FAILURES.search(reason) is not None
+        )
+        return QueryFailed(
+            "Query entered state {state} with reason {reason}".format(
+                state=status["State"], reason=reason
+            ),
+            retryable,
+        )
+
+    def wait_for_query_to_complete(self, queryExecutionId, query=""):
+        """
+        Returns when the query completes successfully, or raises QueryFailed if it fails, is
+        canceled, or times out.  Waits until the query finishes running, stopping it if it
+        goes over the scan budget.
         """
 
+        started = time.monotonic()
         while True:
-            response = self.athena.get_query_execution(
-                QueryExecutionId=queryExecutionId
+            response = self.scheduler.call(
+                self.athena.get_query_execution, QueryExecutionId=queryExecutionId
             )
+            profiler.count("athena_polls")
             state = response["QueryExecution"]["Status"]["State"]
             if state == "SUCCEEDED":
+                self.count_statistics(response["QueryExecution"])
+                self.ledger.add(
+                    queryExecutionId,
+                    query,
+                    response["QueryExecution"]
+                    .get("Statistics", {})
+                    .get("DataScannedInBytes", 0),
+                )
                 return True
             if state == "FAILED" or state == "CANCELLED":
-                raise Exception(
-                    "Query entered state {state} with reason {reason}".format(
-                        state=state,
-                        reason=response["QueryExecution"]["Status"][
-                            "StateChangeReason"
-                        ],
-                    )
-                )
+                raise self.get_query_failure(response["QueryExecution"])
+            if state == "RUNNING" and self.ledger.has_budget():
+                self.check_scanned(response["QueryExecution"])
+            self.scheduler.check_timeout(self.athena, queryExecutionId, started)
             logging.debug(
                 "Sleeping 1 second while query {} completes".format(queryExecutionId)
             )
@@ -135,22 +646,29 @@ class Athena(object):
         """
 
         while len(queryExecutionIds) > 0:
-            response = self.athena.batch_get_query_execution(
-                QueryExecutionIds=list(queryExecutionIds)
+            response = self.scheduler.call(
+                self.athena.batch_get_query_execution,
+                QueryExecutionIds=list(queryExecutionIds),
             )
+            profiler.count("athena_polls")
             for query_execution in response["QueryExecutions"]:
                 state = query_execution["Status"]["State"]
                 if state == "SUCCEEDED":
                     queryExecutionIds.remove(query_execution["QueryExecutionId"])
-                if state == "FAILED" or state == "CANCELLED":
-                    raise Exception(
-                        "Query entered state {state} with reason {reason}".format(
-                            state=state,
-                            reason=response["QueryExecution"]["Status"][
-                                "StateChangeReason"
-                            ],
-                        )
+                    self.scheduler.finish(query_execution["QueryExecutionId"])
+                    self.count_statistics(query_execution)
+                    self.ledger.add(
+                        query_execution["QueryExecutionId"],
+                        query_execution.get("Query", ""),
+                        query_execution.get("Statistics", {}).get(
+                            "DataScannedInBytes", 0
+                        ),
                     )
+                if state == "RUNNING" and self.ledger.has_budget():
+                    self.check_scanned(query_execution)
+                if state == "FAILED" or state == "CANCELLED":
+                    self.scheduler.finish(query_execution["QueryExecutionId"])
+                    raise self.get_query_failure(query_execution)
 
                 if len(queryExecutionIds) == 0:
                     return
@@ -161,7 +679,17 @@ class Athena(object):
                 )
                 time.sleep(1)
 
-    def __init__(self, config, account, start, end, args):
+    def __init__(
+        self,
+        config,
+        account,
+        start,
+        end,
+        args,
+        clients=None,
+        ledger=None,
+        scheduler=None,
+    ):
         # Mute boto except errors
         logging.getLogger("botocore").setLevel(logging.WARN)
         logging.info(
@@ -178,6 +706,12 @@ class Athena(object):
                 "Start date is over a year old. CloudTracker does not create or use partitions over a year old."
             )
 
+        self.config = config
+        self.account_id = account["id"]
+        self.months = get_months(start, end)
+        self.ledger = ledger or ScanLedger(config)
+        self.scheduler = scheduler or QueryScheduler(config)
+
         #
         # Create date filtering
         #
@@ -209,17 +743,29 @@ class Athena(object):
                 )
 
         # Combine date filters and add error filter
-        self.search_filter = (
-            "((" + " or ".join(month_restrictions) + ") and errorcode IS NULL)"
-        )
-
-        self.table_name = "cloudtrail_logs_{}".format(account["id"])
+        self.date_filter = "(" + " or ".join(month_restrictions) + ")"
+        self.search_filter = "({} and errorcode IS NULL)".format(self.date_filter)
+
+        # With an organization table, every account shares one table partitioned by account
+        self.org_table = config.get("org_table", False)
+        if self.org_table:
+            if not config.get("org_id"):
+                exit("ERROR: org_table requires org_id to be set in the athena config")
+            self.table_name = "cloudtrail_logs_{}".format(
+                config["org_id"].replace("-", "_")
+            )
+            self.search_filter = "(account = '{}' and {})".format(
+                account["id"], self.search_filter
+            )
+        else:
+            self.table_name = "cloudtrail_logs_{}".format(account["id"])
 
         #
         # Display the AWS identity (doubles as a check that boto creds are setup)
         #
-        sts = boto3.client("sts")
-        identity = sts.get_caller_identity()
+        if clients is None:
+            clients = get_clients()
+        identity = self.scheduler.call(clients["sts"].get_caller_identity)
         logging.info("Using AWS identity: {}".format(identity["Arn"]))
         current_account_id = identity["Account"]
         region = boto3.session.Session().region_name
@@ -247,9 +793,8 @@ class Athena(object):
 
         logging.info("Account cloudtrail log path: {}".format(cloudtrail_log_path))
 
-        # Open connections to needed AWS services
-        self.athena = boto3.client("athena")
-        self.s3 = boto3.client("s3")
+        self.athena = clients["athena"]
+        self.s3 = clients["s3"]
 
         if args.skip_setup:
             logging.info("Skipping initial table creation")
@@ -267,51 +812,33 @@ class Athena(object):
             )
 
         # Ensure our database exists
-        self.query_athena(
-            "CREATE DATABASE IF NOT EXISTS {db} {comment}".format(
-                db=self.database, comment="COMMENT 'Created by CloudTracker'"
-            ),
-            context=None,
-        )
+        with profiler.span("athena_create_database"):
+            self.query_athena(
+                "CREATE DATABASE IF NOT EXISTS {db} {comment}".format(
+                    db=self.database, comment="COMMENT 'Created by CloudTracker'"
+                ),
+                context=None,
+            )
+
+        if self.org_table:
+            with profiler.span("athena_create_table"):
+                self.create_org_table(config)
+            return
 
         #
         # Set up table
         #
-        query = """CREATE EXTERNAL TABLE IF NOT EXISTS `{table_name}` (
-            `eventversion` string COMMENT 'from deserializer', 
-            `useridentity` struct<type:string,principalid:string,arn:string,accountid:string,invokedby:string,accesskeyid:string,username:string,sessioncontext:struct<attributes:struct<mfaauthenticated:string,creationdate:string>,sessionissuer:struct<type:string,principalid:string,arn:string,accountid:string,username:string>>> COMMENT 'from deserializer', 
-            `eventtime` string COMMENT 'from deserializer', 
-            `eventsource` string COMMENT 'from deserializer', 
-            `eventname` string COMMENT 'from deserializer', 
-            `awsregion` string COMMENT 'from deserializer', 
-            `sourceipaddress` string COMMENT 'from deserializer', 
-            `useragent` string COMMENT 'from deserializer', 
-            `errorcode` string COMMENT 'from deserializer', 
-            `errormessage` string COMMENT 'from deserializer', 
-            `requestparameters` string COMMENT 'from deserializer', 
-            `responseelements` string COMMENT 'from deserializer', 
-            `additionaleventdata` string COMMENT 'from deserializer', 
-            `requestid` string COMMENT 'from deserializer', 
-            `eventid` string COMMENT 'from deserializer', 
-            `resources` array<struct<arn:string,accountid:string,type:string>> COMMENT 'from deserializer', 
-            `eventtype` string COMMENT 'from deserializer', 
-            `apiversion` string COMMENT 'from deserializer', 
-            `readonly` string COMMENT 'from deserializer', 
-            `recipientaccountid` string COMMENT 'from deserializer', 
-            `serviceeventdetails` string COMMENT 'from deserializer', 
-            `sharedeventid` string COMMENT 'from deserializer', 
-            `vpcendpointid` string COMMENT 'from deserializer')
+        query = """CREATE EXTERNAL TABLE IF NOT EXISTS `{table_name}` ({columns})
             PARTITIONED BY (region string, year string, month string)
-            ROW FORMAT SERDE 
-            'com.amazon.emr.hive.serde.CloudTrailSerde' 
-            STORED AS INPUTFORMAT 
-            'com.amazon.emr.cloudtrail.CloudTrailInputFormat' 
-            OUTPUTFORMAT 
-            'org.apache.hadoop.hive.ql.io.HiveIgnoreKeyTextOutputFormat'
+            {table_format}
             LOCATION '{cloudtrail_log_path}'""".format(
-            table_name=self.table_name, cloudtrail_log_path=cloudtrail_log_path
+            table_name=self.table_name,
+            columns=TABLE_COLUMNS,
+            table_format=TABLE_FORMAT,
+            cloudtrail_log_path=cloudtrail_log_path,
         )
-        self.query_athena(query)
+        with profiler.span("athena_create_table"):
+            self.query_athena(query)
 
         #
         # Create partitions
@@ -325,7 +852,8 @@ class Athena(object):
 
         # Get list of current partitions
         query = "SHOW PARTITIONS {table_name}".format(table_name=self.table_name)
-        partition_list = self.query_athena(query, skip_header=False)
+        with profiler.span("athena_show_partitions"):
+            partition_list = self.query_athena(query, skip_header=False)
 
         partition_set = set()
         for partition in partition_list:
@@ -371,9 +899,152 @@ class Athena(object):
         query_count = len(queries_to_make)
         for query in queries_to_make:
             logging.info("Partition groups remaining to create: {}".format(query_count))
-            self.query_athena(query)
+            with profiler.span("athena_add_partitions"):
+                self.query_athena(query)
             query_count -= 1
 
+    def create_org_table(self, config):
+        """
+        Create the organization table.  Its partitions are projected from the S3 layout,
+        so they don't need to be created, and queries only read the accounts they name.  The
+        years projected are brought up to date each time, as an existing table keeps the
+        range it was created with.
+        """
+        org_log_path = "s3://{bucket}/{path}/AWSLogs/{org_id}".format(
+            bucket=config["s3_bucket"], path=config["path"], org_id=config["org_id"]
+        )
+        logging.info("Organization cloudtrail log path: {}".format(org_log_path))
+
+        # Get region list. Using ec2 here just because it exists in all regions.
+        regions = boto3.session.Session().get_available_regions("ec2")
+        year_range = "{},{}".format(
+            FIRST_ORG_TABLE_YEAR, datetime.datetime.now().year + 1
+        )
+
+        query = """CREATE EXTERNAL TABLE IF NOT EXISTS `{table_name}` ({columns})
+            PARTITIONED BY (account string, region string, year string, month string)
+            {table_format}
+            LOCATION '{org_log_path}'
+            TBLPROPERTIES (
+            'projection.enabled'='true',
+            'projection.account.type'='injected',
+            'projection.region.type'='enum',
+            'projection.region.values'='{regions}',
+            'projection.year.type'='integer',
+            'projection.year.range'='{year_range}',
+            'projection.month.type'='integer',
+            'projection.month.range'='1,12',
+            'projection.month.digits'='2',
+            'storage.location.template'='{org_log_path}/${{account}}/CloudTrail/${{region}}/${{year}}/${{month}}/')""".format(
+            table_name=self.table_name,
+            columns=TABLE_COLUMNS,
+            table_format=TABLE_FORMAT,
+            org_log_path=org_log_path,
+            regions=",".join(regions),
+            year_range=year_range,
+        )
+        self.query_athena(query)
+
+        # Integer projections can't be open ended, so extend the range to include next year
+        query = "ALTER TABLE `{table_name}` SET TBLPROPERTIES ('projection.year.range'='{year_range}')".format(
+            table_name=self.table_name, year_range=year_range
+        )
+        self.query_athena(query)
+
+    def get_performed_event_names_by_accounts(self, account_ids, principal_type):
+        """
+        For the users or roles of many accounts, return all performed events, with a single
+        query of the organization table.  Returns {account_id: {arn: {event_name: True}}}
+        """
+        if not self.org_table:
+            raise Exception("Querying many accounts at once requires org_table")
+
+        if principal_type == "users":
+            principal_field = "userIdentity.arn"
+        else:
+            principal_field = "userIdentity.sessionContext.sessionIssuer.arn"
+
+        query = "select distinct account, {principal_field}, eventsource, eventname from {table_name} where account IN ({accounts}) and {principal_field} IS NOT NULL and {date_filter} and errorcode IS NULL".format(
+            principal_field=principal_field,
+            table_name=self.table_name,
+            accounts=", ".join("'{}'".format(account_id) for account_id in account_ids),
+            date_filter=self.date_filter,
+        )
+        response = self.query_athena(query, account_ids=account_ids)
+
+        events_by_account = {str(account_id): {} for account_id in account_ids}
+        for account_id, arn, eventsource, eventname in response:
+            service = eventsource.split(".")[0]
+            events_by_account.setdefault(account_id, {}).setdefault(arn, {})[
+                normalize_api_call(service, eventname)
+            ] = True
+        return events_by_account
+
+    def get_last_used_rows(self, start, end):
+        """
+        Return when each user and role first and last made each API call from start through
+        end, with a single grouped query, as rows of (principal type, ARN, name, eventsource,
+        eventname, first seen, last seen)
+        """
+        is_role = "userIdentity.sessionContext.sessionIssuer.type = 'Role'"
+        months = get_months(start, end)
+        day_after_end = datetime.datetime.strptime(
+            end, "%Y-%m-%d"
+        ) + datetime.timedelta(days=1)
+        search_filter = "({months}) and eventtime >= '{start}' and eventtime < '{end}' and errorcode IS NULL".format(
+            months=" or ".join(
+                "(year = '{:0>2}' and month = '{:0>2}')".format(year, month)
+                for year, month in months
+            ),
+            start=start,
+            end=day_after_end.date().isoformat(),
+        )
+        if self.org_table:
+            search_filter = "account = '{}' and {}".format(
+                self.account_id, search_filter
+            )
+        query = """select
+            case when {is_role} then 'roles' else 'users' end,
+            case when {is_role} then userIdentity.sessionContext.sessionIssuer.arn else userIdentity.arn end,
+            case when {is_role} then userIdentity.sessionContext.sessionIssuer.userName else userIdentity.userName end,
+            eventsource, eventname, min(eventtime), max(eventtime)
+            from {table_name} where userIdentity.arn IS NOT NULL and {search_filter}
+            group by 1, 2, 3, 4, 5""".format(
+            is_role=is_role, table_name=self.table_name, search_filter=search_filter
+        )
+        return self.query_athena(query, months=months)
+
+    def use_performed_events(self, events_by_arn):
+        """
+        Answer lookups of users and roles from events already queried, such as those from
+        get_performed_event_names_by_accounts
+        """
+        self.performed_events = events_by_arn
+
+    def get_performed_event_names_by_users(self, searchquery, users_iam):
+        """For many users, return all performed events, keyed by ARN"""
+        if self.performed_events is not None:
+            return {
+                user_iam["Arn"]: self.performed_events.get(user_iam["Arn"], {})
+                for user_iam in users_iam
+            }
+        return {
+            user_iam["Arn"]: self.get_performed_event_names_by_user(searchquery, user_iam)
+            for user_iam in users_iam
+        }
+
+    def get_performed_event_names_by_roles(self, searchquery, roles_iam):
+        """For many roles, return all performed events, keyed by ARN"""
+        if self.performed_events is not None:
+            return {
+                role_iam["Arn"]: self.performed_events.get(role_iam["Arn"], {})
+                for role_iam in roles_iam
+            }
+        return {
+            role_iam["Arn"]: self.get_performed_event_names_by_role(searchquery, role_iam)
+            for role_iam in roles_iam
+        }
+
     def get_performed_users(self):
         """
         Returns the users that performed actions within the search filters
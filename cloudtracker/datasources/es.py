@@ -23,31 +23,103 @@ USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
 ---------------------------------------------------------------------------
 """
 
-from elasticsearch import Elasticsearch
+import datetime
+import hashlib
+import json
+import logging
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from elasticsearch import Elasticsearch, NotFoundError
+from elasticsearch.helpers import bulk
 from elasticsearch_dsl import Search, Q
 from cloudtracker import normalize_api_call
+from cloudtracker.cache import get_cache_path, load_json, save_json
+from cloudtracker.profiling import profiler
+
+# Number of per-actor searches to send in each _msearch request
+MSEARCH_BATCH_SIZE = 100
+
+# Number of requests that may be in flight to the cluster at once
+MAX_CONCURRENT_QUERIES = 4
+
+# Connection settings that identify a cluster, used to cache its version, and how long in
+# seconds a cached version is used before it is looked up again, in case the cluster has
+# been upgraded
+CLUSTER_KEYS = ("host", "port", "scheme", "url_prefix")
+ES_VERSION_CACHE_SECONDS = 24 * 60 * 60
+
+# Number of buckets to request per page of the composite aggregation used to build the summary
+SUMMARY_PAGE_SIZE = 1000
+
+# The summary index stores the day it has been built through in the document with this id
+SUMMARY_CHECKPOINT_ID = "checkpoint"
+
+SUMMARY_MAPPING = {
+    "properties": {
+        "principalType": {"type": "keyword"},
+        "arn": {"type": "keyword"},
+        "name": {"type": "keyword"},
+        "eventSource": {"type": "keyword"},
+        "eventName": {"type": "keyword"},
+        "day": {"type": "date", "format": "yyyy-MM-dd"},
+        "count": {"type": "long"},
+        "firstSeen": {"type": "date"},
+        "lastSeen": {"type": "date"},
+        "firstDay": {"type": "date", "format": "yyyy-MM-dd"},
+        "lastDay": {"type": "date", "format": "yyyy-MM-dd"},
+    }
+}
+
+# For each type of principal, the fields identifying it in a CloudTrail record
+SUMMARY_PRINCIPALS = {
+    "user": ("userIdentity.arn", "userIdentity.userName"),
+    "role": (
+        "userIdentity.sessionContext.sessionIssuer.arn",
+        "userIdentity.sessionContext.sessionIssuer.userName",
+    ),
+}
 
 
 class ElasticSearch(object):
     es = None
     index = "cloudtrail"
     key_prefix = ""
+    msearch_batch_size = MSEARCH_BATCH_SIZE
+    max_concurrent_queries = MAX_CONCURRENT_QUERIES
+    summary_index = None
 
     # Create search filters
     searchfilter = None
 
-    def __init__(self, config, start, end):
-        # Open connection to ElasticSearch
-        self.es = Elasticsearch([config], timeout=900)
+    # The days to read from the summary index, and the filter for the raw events after them
+    summary_days = None
+    after_summary_filter = None
+
+    def __init__(self, config, start, end, cache_dir=None):
+        self.max_concurrent_queries = int(
+            config.get("max_concurrent_queries", MAX_CONCURRENT_QUERIES)
+        )
+
+        # Open connection to ElasticSearch.  A list of `hosts` spreads the requests over
+        # several nodes, and the connection pool to each node is sized so every query we
+        # allow in flight can reuse a kept-alive connection.
+        hosts = config.get("hosts", [config])
+        self.es = Elasticsearch(
+            hosts, timeout=900, maxsize=self.max_concurrent_queries
+        )
         self.searchfilter = {}
         self.index = config.get("index", "cloudtrail")
         self.key_prefix = config.get("key_prefix", "")
         if self.key_prefix != "":
             self.key_prefix += "."
         self.timestamp_field = config.get("timestamp_field", "eventTime")
+        self.msearch_batch_size = int(
+            config.get("msearch_batch_size", MSEARCH_BATCH_SIZE)
+        )
 
         # Used to make elasticsearch query language semantics dynamically based on version
-        self.es_version = int(self.es.info()["version"]["number"].split(".")[0])
+        self.es_version = self.get_es_version(config, hosts, cache_dir)
 
         # Filter errors
         # https://www.elastic.co/guide/en/elasticsearch/reference/2.0/breaking_20_query_dsl_changes.html
@@ -70,6 +142,334 @@ class ElasticSearch(object):
                 "range", **{self.timestamp_field: {"lte": end}}
             )
 
+        # Use the summary index for as much of the date range as it covers
+        self.summary_index = config.get("summary_index")
+        if self.summary_index and start and end:
+            self.summary_days = self.get_summary_days(start, end)
+        if self.summary_days is not None:
+            logging.info(
+                "Using summary index {} for {} through {}".format(
+                    self.summary_index, *self.summary_days
+                )
+            )
+            if self.summary_days[1] != end:
+                day_after = parse_day(self.summary_days[1]) + datetime.timedelta(days=1)
+                self.after_summary_filter = Q(
+                    "range", **{self.timestamp_field: {"gte": format_day(day_after)}}
+                )
+
+    def get_es_version(self, config, hosts, cache_dir):
+        """
+        Return the major version of the cluster.  This is read from the config if set,
+        otherwise it is looked up, and with a cache directory, cached for each cluster for
+        ES_VERSION_CACHE_SECONDS to avoid a round trip on every run.
+        """
+        if "es_version" in config:
+            return int(config["es_version"])
+        if cache_dir is None:
+            profiler.count("es_requests")
+            return int(self.es.info()["version"]["number"].split(".")[0])
+
+        cache_path = get_cache_path(cache_dir, "es_versions.json")
+        # Identify the cluster by where it is, ignoring cloudtracker's own settings
+        cluster = json.dumps(
+            [
+                {key: host[key] for key in CLUSTER_KEYS if key in host}
+                if isinstance(host, dict)
+                else host
+                for host in hosts
+            ],
+            sort_keys=True,
+        )
+        es_versions = load_json(cache_path, {})
+        cached = es_versions.get(cluster)
+        # Versions cached before they were timed are looked up again
+        if (
+            isinstance(cached, dict)
+            and time.time() - cached["checked"] < ES_VERSION_CACHE_SECONDS
+        ):
+            profiler.count("es_version_cache_hits")
+            return cached["version"]
+
+        profiler.count("es_requests")
+        es_version = int(self.es.info()["version"]["number"].split(".")[0])
+        logging.debug("Caching version {} for cluster {}".format(es_version, cluster))
+        es_versions[cluster] = {"version": es_version, "checked": time.time()}
+        save_json(cache_path, es_versions)
+        return es_version
+
+    def map_concurrently(self, func, items):
+        """
+        Call func on each of the items, with at most max_concurrent_queries calls in flight
+        at once.  Returns the results in the same order as the items.
+        """
+        items = list(items)
+        if self.max_concurrent_queries <= 1 or len(items) <= 1:
+            return [func(item) for item in items]
+        with ThreadPoolExecutor(max_workers=self.max_concurrent_queries) as executor:
+            return list(executor.map(func, items))
+
+    def get_summary_checkpoint(self):
+        """Return the range of days the summary index has been built for, or None if it hasn't been built"""
+        try:
+            return self.es.get(
+                index=self.summary_index,
+                doc_type=self.get_doc_type(),
+                id=SUMMARY_CHECKPOINT_ID,
+            )["_source"]
+        except NotFoundError:
+            return None
+
+    def get_summary_days(self, start, end):
+        """
+        Return the first and last day of the date range that can be read from the summary index,
+        or None if the summary index doesn't cover the start of the range.
+        """
+        checkpoint = self.get_summary_checkpoint()
+        if checkpoint is None:
+            return None
+        if start < checkpoint["firstDay"] or start > checkpoint["lastDay"]:
+            return None
+        return (start, min(end, checkpoint["lastDay"]))
+
+    def has_events_after_summary(self):
+        """Returns True if some of the date range has to be read from the raw events"""
+        return self.summary_days is None or self.after_summary_filter is not None
+
+    def get_events_after_summary_query(self, searchquery):
+        """Restrict a query on the raw events to the days the summary index doesn't cover"""
+        if self.after_summary_filter is None:
+            return searchquery
+        return searchquery.query(self.after_summary_filter)
+
+    def get_summary_query(self, principal_type, arn=None):
+        """Return a query on the summary index for a type of principal, within the date range"""
+        search = (
+            Search(using=self.es, index=self.summary_index)
+            .filter("term", principalType=principal_type)
+            .filter(
+                "range",
+                day={"gte": self.summary_days[0], "lte": self.summary_days[1]},
+            )
+        )
+        if arn is not None:
+            search = search.filter("term", arn=arn)
+        return search
+
+    def get_summary_names(self, principal_type):
+        """Return the names of the users or roles in the summary index within the date range"""
+        if self.summary_days is None:
+            return []
+        search = self.get_summary_query(principal_type).extra(size=0)
+        search.aggs.bucket("names", "terms", field="name", size=5000)
+        profiler.count("es_requests")
+        with profiler.span("es_search"):
+            response = search.execute()
+        return [bucket.key for bucket in response.aggregations.names.buckets]
+
+    def build_summary(self, start, end):
+        """
+        Roll up the raw events into the summary index, with one document per principal, API call,
+        and day, holding the number of calls and when they were first and last seen.  Days are
+        built in order and recorded in a checkpoint, so this continues from the last day
+        already built, or from start if the summary index is new, through end, or through
+        yesterday if end is later, as a day that isn't over would never be built again.
+        """
+        if self.es_version < 6:
+            exit("ERROR: Building a summary index requires ElasticSearch 6 or later")
+        if not self.summary_index:
+            exit("ERROR: No summary_index is set in the elasticsearch config")
+
+        if not self.es.indices.exists(index=self.summary_index):
+            logging.info("Creating summary index {}".format(self.summary_index))
+            self.es.indices.create(
+                index=self.summary_index,
+                body={"mappings": self.get_summary_mappings()},
+            )
+
+        checkpoint = self.get_summary_checkpoint()
+        if checkpoint is None:
+            first_day = start
+            day = parse_day(start)
+        else:
+            first_day = checkpoint["firstDay"]
+            day = parse_day(checkpoint["lastDay"]) + datetime.timedelta(days=1)
+
+        last_day = min(
+            parse_day(end), datetime.datetime.utcnow().date() - datetime.timedelta(days=1)
+        )
+        while day <= last_day:
+            doc_count = 0
+            for principal_type in SUMMARY_PRINCIPALS:
+                count, _ = bulk(self.es, self.get_summary_docs(principal_type, day))
+                doc_count += count
+
+            self.es.index(
+                index=self.summary_index,
+                doc_type=self.get_doc_type(),
+                id=SUMMARY_CHECKPOINT_ID,
+                body={"firstDay": first_day, "lastDay": format_day(day)},
+                refresh=True,
+            )
+            logging.info(
+                "Summarized {} as {} documents".format(format_day(day), doc_count)
+            )
+            day += datetime.timedelta(days=1)
+
+    def get_summary_docs(self, principal_type, day):
+        """
+        Generate the summary documents for one type of principal on one day, by paging through
+        a composite aggregation of the raw events.
+        """
+        arn_field, name_field = SUMMARY_PRINCIPALS[principal_type]
+        sources = [
+            {"arn": {"terms": {"field": self.get_field_name(arn_field)}}},
+            {"name": {"terms": {"field": self.get_field_name(name_field)}}},
+            {"eventSource": {"terms": {"field": self.get_field_name("eventSource")}}},
+            {"eventName": {"terms": {"field": self.get_field_name("eventName")}}},
+        ]
+        next_day = day + datetime.timedelta(days=1)
+        body = {
+            "size": 0,
+            "query": {
+                "bool": {
+                    "filter": [
+                        {
+                            "range": {
+                                self.timestamp_field: {
+                                    "gte": format_day(day),
+                                    "lt": format_day(next_day),
+                                }
+                            }
+                        }
+                    ],
+                    "must_not": [
+                        {"exists": {"field": self.get_field_name("errorCode")}}
+                    ],
+                }
+            },
+            "aggs": {
+                "summary": {
+                    "composite": {"size": SUMMARY_PAGE_SIZE, "sources": sources},
+                    "aggs": {
+                        "first_seen": {"min": {"field": self.timestamp_field}},
+                        "last_seen": {"max": {"field": self.timestamp_field}},
+                    },
+                }
+            },
+        }
+
+        while True:
+            response = self.es.search(index=self.index, body=body)
+            buckets = response["aggregations"]["summary"]["buckets"]
+            for bucket in buckets:
+                key = bucket["key"]
+                doc_id = hashlib.sha1(
+                    "|".join(
+                        [
+                            principal_type,
+                            key["arn"],
+                            key["eventSource"],
+                            key["eventName"],
+                            format_day(day),
+                        ]
+                    ).encode("utf-8")
+                ).hexdigest()
+                yield {
+                    "_index": self.summary_index,
+                    "_type": self.get_doc_type(),
+                    "_id": doc_id,
+                    "_source": {
+                        "principalType": principal_type,
+                        "arn": key["arn"],
+                        "name": key["name"],
+                        "eventSource": key["eventSource"],
+                        "eventName": key["eventName"],
+                        "day": format_day(day),
+                        "count": bucket["doc_count"],
+                        "firstSeen": bucket["first_seen"]["value_as_string"],
+                        "lastSeen": bucket["last_seen"]["value_as_string"],
+                    },
+                }
+
+            if len(buckets) < SUMMARY_PAGE_SIZE:
+                return
+            body["aggs"]["summary"]["composite"]["after"] = buckets[-1]["key"]
+
+    def get_last_used_rows(self, start, end):
+        """
+        Generate when each user and role first and last made each API call from start through
+        end, as rows of (principal type, ARN, name, eventSource, eventName, first seen, last
+        seen), by paging through a composite aggregation of the raw events
+        """
+        if self.es_version < 6:
+            exit("ERROR: The last used index requires ElasticSearch 6 or later")
+
+        for principal_type, (arn_field, name_field) in SUMMARY_PRINCIPALS.items():
+            sources = [
+                {"arn": {"terms": {"field": self.get_field_name(arn_field)}}},
+                {"name": {"terms": {"field": self.get_field_name(name_field)}}},
+                {"eventSource": {"terms": {"field": self.get_field_name("eventSource")}}},
+                {"eventName": {"terms": {"field": self.get_field_name("eventName")}}},
+            ]
+            body = {
+                "size": 0,
+                "query": {
+                    "bool": {
+                        "filter": [
+                            {"range": {self.timestamp_field: {"gte": start, "lte": end}}}
+                        ],
+                        "must_not": [
+                            {"exists": {"field": self.get_field_name("errorCode")}}
+                        ],
+                    }
+                },
+                "aggs": {
+                    "last_used": {
+                        "composite": {"size": SUMMARY_PAGE_SIZE, "sources": sources},
+                        "aggs": {
+                            "first_seen": {"min": {"field": self.timestamp_field}},
+                            "last_seen": {"max": {"field": self.timestamp_field}},
+                        },
+                    }
+                },
+            }
+
+            while True:
+                profiler.count("es_requests")
+                with profiler.span("es_search"):
+                    response = self.es.search(index=self.index, body=body)
+                buckets = response["aggregations"]["last_used"]["buckets"]
+                for bucket in buckets:
+                    key = bucket["key"]
+                    yield (
+                        principal_type + "s",
+                        key["arn"],
+                        key["name"],
+                        key["eventSource"],
+                        key["eventName"],
+                        bucket["first_seen"]["value_as_string"],
+                        bucket["last_seen"]["value_as_string"],
+                    )
+
+                if len(buckets) < SUMMARY_PAGE_SIZE:
+                    break
+                body["aggs"]["last_used"]["composite"]["after"] = buckets[-1]["key"]
+
+    def get_doc_type(self):
+        """Return the document type to index raw events with"""
+        if self.es_version >= 7:
+            return "_doc"
+        return "doc"
+
+    def get_summary_mappings(self):
+        """Return the mappings to create the summary index with"""
+        # Mapping types were removed in ElasticSearch 7
+        # https://www.elastic.co/guide/en/elasticsearch/reference/7.0/removal-of-types.html
+        if self.es_version >= 7:
+            return SUMMARY_MAPPING
+        return {self.get_doc_type(): SUMMARY_MAPPING}
+
     def get_field_name(self, field):
         return self.key_prefix + field + self.get_field_suffix()
 
@@ -92,9 +492,15 @@ class ElasticSearch(object):
         """
         Returns the users that performed actions within the search filters
         """
-        search = Search(using=self.es, index=self.index)
-        for query in self.searchfilter.values():
-            search = search.query(query)
+        user_names = {}
+        for user_name in self.get_summary_names("user"):
+            if user_name == "HIDDEN_DUE_TO_SECURITY_REASONS":
+                continue
+            user_names[user_name] = True
+        if not self.has_events_after_summary():
+            return user_names
+
+        search = self.get_events_after_summary_query(self.get_search_query())
 
         search.aggs.bucket(
             "user_names",
@@ -102,9 +508,10 @@ class ElasticSearch(object):
             field=self.get_field_name("userIdentity.userName"),
             size=5000,
         )
-        response = search.execute()
+        profiler.count("es_requests")
+        with profiler.span("es_search"):
+            response = search.execute()
 
-        user_names = {}
         for user in response.aggregations.user_names.buckets:
             if user.key == "HIDDEN_DUE_TO_SECURITY_REASONS":
                 # This happens when a user logs in with the wrong username
@@ -116,17 +523,22 @@ class ElasticSearch(object):
         """
         Returns the roles that performed actions within the search filters
         """
-        search = Search(using=self.es, index=self.index)
-        for query in self.searchfilter.values():
-            search = search.query(query)
+        role_names = {}
+        for role_name in self.get_summary_names("role"):
+            role_names[role_name] = True
+        if not self.has_events_after_summary():
+            return role_names
+
+        search = self.get_events_after_summary_query(self.get_search_query())
 
         userName_field = self.get_field_name(
             "userIdentity.sessionContext.sessionIssuer.userName"
         )
         search.aggs.bucket("role_names", "terms", field=userName_field, size=5000)
-        response = search.execute()
+        profiler.count("es_requests")
+        with profiler.span("es_search"):
+            response = search.execute()
 
-        role_names = {}
         for role in response.aggregations.role_names.buckets:
             role_names[role.key] = True
         return role_names
@@ -141,44 +553,167 @@ class ElasticSearch(object):
 
         return search
 
-    def get_events_from_search(self, searchquery):
+    def add_event_aggregations(self, searchquery, summary=False):
         """
-        Given a started elasticsearch query, apply the remaining search filters, and
-        return the API calls that exist for this query.
-        s: search query
+        Add the aggregations used to find the distinct API calls to a search query.
+        searchquery: search query
+        summary: True if the query is against the summary index instead of the raw events
         """
+        if summary:
+            event_name_field, event_source_field = "eventName", "eventSource"
+        else:
+            event_name_field = self.get_field_name("eventName")
+            event_source_field = self.get_field_name("eventSource")
+
         searchquery.aggs.bucket(
-            "event_names", "terms", field=self.get_field_name("eventName"), size=5000
+            "event_names", "terms", field=event_name_field, size=5000
         ).bucket(
             "service_names",
             "terms",
-            field=self.get_field_name("eventSource"),
+            field=event_source_field,
             size=5000,
         )
-        response = searchquery.execute()
+        return searchquery
 
+    def get_events_from_buckets(self, buckets):
+        """
+        Given the buckets of an event_names aggregation, return the API calls they contain.
+        """
         event_names = {}
 
-        for event in response.aggregations.event_names.buckets:
-            service = event.service_names.buckets[0].key
+        for event in buckets:
+            service = event["service_names"]["buckets"][0]["key"]
             service = service.split(".")[0]
 
-            event_names[normalize_api_call(service, event.key)] = True
+            event_names[normalize_api_call(service, event["key"])] = True
+
+        return event_names
+
+    def get_events_from_search(self, searchquery):
+        """
+        Given a started elasticsearch query, apply the remaining search filters, and
+        return the API calls that exist for this query.
+        s: search query
+        """
+        profiler.count("es_requests")
+        with profiler.span("es_search"):
+            response = self.add_event_aggregations(searchquery).execute()
+        return self.get_events_from_buckets(response.aggregations.event_names.buckets)
 
+    def get_events_from_searches(self, searches, indexes=None):
+        """
+        Given a dict of keys to elasticsearch queries with their event aggregations added,
+        return a dict of those keys to the API calls that exist for each query.  The queries
+        are sent through _msearch in batches of msearch_batch_size, instead of one request per query.
+        The queries are of the index of raw events, except for those whose keys are in the
+        dict of indexes, such as queries of the summary index.
+        """
+        indexes = indexes or {}
+        keys = list(searches)
+        batches = [
+            keys[i : i + self.msearch_batch_size]
+            for i in range(0, len(keys), self.msearch_batch_size)
+        ]
+
+        def search_batch(batch):
+            body = []
+            for key in batch:
+                # Only the aggregations are needed, so don't return any hits
+                searchquery = searches[key].extra(size=0)
+                body.append({"index": indexes.get(key, self.index)})
+                body.append(searchquery.to_dict())
+
+            profiler.count("es_requests")
+            profiler.count("es_searches", len(batch))
+            with profiler.span("es_msearch", searches=len(batch)):
+                response = self.es.msearch(index=self.index, body=body)
+
+            # Responses are returned in the same order as the searches were sent
+            batch_event_names = {}
+            for key, result in zip(batch, response["responses"]):
+                if "error" in result:
+                    raise Exception(
+                        "Search for {} failed: {}".format(key, result["error"])
+                    )
+                batch_event_names[key] = self.get_events_from_buckets(
+                    result["aggregations"]["event_names"]["buckets"]
+                )
+            return batch_event_names
+
+        event_names = {}
+        for batch_event_names in self.map_concurrently(search_batch, batches):
+            event_names.update(batch_event_names)
         return event_names
 
+    def get_innerquery_chunk_size(self):
+        """
+        Number of per-session searches to collect before sending them, which is enough to
+        fill every in-flight _msearch request.
+        """
+        return self.msearch_batch_size * self.max_concurrent_queries
+
+    def update_events_from_searches(self, event_names, searches):
+        """Add the API calls found by all the given searches into event_names"""
+        for search_event_names in self.get_events_from_searches(searches).values():
+            event_names.update(search_event_names)
+
     def get_performed_event_names_by_user(self, searchquery, user_iam):
         """For a user, return all performed events"""
-        searchquery = searchquery.query(
-            self.get_query_match("userIdentity.arn", user_iam["Arn"])
-        )
-        return self.get_events_from_search(searchquery)
+        return self.get_performed_event_names_by_users(searchquery, [user_iam])[
+            user_iam["Arn"]
+        ]
 
     def get_performed_event_names_by_role(self, searchquery, role_iam):
         """For a role, return all performed events"""
-        field = "userIdentity.sessionContext.sessionIssuer.arn"
-        searchquery = searchquery.query(self.get_query_match(field, role_iam["Arn"]))
-        return self.get_events_from_search(searchquery)
+        return self.get_performed_event_names_by_roles(searchquery, [role_iam])[
+            role_iam["Arn"]
+        ]
+
+    def get_performed_event_names_by_users(self, searchquery, users_iam):
+        """For a list of users, return a dict of each user's ARN to their performed events"""
+        return self.get_performed_event_names_by_principals(
+            searchquery, "user", users_iam
+        )
+
+    def get_performed_event_names_by_roles(self, searchquery, roles_iam):
+        """For a list of roles, return a dict of each role's ARN to their performed events"""
+        return self.get_performed_event_names_by_principals(
+            searchquery, "role", roles_iam
+        )
+
+    def get_performed_event_names_by_principals(
+        self, searchquery, principal_type, principals_iam
+    ):
+        """
+        For a list of users or roles, return a dict of each one's ARN to their performed events.
+        The days covered by the summary index are read from it, and the rest from the raw events.
+        """
+        arn_field = SUMMARY_PRINCIPALS[principal_type][0]
+
+        searches = {}
+        indexes = {}
+        for principal_iam in principals_iam:
+            arn = principal_iam["Arn"]
+            if self.summary_days is not None:
+                searches[(arn, "summary")] = self.add_event_aggregations(
+                    self.get_summary_query(principal_type, arn), summary=True
+                )
+                indexes[(arn, "summary")] = self.summary_index
+            if self.has_events_after_summary():
+                searches[(arn, "events")] = self.add_event_aggregations(
+                    self.get_events_after_summary_query(searchquery).query(
+                        self.get_query_match(arn_field, arn)
+                    )
+                )
+
+        event_names = {}
+        for principal_iam in principals_iam:
+            event_names[principal_iam["Arn"]] = {}
+        for (arn, _), search_event_names in self.get_events_from_searches(
+            searches, indexes
+        ).items():
+            event_names[arn].update(search_event_names)
+        return event_names
 
     def get_performed_event_names_by_user_in_role(
         self, searchquery, user_iam, role_iam
@@ -191,22 +726,29 @@ class ElasticSearch(object):
         )
 
         event_names = {}
+        innerqueries = {}
         for roleAssumption in sessionquery.scan():
+            profiler.count("es_role_assumptions")
             sessionKey = roleAssumption.responseElements.credentials.accessKeyId
             # I assume the session key is unique enough to use for identifying role assumptions
             # TODO: I should also be using sharedEventID as explained in:
             # https://aws.amazon.com/blogs/security/aws-cloudtrail-now-tracks-cross-account-activity-to-its-origin/
             # I could also use the timings of these events.
-            innerquery = searchquery.query(
-                self.get_query_match("userIdentity.accessKeyId", sessionKey)
-            ).query(
-                self.get_query_match(
-                    "userIdentity.sessionContext.sessionIssuer.arn", role_iam["Arn"]
+            innerqueries[sessionKey] = self.add_event_aggregations(
+                searchquery.query(
+                    self.get_query_match("userIdentity.accessKeyId", sessionKey)
+                ).query(
+                    self.get_query_match(
+                        "userIdentity.sessionContext.sessionIssuer.arn", role_iam["Arn"]
+                    )
                 )
             )
 
-            event_names.update(self.get_events_from_search(innerquery))
+            if len(innerqueries) >= self.get_innerquery_chunk_size():
+                self.update_events_from_searches(event_names, innerqueries)
+                innerqueries = {}
 
+        self.update_events_from_searches(event_names, innerqueries)
         return event_names
 
     def get_performed_event_names_by_role_in_role(
@@ -228,8 +770,10 @@ class ElasticSearch(object):
         # TODO I should get a count of the number of role assumptions, since this can be millions
 
         event_names = {}
+        innerqueries = {}
         count = 0
         for roleAssumption in sessionquery.scan():
+            profiler.count("es_role_assumptions")
             count += 1
             if count % 1000 == 0:
                 # This is just info level information, for cases where many role assumptions have happened
@@ -237,15 +781,30 @@ class ElasticSearch(object):
                 # is continuously assuming into another role and that is the only thing assuming into it.
                 print("{} role assumptions scanned so far...".format(count))
             sessionKey = roleAssumption.responseElements.credentials.accessKeyId
-            innerquery = searchquery.query(
-                self.get_query_match("userIdentity.accessKeyId", sessionKey)
-            ).query(
-                self.get_query_match(
-                    "userIdentity.sessionContext.sessionIssuer.arn",
-                    dest_role_iam["Arn"],
+            innerqueries[sessionKey] = self.add_event_aggregations(
+                searchquery.query(
+                    self.get_query_match("userIdentity.accessKeyId", sessionKey)
+                ).query(
+                    self.get_query_match(
+                        "userIdentity.sessionContext.sessionIssuer.arn",
+                        dest_role_iam["Arn"],
+                    )
                 )
             )
 
-            event_names.update(self.get_events_from_search(innerquery))
+            if len(innerqueries) >= self.get_innerquery_chunk_size():
+                self.update_events_from_searches(event_names, innerqueries)
+                innerqueries = {}
 
+        self.update_events_from_searches(event_names, innerqueries)
         return event_names
+
+
+def parse_day(day):
+    """Convert a date string such as 2018-01-21 to a date"""
+    return datetime.datetime.strptime(day[:10], "%Y-%m-%d").date()
+
+
+def format_day(day):
+    """Convert a date to a string such as 2018-01-21"""
+    return day.isoformat()
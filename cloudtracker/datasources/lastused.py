@@ -0,0 +1,152 @@
+"""
+Copyright 2018 Duo Security
+
+Redistribution and use in source and binary forms, with or without modification, are permitted provided that the
+following conditions are met:
+
+1. Redistributions of source code must retain the above copyright notice, this list of conditions and the following
+disclaimer.
+
+2. Redistributions in binary form must reproduce the above copyright notice, this list of conditions and the
+following disclaimer in the documentation and/or other materials provided with the distribution.
+
+3. Neither the name of the copyright holder nor the names of its contributors may be used to endorse or promote
+products derived from this software without specific prior written permission.
+
+THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES,
+INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL,
+SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY,
+WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE
+USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+---------------------------------------------------------------------------
+"""
+
+import logging
+
+
+class LastUsed(object):
+    """
+    Answers queries for a date range from a LastUsedIndex, without querying the datasource
+    it was built from, except for the users and roles whose use in the date range the index
+    can't tell.  The last time each API call was used is also available for showing in diffs.
+    """
+
+    datasource = None
+    index = None
+    performed_events = None
+
+    def __init__(self, datasource, index, start, end):
+        self.datasource = datasource
+        self.index = index
+        self.start = start
+        self.end = end
+
+    def get_performed_users(self):
+        """
+        Returns the users that performed actions within the search filters
+        """
+        user_names = self.index.get_names("users", self.start, self.end)
+        if user_names is None:
+            return self.datasource.get_performed_users()
+        # This happens when a user logs in with the wrong username
+        user_names.pop("HIDDEN_DUE_TO_SECURITY_REASONS", None)
+        return user_names
+
+    def get_performed_roles(self):
+        """
+        Returns the roles that performed actions within the search filters
+        """
+        role_names = self.index.get_names("roles", self.start, self.end)
+        if role_names is None:
+            return self.datasource.get_performed_roles()
+        return role_names
+
+    def get_search_query(self):
+        return self.datasource.get_search_query()
+
+    def use_performed_events(self, events_by_arn):
+        """
+        Answer lookups of users and roles from events already queried, such as by the
+        organization table for many accounts at once
+        """
+        self.datasource.use_performed_events(events_by_arn)
+        self.performed_events = events_by_arn
+
+    def get_performed_event_names(self, principal_type, actors_iam, batch_lookup, lookup):
+        """
+        For many users or roles, return all performed events, keyed by ARN.  The actors the
+        index can't answer for are looked up in the datasource, in a batch if it supports that.
+        """
+        events_by_arn = {}
+        unknown = []
+        for actor_iam in actors_iam:
+            event_names = None
+            if self.performed_events is None:
+                event_names = self.index.get_event_names(
+                    principal_type, actor_iam["Arn"], self.start, self.end
+                )
+            if event_names is None:
+                unknown.append(actor_iam)
+            else:
+                events_by_arn[actor_iam["Arn"]] = event_names
+
+        if unknown:
+            logging.debug(
+                "Querying the datasource for {} {}".format(len(unknown), principal_type)
+            )
+            searchquery = self.datasource.get_search_query()
+            if batch_lookup is not None:
+                events_by_arn.update(batch_lookup(searchquery, unknown))
+            else:
+                for actor_iam in unknown:
+                    events_by_arn[actor_iam["Arn"]] = lookup(searchquery, actor_iam)
+        return events_by_arn
+
+    def get_performed_event_names_by_user(self, _, user_iam):
+        """For a user, return all performed events"""
+        return self.get_performed_event_names_by_users(None, [user_iam])[user_iam["Arn"]]
+
+    def get_performed_event_names_by_role(self, _, role_iam):
+        """For a role, return all performed events"""
+        return self.get_performed_event_names_by_roles(None, [role_iam])[role_iam["Arn"]]
+
+    def get_performed_event_names_by_users(self, _, users_iam):
+        """For many users, return all performed events, keyed by ARN"""
+        return self.get_performed_event_names(
+            "users",
+            users_iam,
+            getattr(self.datasource, "get_performed_event_names_by_users", None),
+            self.datasource.get_performed_event_names_by_user,
+        )
+
+    def get_performed_event_names_by_roles(self, _, roles_iam):
+        """For many roles, return all performed events, keyed by ARN"""
+        return self.get_performed_event_names(
+            "roles",
+            roles_iam,
+            getattr(self.datasource, "get_performed_event_names_by_roles", None),
+            self.datasource.get_performed_event_names_by_role,
+        )
+
+    def get_performed_event_names_by_user_in_role(
+        self, searchquery, user_iam, role_iam
+    ):
+        """For a user that has assumed into another role, return all performed events"""
+        # Role assumptions aren't in the index, so are always queried
+        return self.datasource.get_performed_event_names_by_user_in_role(
+            searchquery, user_iam, role_iam
+        )
+
+    def get_performed_event_names_by_role_in_role(
+        self, searchquery, role_iam, dest_role_iam
+    ):
+        """For a role that has assumed into another role, return all performed events"""
+        return self.datasource.get_performed_event_names_by_role_in_role(
+            searchquery, role_iam, dest_role_iam
+        )
+
+    def get_last_used(self, principal_type, arn):
+        """Return the last time a user or role made each API call, by API call"""
+        return self.index.get_last_used(principal_type, arn)
@@ -0,0 +1,393 @@
+"""
+Copyright 2018 Duo Security
+
+Redistribution and use in source and binary forms, with or without modification, are permitted provided that the
+following conditions are met:
+
+1. Redistributions of source code must retain the above copyright notice, this list of conditions and the following
+disclaimer.
+
+2. Redistributions in binary form must reproduce the above copyright notice, this list of conditions and the
+following disclaimer in the documentation and/or other materials provided with the distribution.
+
+3. Neither the name of the copyright holder nor the names of its contributors may be used to endorse or promote
+products derived from this software without specific prior written permission.
+
+THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES,
+INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL,
+SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY,
+WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE
+USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+---------------------------------------------------------------------------
+"""
+
+import logging
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+from cloudtracker import normalize_api_call
+from cloudtracker.events import EventFrame
+from cloudtracker.logfiles import find_account_log_files, get_field, read_log_file
+
+# Number of files handed to a worker process at a time
+FILES_PER_TASK = 64
+
+# The fields whose values are recorded in the index of each log file.  A scan matching on one
+# of these skips the files whose index doesn't contain any of the values it is looking for.
+INDEXED_FIELDS = (
+    "userIdentity.arn",
+    "userIdentity.sessionContext.sessionIssuer.arn",
+    "userIdentity.accessKeyId",
+)
+
+# Extension of the index files
+INDEX_EXTENSION = ".idx"
+
+# Looking up at least this many users or roles at once reads every file into an EventFrame,
+# rather than scanning for their ARNs
+FRAME_MIN_PRINCIPALS = 32
+
+
+def read_index(index_path, path):
+    """
+    Return the set of values in the index of a log file, or None if it hasn't been built or is
+    older than the log file.
+    """
+    try:
+        if os.path.getmtime(index_path) < os.path.getmtime(path):
+            return None
+        with open(index_path) as f:
+            return set(f.read().splitlines())
+    except OSError:
+        return None
+
+
+def write_index(index_path, records):
+    """
+    Write the index of a log file: the sorted, distinct values of the indexed fields in the
+    records of successful API calls, one per line.
+    """
+    values = set()
+    for record in records:
+        if "errorCode" in record:
+            continue
+        for field in INDEXED_FIELDS:
+            value = get_field(record, field)
+            if value:
+                values.add(value)
+
+    tmp_path = "{}.{}.tmp".format(index_path, os.getpid())
+    try:
+        os.makedirs(os.path.dirname(index_path), exist_ok=True)
+        with open(tmp_path, "w") as f:
+            f.write("\n".join(sorted(values)))
+        os.replace(tmp_path, index_path)
+    except OSError as e:
+        # The index is only an optimization, so carry on if it can't be written
+        logging.debug("Unable to write index {}: {}".format(index_path, e))
+
+
+def scan_log_file(path, start, end, scan, index_path=None):
+    """
+    Read a CloudTrail log file and return only what a scan asks for, so the full records never
+    leave the worker process.  Failed API calls, and events outside of the date range, are ignored.
+
+    If index_path is given, a scan matching on an indexed field first checks the index of the
+    file, and doesn't open the file if it can't contain a match.  The index is written whenever
+    the file has to be read and it doesn't have one.
+
+    scan is a tuple of:
+    - the field holding the value to return for each matching record
+    - the field to match on, or None to match every record
+    - the set of values of that field to match
+    - optionally, a further field and the value it must have
+
+    When the value field is "event", the API call of the record is returned, as an
+    (eventSource, eventName) pair, grouped by the value of the field matched on.
+    """
+    value_field, match_field, match_values = scan[:3]
+    extra_filters = scan[3:]
+
+    if index_path is not None:
+        index = read_index(index_path, path)
+        if index is not None and match_field in INDEXED_FIELDS:
+            if index.isdisjoint(match_values):
+                return {}
+
+    records = read_log_file(path)
+    if index_path is not None and index is None:
+        write_index(index_path, records)
+
+    results = {}
+    for record in records:
+        if "errorCode" in record:
+            continue
+        event_day = record.get("eventTime", "")[:10]
+        if event_day and not start <= event_day <= end:
+            continue
+
+        if match_field is None:
+            key = None
+        else:
+            key = get_field(record, match_field)
+            if key not in match_values:
+                continue
+        if extra_filters and get_field(record, extra_filters[0]) != extra_filters[1]:
+            continue
+
+        if value_field == "event":
+            value = (record.get("eventSource", ""), record.get("eventName", ""))
+        else:
+            value = get_field(record, value_field)
+            if value is None:
+                continue
+        results.setdefault(key, set()).add(value)
+    return results
+
+
+def frame_log_file(path, start, end, principal_field):
+    """
+    Read a CloudTrail log file into an EventFrame of the principals in a field, in a worker
+    process
+    """
+    frame = EventFrame(start)
+    frame.add_records(read_log_file(path), end, principal_field)
+    return frame
+
+
+class LocalFiles(object):
+    """
+    Reads CloudTrail log files directly from a local directory, such as a copy of the S3 bucket
+    CloudTrail delivers to, without needing Athena or ElasticSearch.
+    """
+
+    log_files = None
+    index_paths = None
+    workers = None
+    frames = None
+
+    def __init__(self, config, account, start, end):
+        self.start = start[:10]
+        self.end = end[:10]
+        self.workers = config.get("workers") or os.cpu_count()
+        # The EventFrame read for each field principals are looked up by
+        self.frames = {}
+        root = os.path.expanduser(config["path"])
+
+        self.log_files = find_account_log_files(
+            root,
+            account["id"],
+            self.start,
+            self.end,
+            regions=config.get("regions"),
+            org_id=config.get("org_id"),
+        )
+        logging.info(
+            "Using {} CloudTrail log files from {}".format(
+                len(self.log_files), config["path"]
+            )
+        )
+        if not self.log_files:
+            logging.warning("No CloudTrail log files found for this account and date range")
+
+        # Each log file's index is kept beside it, or in the same place under index_path
+        # when the log files can't be written to
+        if config.get("index", True):
+            index_root = os.path.expanduser(config.get("index_path", root))
+            self.index_paths = [
+                os.path.join(index_root, os.path.relpath(log_file, root))
+                + INDEX_EXTENSION
+                for log_file in self.log_files
+            ]
+        else:
+            self.index_paths = [None] * len(self.log_files)
+
+    def scan(self, scan):
+        """Run a scan over every log file on a pool of processes, and combine the results"""
+        results = {}
+        if not self.log_files:
+            return results
+
+        count = len(self.log_files)
+        with ProcessPoolExecutor(max_workers=self.workers) as executor:
+            file_results = executor.map(
+                scan_log_file,
+                self.log_files,
+                [self.start] * count,
+                [self.end] * count,
+                [scan] * count,
+                self.index_paths,
+                chunksize=FILES_PER_TASK,
+            )
+            for file_result in file_results:
+                for key, values in file_result.items():
+                    results.setdefault(key, set()).update(values)
+        return results
+
+    def get_event_frame(self, principal_field):
+        """
+        Read every log file into one EventFrame of the principals in a field, such as
+        userIdentity.arn, on a pool of processes.  Each worker sends back a frame, which is
+        much smaller to pickle than the events themselves.
+        """
+        if principal_field in self.frames:
+            return self.frames[principal_field]
+
+        frame = EventFrame(self.start)
+        if self.log_files:
+            count = len(self.log_files)
+            with ProcessPoolExecutor(max_workers=self.workers) as executor:
+                for file_frame in executor.map(
+                    frame_log_file,
+                    self.log_files,
+                    [self.start] * count,
+                    [self.end] * count,
+                    [principal_field] * count,
+                    chunksize=FILES_PER_TASK,
+                ):
+                    frame.extend(file_frame)
+            frame.compact()
+        logging.info("Read {} distinct events".format(len(frame)))
+
+        self.frames[principal_field] = frame
+        return frame
+
+    def get_events(self, events):
+        """Convert a set of (eventSource, eventName) pairs to the API calls they represent"""
+        event_names = {}
+        for event_source, event_name in events:
+            service = event_source.split(".")[0]
+            event_names[normalize_api_call(service, event_name)] = True
+        return event_names
+
+    def get_performed_users(self):
+        """
+        Returns the users that performed actions within the search filters
+        """
+        user_names = {}
+        for user_name in self.scan(("userIdentity.userName", None, None)).get(None, []):
+            if user_name == "HIDDEN_DUE_TO_SECURITY_REASONS":
+                # This happens when a user logs in with the wrong username
+                continue
+            user_names[user_name] = True
+        return user_names
+
+    def get_performed_roles(self):
+        """
+        Returns the roles that performed actions within the search filters
+        """
+        role_names = {}
+        field = "userIdentity.sessionContext.sessionIssuer.userName"
+        for role_name in self.scan((field, None, None)).get(None, []):
+            role_names[role_name] = True
+        return role_names
+
+    def get_search_query(self):
+        # Local files don't use this call, but need to support it being called
+        return None
+
+    def get_event_frame_by_arns(self, field, arns):
+        """
+        Return the EventFrame of the principals in a field to look up these ARNs in, or None
+        if there are too few of them to be worth reading every file for
+        """
+        if len(arns) >= FRAME_MIN_PRINCIPALS or field in self.frames:
+            return self.get_event_frame(field)
+        return None
+
+    def get_event_frame_by_users(self, _, users_iam):
+        """For a list of users, return the EventFrame holding their events, or None"""
+        return self.get_event_frame_by_arns(
+            "userIdentity.arn", [user_iam["Arn"] for user_iam in users_iam]
+        )
+
+    def get_event_frame_by_roles(self, _, roles_iam):
+        """For a list of roles, return the EventFrame holding their events, or None"""
+        return self.get_event_frame_by_arns(
+            "userIdentity.sessionContext.sessionIssuer.arn",
+            [role_iam["Arn"] for role_iam in roles_iam],
+        )
+
+    def get_performed_event_names_by_arns(self, field, arns):
+        """Return a dict of each ARN to the events performed where the field has that ARN"""
+        frame = self.get_event_frame_by_arns(field, arns)
+        if frame is not None:
+            return frame.get_performed_event_names_by_principals(arns)
+
+        events_by_arn = self.scan(("event", field, frozenset(arns)))
+        event_names = {}
+        for arn in arns:
+            event_names[arn] = self.get_events(events_by_arn.get(arn, []))
+        return event_names
+
+    def get_performed_event_names_by_user(self, _, user_iam):
+        """For a user, return all performed events"""
+        return self.get_performed_event_names_by_users(None, [user_iam])[
+            user_iam["Arn"]
+        ]
+
+    def get_performed_event_names_by_role(self, _, role_iam):
+        """For a role, return all performed events"""
+        return self.get_performed_event_names_by_roles(None, [role_iam])[
+            role_iam["Arn"]
+        ]
+
+    def get_performed_event_names_by_users(self, _, users_iam):
+        """For a list of users, return a dict of each user's ARN to their performed events"""
+        return self.get_performed_event_names_by_arns(
+            "userIdentity.arn", [user_iam["Arn"] for user_iam in users_iam]
+        )
+
+    def get_performed_event_names_by_roles(self, _, roles_iam):
+        """For a list of roles, return a dict of each role's ARN to their performed events"""
+        return self.get_performed_event_names_by_arns(
+            "userIdentity.sessionContext.sessionIssuer.arn",
+            [role_iam["Arn"] for role_iam in roles_iam],
+        )
+
+    def get_performed_event_names_in_role(self, assumer_field, assumer_arn, role_iam):
+        """
+        For an actor that has assumed into a role, return all performed events.  The session keys
+        of the role assumptions are found first, then the events performed with those keys.
+        """
+        session_keys = self.scan(
+            (
+                "responseElements.credentials.accessKeyId",
+                assumer_field,
+                frozenset([assumer_arn]),
+                "requestParameters.roleArn",
+                role_iam["Arn"],
+            )
+        ).get(assumer_arn, set())
+        if not session_keys:
+            return {}
+
+        events_by_key = self.scan(
+            (
+                "event",
+                "userIdentity.accessKeyId",
+                frozenset(session_keys),
+                "userIdentity.sessionContext.sessionIssuer.arn",
+                role_iam["Arn"],
+            )
+        )
+        event_names = {}
+        for events in events_by_key.values():
+            event_names.update(self.get_events(events))
+        return event_names
+
+    def get_performed_event_names_by_user_in_role(self, _, user_iam, role_iam):
+        """For a user that has assumed into another role, return all performed events"""
+        return self.get_performed_event_names_in_role(
+            "userIdentity.arn", user_iam["Arn"], role_iam
+        )
+
+    def get_performed_event_names_by_role_in_role(self, _, role_iam, dest_role_iam):
+        """For a role that has assumed into another role, return all performed events"""
+        return self.get_performed_event_names_in_role(
+            "userIdentity.sessionContext.sessionIssuer.arn",
+            role_iam["Arn"],
+            dest_role_iam,
+        )
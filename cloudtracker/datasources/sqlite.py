@@ -0,0 +1,284 @@
+"""
+Copyright 2018 Duo Security
+
+Redistribution and use in source and binary forms, with or without modification, are permitted provided that the
+following conditions are met:
+
+1. Redistributions of source code must retain the above copyright notice, this list of conditions and the following
+disclaimer.
+
+2. Redistributions in binary form must reproduce the above copyright notice, this list of conditions and the
+following disclaimer in the documentation and/or other materials provided with the distribution.
+
+3. Neither the name of the copyright holder nor the names of its contributors may be used to endorse or promote
+products derived from this software without specific prior written permission.
+
+THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES,
+INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL,
+SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY,
+WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE
+USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+---------------------------------------------------------------------------
+"""
+
+import datetime
+import logging
+import os
+import sqlite3
+from concurrent.futures import ProcessPoolExecutor
+
+from cloudtracker import normalize_api_call
+from cloudtracker.logfiles import (
+    find_log_files,
+    get_account_id,
+    get_field,
+    read_log_file,
+)
+
+# Number of files handed to a worker process at a time, and ingested per transaction
+FILES_PER_TASK = 16
+FILES_PER_TRANSACTION = 256
+
+# Principals and actions are stored once, and referred to by id from the usage table, which has
+# one row per principal, action and day.  Its primary key leads with the principal and day, so
+# it covers looking up what a principal did within a date range.
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS principals (
+    id INTEGER PRIMARY KEY,
+    type TEXT NOT NULL,
+    arn TEXT NOT NULL,
+    name TEXT NOT NULL,
+    account_id TEXT NOT NULL,
+    UNIQUE (type, arn)
+);
+CREATE INDEX IF NOT EXISTS principals_account ON principals (account_id, type, name, id);
+CREATE TABLE IF NOT EXISTS actions (
+    id INTEGER PRIMARY KEY,
+    event_source TEXT NOT NULL,
+    event_name TEXT NOT NULL,
+    UNIQUE (event_source, event_name)
+);
+CREATE TABLE IF NOT EXISTS usage (
+    principal_id INTEGER NOT NULL,
+    day INTEGER NOT NULL,
+    action_id INTEGER NOT NULL,
+    count INTEGER NOT NULL,
+    PRIMARY KEY (principal_id, day, action_id)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS files (
+    path TEXT PRIMARY KEY,
+    size INTEGER NOT NULL,
+    ingested TEXT NOT NULL
+);
+"""
+
+# For each type of principal, the fields identifying it in a CloudTrail record
+PRINCIPAL_FIELDS = {
+    "user": ("userIdentity.arn", "userIdentity.userName"),
+    "role": (
+        "userIdentity.sessionContext.sessionIssuer.arn",
+        "userIdentity.sessionContext.sessionIssuer.userName",
+    ),
+}
+
+
+def to_day_number(day):
+    """Convert a date string such as 2018-01-21 to the number used to store it"""
+    return datetime.datetime.strptime(day[:10], "%Y-%m-%d").date().toordinal()
+
+
+def count_log_file(path):
+    """
+    Read a CloudTrail log file, and count the successful API calls made by each principal per day.
+    Returns the path and a dict of (type, arn, name, eventSource, eventName, day) to the count.
+    """
+    counts = {}
+    for record in read_log_file(path):
+        if "errorCode" in record or "eventTime" not in record:
+            continue
+        day = to_day_number(record["eventTime"])
+        event_source = record.get("eventSource", "")
+        event_name = record.get("eventName", "")
+        for principal_type, (arn_field, name_field) in PRINCIPAL_FIELDS.items():
+            arn = get_field(record, arn_field)
+            name = get_field(record, name_field)
+            if arn is None or name is None:
+                continue
+            key = (principal_type, arn, name, event_source, event_name, day)
+            counts[key] = counts.get(key, 0) + 1
+    return path, counts
+
+
+class SQLite(object):
+    """
+    Reads CloudTrail usage from a local SQLite database, built from CloudTrail log files with
+    `cloudtracker ingest`.  Answers queries without any calls to AWS.
+    """
+
+    db = None
+    account_id = None
+
+    def __init__(self, config, account, start, end):
+        path = os.path.expanduser(config["path"])
+        if account is not None and not os.path.exists(path):
+            exit(
+                "ERROR: SQLite database {} does not exist. Create it with `cloudtracker ingest`".format(
+                    path
+                )
+            )
+        self.db = sqlite3.connect(path)
+        self.db.executescript(SCHEMA)
+        self.workers = config.get("workers") or os.cpu_count()
+
+        if account is not None:
+            self.account_id = str(account["id"])
+        self.start = to_day_number(start) if start else 0
+        self.end = to_day_number(end) if end else datetime.date.max.toordinal()
+
+    def get_performed_names(self, principal_type):
+        """Returns the names of the users or roles that performed actions within the date range"""
+        rows = self.db.execute(
+            """SELECT DISTINCT name FROM principals p
+            WHERE account_id = ? AND type = ? AND EXISTS (
+                SELECT 1 FROM usage u WHERE u.principal_id = p.id AND u.day BETWEEN ? AND ?
+            )""",
+            (self.account_id, principal_type, self.start, self.end),
+        )
+        return [row[0] for row in rows]
+
+    def get_performed_users(self):
+        """
+        Returns the users that performed actions within the search filters
+        """
+        user_names = {}
+        for user_name in self.get_performed_names("user"):
+            if user_name == "HIDDEN_DUE_TO_SECURITY_REASONS":
+                # This happens when a user logs in with the wrong username
+                continue
+            user_names[user_name] = True
+        return user_names
+
+    def get_performed_roles(self):
+        """
+        Returns the roles that performed actions within the search filters
+        """
+        role_names = {}
+        for role_name in self.get_performed_names("role"):
+            role_names[role_name] = True
+        return role_names
+
+    def get_search_query(self):
+        # SQLite doesn't use this call, but needs to support it being called
+        return None
+
+    def get_performed_event_names_by_arn(self, principal_type, arn):
+        """Return the events performed by a user or role within the date range"""
+        rows = self.db.execute(
+            """SELECT DISTINCT a.event_source, a.event_name
+            FROM principals p
+            JOIN usage u ON u.principal_id = p.id
+            JOIN actions a ON a.id = u.action_id
+            WHERE p.type = ? AND p.arn = ? AND u.day BETWEEN ? AND ?""",
+            (principal_type, arn, self.start, self.end),
+        )
+        event_names = {}
+        for event_source, event_name in rows:
+            service = event_source.split(".")[0]
+            event_names[normalize_api_call(service, event_name)] = True
+        return event_names
+
+    def get_performed_event_names_by_user(self, _, user_iam):
+        """For a user, return all performed events"""
+        return self.get_performed_event_names_by_arn("user", user_iam["Arn"])
+
+    def get_performed_event_names_by_role(self, _, role_iam):
+        """For a role, return all performed events"""
+        return self.get_performed_event_names_by_arn("role", role_iam["Arn"])
+
+    def get_performed_event_names_by_user_in_role(
+        self, searchquery, user_iam, role_iam
+    ):
+        """For a user that has assumed into another role, return all performed events"""
+        # Session keys aren't stored, so role assumptions can't be followed
+        raise Exception("Not implemented")
+
+    def get_performed_event_names_by_role_in_role(
+        self, searchquery, role_iam, dest_role_iam
+    ):
+        """For a role that has assumed into another role, return all performed events"""
+        raise Exception("Not implemented")
+
+    def ingest(self, path):
+        """
+        Add the CloudTrail log files under path that haven't been added before.  Each batch of
+        files is added in one transaction along with its entries in the files table, so an
+        interrupted ingest never counts a file twice.
+        """
+        ingested = set(row[0] for row in self.db.execute("SELECT path FROM files"))
+        log_files = [
+            log_file
+            for log_file in find_log_files(path)
+            if os.path.abspath(log_file) not in ingested
+        ]
+        logging.info("{} new log files to ingest".format(len(log_files)))
+
+        self.db.execute("PRAGMA journal_mode = WAL")
+        self.db.execute("PRAGMA synchronous = NORMAL")
+        principal_ids = {}
+        for row in self.db.execute("SELECT type, arn, id FROM principals"):
+            principal_ids[row[:2]] = row[2]
+        action_ids = {}
+        for row in self.db.execute("SELECT event_source, event_name, id FROM actions"):
+            action_ids[row[:2]] = row[2]
+
+        with ProcessPoolExecutor(max_workers=self.workers) as executor:
+            for start in range(0, len(log_files), FILES_PER_TRANSACTION):
+                batch = log_files[start : start + FILES_PER_TRANSACTION]
+                with self.db:
+                    for log_file, counts in executor.map(
+                        count_log_file, batch, chunksize=FILES_PER_TASK
+                    ):
+                        self.add_counts(counts, principal_ids, action_ids)
+                        self.db.execute(
+                            "INSERT INTO files (path, size, ingested) VALUES (?, ?, ?)",
+                            (
+                                os.path.abspath(log_file),
+                                os.path.getsize(log_file),
+                                datetime.datetime.utcnow().isoformat(),
+                            ),
+                        )
+                logging.info(
+                    "Ingested {} of {} log files".format(
+                        start + len(batch), len(log_files)
+                    )
+                )
+
+    def add_counts(self, counts, principal_ids, action_ids):
+        """Add the counts from a log file to the usage table, creating principals and actions as needed"""
+        rows = []
+        for (principal_type, arn, name, event_source, event_name, day), count in counts.items():
+            principal_id = principal_ids.get((principal_type, arn))
+            if principal_id is None:
+                principal_id = self.db.execute(
+                    "INSERT INTO principals (type, arn, name, account_id) VALUES (?, ?, ?, ?)",
+                    (principal_type, arn, name, get_account_id(arn)),
+                ).lastrowid
+                principal_ids[(principal_type, arn)] = principal_id
+
+            action_id = action_ids.get((event_source, event_name))
+            if action_id is None:
+                action_id = self.db.execute(
+                    "INSERT INTO actions (event_source, event_name) VALUES (?, ?)",
+                    (event_source, event_name),
+                ).lastrowid
+                action_ids[(event_source, event_name)] = action_id
+
+            rows.append((principal_id, day, action_id, count))
+
+        self.db.executemany(
+            """INSERT INTO usage (principal_id, day, action_id, count) VALUES (?, ?, ?, ?)
+            ON CONFLICT (principal_id, day, action_id) DO UPDATE SET count = count + excluded.count""",
+            rows,
+        )
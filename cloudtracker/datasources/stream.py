@@ -0,0 +1,123 @@
+"""
+Copyright 2018 Duo Security
+
+Redistribution and use in source and binary forms, with or without modification, are permitted provided that the
+following conditions are met:
+
+1. Redistributions of source code must retain the above copyright notice, this list of conditions and the following
+disclaimer.
+
+2. Redistributions in binary form must reproduce the above copyright notice, this list of conditions and the
+following disclaimer in the documentation and/or other materials provided with the distribution.
+
+3. Neither the name of the copyright holder nor the names of its contributors may be used to endorse or promote
+products derived from this software without specific prior written permission.
+
+THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES,
+INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL,
+SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY,
+WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE
+USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+---------------------------------------------------------------------------
+"""
+
+import logging
+import os
+
+from cloudtracker.logfiles import get_account_id
+from cloudtracker.stream import UsageTracker, was_used
+
+
+class Stream(object):
+    """
+    Reads the API calls of each principal from the state kept by `cloudtracker stream`, so
+    queries are answered from memory without re-reading any CloudTrail logs.
+
+    The days each API call was seen are kept, so any date range is answered exactly.  State
+    saved by older versions only has the first and last day, and a call is then reported as
+    used if those days overlap the date range.
+    """
+
+    tracker = None
+    account_id = None
+
+    def __init__(self, config, account, start, end):
+        path = os.path.expanduser(config["state"])
+        if not os.path.exists(path):
+            exit(
+                "ERROR: Stream state {} does not exist. Create it with `cloudtracker stream`".format(
+                    path
+                )
+            )
+        self.tracker = UsageTracker.load(path)
+        logging.info(
+            "Using the stream state from {} records".format(self.tracker.record_count)
+        )
+        self.account_id = str(account["id"])
+        self.start = start[:10]
+        self.end = end[:10]
+
+    def was_used(self, seen):
+        """Given the days an API call was seen, return True if it was used in the date range"""
+        return was_used(seen, self.start, self.end)
+
+    def get_performed_names(self, principal_type):
+        """Returns the names of the users or roles of the account that were active in the date range"""
+        names = {}
+        for arn, principal in self.tracker.principals[principal_type].items():
+            if get_account_id(arn) != self.account_id:
+                continue
+            if any(self.was_used(seen) for seen in principal["actions"].values()):
+                names[principal["name"]] = True
+        return names
+
+    def get_performed_users(self):
+        """
+        Returns the users that performed actions within the search filters
+        """
+        user_names = self.get_performed_names("users")
+        # This happens when a user logs in with the wrong username
+        user_names.pop("HIDDEN_DUE_TO_SECURITY_REASONS", None)
+        return user_names
+
+    def get_performed_roles(self):
+        """
+        Returns the roles that performed actions within the search filters
+        """
+        return self.get_performed_names("roles")
+
+    def get_search_query(self):
+        # The stream state doesn't use this call, but needs to support it being called
+        return None
+
+    def get_performed_event_names(self, principal_type, arn):
+        """Return the API calls a user or role made in the date range"""
+        principal = self.tracker.principals[principal_type].get(arn, {"actions": {}})
+        event_names = {}
+        for action, seen in principal["actions"].items():
+            if self.was_used(seen):
+                event_names[action] = True
+        return event_names
+
+    def get_performed_event_names_by_user(self, _, user_iam):
+        """For a user, return all performed events"""
+        return self.get_performed_event_names("users", user_iam["Arn"])
+
+    def get_performed_event_names_by_role(self, _, role_iam):
+        """For a role, return all performed events"""
+        return self.get_performed_event_names("roles", role_iam["Arn"])
+
+    def get_performed_event_names_by_user_in_role(
+        self, searchquery, user_iam, role_iam
+    ):
+        """For a user that has assumed into another role, return all performed events"""
+        # Session keys aren't tracked, so role assumptions can't be followed
+        raise Exception("Not implemented")
+
+    def get_performed_event_names_by_role_in_role(
+        self, searchquery, role_iam, dest_role_iam
+    ):
+        """For a role that has assumed into another role, return all performed events"""
+        raise Exception("Not implemented")
@@ -0,0 +1,235 @@
+"""
+Copyright 2018 Duo Security
+
+Redistribution and use in source and binary forms, with or without modification, are permitted provided that the
+following conditions are met:
+
+1. Redistributions of source code must retain the above copyright notice, this list of conditions and the following
+disclaimer.
+
+2. Redistributions in binary form must reproduce the above copyright notice, this list of conditions and the
+following disclaimer in the documentation and/or other materials provided with the distribution.
+
+3. Neither the name of the copyright holder nor the names of its contributors may be used to endorse or promote
+products derived from this software without specific prior written permission.
+
+THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES,
+INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL,
+SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY,
+WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE
+USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+---------------------------------------------------------------------------
+"""
+
+
+import datetime
+from array import array
+
+from cloudtracker import normalize_api_call
+from cloudtracker.logfiles import get_field
+
+# Days are stored as unsigned 16 bit offsets from the base day, so can be up to this many
+# days after it
+MAX_DAY_OFFSET = 2 ** 16 - 1
+
+
+class StringDictionary(object):
+    """Gives each distinct string a small integer code, so columns can store the codes"""
+
+    strings = None
+    codes = None
+
+    def __init__(self, strings=()):
+        self.strings = []
+        self.codes = {}
+        for string in strings:
+            self.encode(string)
+
+    def __len__(self):
+        return len(self.strings)
+
+    def encode(self, string):
+        """Return the code of a string, giving it the next code if it is new"""
+        code = self.codes.get(string)
+        if code is None:
+            code = len(self.strings)
+            self.codes[string] = code
+            self.strings.append(string)
+        return code
+
+    def decode(self, code):
+        """Return the string with the given code"""
+        return self.strings[code]
+
+    def __getstate__(self):
+        # The codes are rebuilt from the strings, to keep pickles small
+        return self.strings
+
+    def __setstate__(self, strings):
+        self.strings = []
+        self.codes = {}
+        for string in strings:
+            self.encode(string)
+
+
+class EventFrame(object):
+    """
+    The number of times principals performed API calls, by region and day, held as columns of
+    typed arrays of integer codes rather than a Python object per event.  Principals (ARNs),
+    API calls and regions are coded with a StringDictionary each, and days are stored as the
+    number of days since base_day, which no event can be before.  The same principal, API
+    call, region and day may appear on more than one row until compact is called.
+    """
+
+    base_day = None
+
+    def __init__(self, base_day):
+        self.base_day = base_day
+        self.base_ordinal = datetime.date(*map(int, base_day.split("-"))).toordinal()
+
+        self.principals = StringDictionary()
+        self.actions = StringDictionary()
+        self.regions = StringDictionary()
+
+        self.principal_codes = array("I")
+        self.action_codes = array("I")
+        self.region_codes = array("H")
+        self.day_offsets = array("H")
+        self.counts = array("I")
+
+    def __len__(self):
+        return len(self.counts)
+
+    def get_day_offset(self, day):
+        """
+        Return the number of days a YYYY-MM-DD day is after the base day, raising ValueError
+        if it is before the base day, or too long after it to store
+        """
+        offset = datetime.date(*map(int, day[:10].split("-"))).toordinal() - self.base_ordinal
+        if not 0 <= offset <= MAX_DAY_OFFSET:
+            raise ValueError(
+                "Day {} is outside of the frame starting {}".format(day[:10], self.base_day)
+            )
+        return offset
+
+    def add(self, principal, action, region, day, count=1):
+        """Add a count of the times a principal performed an API call, in a region on a day"""
+        day_offset = self.get_day_offset(day)
+        self.principal_codes.append(self.principals.encode(principal))
+        self.action_codes.append(self.actions.encode(action))
+        self.region_codes.append(self.regions.encode(region))
+        self.day_offsets.append(day_offset)
+        self.counts.append(count)
+
+    def add_records(self, records, end_day=None, principal_field=None):
+        """
+        Add the successful API calls of CloudTrail records from the base day up to end_day.
+        The principal of a call is the value of principal_field, such as userIdentity.arn,
+        or when that isn't given, the role for assumed roles, and the user or other identity
+        otherwise.
+        """
+        totals = {}
+        for record in records:
+            if "errorCode" in record:
+                continue
+            day = record.get("eventTime", "")[:10]
+            if not day or day < self.base_day or (end_day and day > end_day):
+                continue
+            if principal_field is not None:
+                principal = get_field(record, principal_field)
+            else:
+                identity = record.get("userIdentity") or {}
+                principal = (
+                    (identity.get("sessionContext") or {}).get("sessionIssuer") or {}
+                ).get("arn") or identity.get("arn")
+            if not principal:
+                continue
+            action = normalize_api_call(
+                record.get("eventSource", "").split(".")[0], record.get("eventName", "")
+            )
+            key = (
+                principal,
+                action,
+                record.get("awsRegion", ""),
+                day,
+            )
+            totals[key] = totals.get(key, 0) + 1
+
+        for (principal, action, region, day), count in totals.items():
+            self.add(principal, action, region, day, count)
+
+    def extend(self, other):
+        """Add the rows of another frame, converting its codes to this frame's"""
+        principal_map = [self.principals.encode(s) for s in other.principals.strings]
+        action_map = [self.actions.encode(s) for s in other.actions.strings]
+        region_map = [self.regions.encode(s) for s in other.regions.strings]
+        day_shift = other.base_ordinal - self.base_ordinal
+        if other.day_offsets and not (
+            0 <= min(other.day_offsets) + day_shift
+            and max(other.day_offsets) + day_shift <= MAX_DAY_OFFSET
+        ):
+            raise ValueError(
+                "The frame starting {} has days outside of the frame starting {}".format(
+                    other.base_day, self.base_day
+                )
+            )
+
+        self.principal_codes.extend(principal_map[c] for c in other.principal_codes)
+        self.action_codes.extend(action_map[c] for c in other.action_codes)
+        self.region_codes.extend(region_map[c] for c in other.region_codes)
+        self.day_offsets.extend(d + day_shift for d in other.day_offsets)
+        self.counts.extend(other.counts)
+
+    def compact(self):
+        """Combine the rows of the same principal, API call, region and day"""
+        totals = {}
+        keys = zip(
+            self.principal_codes, self.action_codes, self.region_codes, self.day_offsets
+        )
+        for key, count in zip(keys, self.counts):
+            totals[key] = totals.get(key, 0) + count
+
+        self.principal_codes = array("I", (key[0] for key in totals))
+        self.action_codes = array("I", (key[1] for key in totals))
+        self.region_codes = array("H", (key[2] for key in totals))
+        self.day_offsets = array("H", (key[3] for key in totals))
+        self.counts = array("I", totals.values())
+
+    def get_principal_codes(self, principals):
+        """Return the codes of those of the principals in the frame"""
+        return {
+            self.principals.codes[principal]
+            for principal in principals
+            if principal in self.principals.codes
+        }
+
+    def get_performed_event_names_by_principals(self, principals):
+        """
+        Return a dict of each principal to the API calls it performed, in the form the
+        datasources return them: {arn: {"service:action": True}}
+        """
+        wanted = self.get_principal_codes(principals)
+        performed = {}
+        for principal_code, action_code in zip(self.principal_codes, self.action_codes):
+            if principal_code in wanted:
+                performed.setdefault(principal_code, set()).add(action_code)
+
+        event_names = {}
+        for principal in principals:
+            action_codes = performed.get(self.principals.codes.get(principal), ())
+            event_names[principal] = {
+                self.actions.decode(action_code): True for action_code in action_codes
+            }
+        return event_names
+
+    def get_action_counts(self, principal):
+        """Return the number of times a principal performed each API call"""
+        principal_code = self.principals.codes.get(principal)
+        counts = {}
+        for row, code in enumerate(self.principal_codes):
+            if code == principal_code:
+                action = self.actions.decode(self.action_codes[row])
+                counts[action] = counts.get(action, 0) + self.counts[row]
+        return counts
@@ -0,0 +1,304 @@
+"""
+Copyright 2018 Duo Security
+
+Redistribution and use in source and binary forms, with or without modification, are permitted provided that the
+following conditions are met:
+
+1. Redistributions of source code must retain the above copyright notice, this list of conditions and the following
+disclaimer.
+
+2. Redistributions in binary form must reproduce the above copyright notice, this list of conditions and the
+following disclaimer in the documentation and/or other materials provided with the distribution.
+
+3. Neither the name of the copyright holder nor the names of its contributors may be used to endorse or promote
+products derived from this software without specific prior written permission.
+
+THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES,
+INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL,
+SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY,
+WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE
+USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+---------------------------------------------------------------------------
+"""
+
+import json
+import logging
+import os
+import random
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+from elasticsearch import ConnectionError, TransportError
+
+from cloudtracker.logfiles import find_log_files, prepare_record, read_log_file
+
+# Number of documents per _bulk request to start with, and the limits it adapts between
+BATCH_SIZE = 500
+MIN_BATCH_SIZE = 50
+MAX_BATCH_SIZE = 10000
+
+# ElasticSearch rejects requests over http.max_content_length (100MB by default)
+MAX_BATCH_BYTES = 10 * 1024 * 1024
+
+# How many times to retry a batch that was rejected or couldn't be sent, and the backoff between tries
+MAX_RETRIES = 10
+BACKOFF_SECONDS = 1
+MAX_BACKOFF_SECONDS = 60
+
+
+def get_bulk_lines(path, index, doc_type, key_prefix):
+    """
+    Read a CloudTrail log file and return the _bulk request lines for each of its records.
+    This runs in the worker processes, so decompressing, parsing and serializing is spread
+    over all the cores.
+    """
+    lines = []
+    for record in read_log_file(path):
+        record = prepare_record(record)
+        action = {"index": {"_index": index, "_type": doc_type}}
+        if "eventID" in record:
+            # Using the eventID makes loading a file twice, such as after resuming, harmless
+            action["index"]["_id"] = record["eventID"]
+        if key_prefix:
+            record = {key_prefix: record}
+        lines.append(json.dumps(action) + "\n" + json.dumps(record) + "\n")
+    return path, lines
+
+
+class AdaptiveBatchSize(object):
+    """
+    The number of documents to send per _bulk request, shared by all the senders.  It grows
+    while requests succeed, and is halved whenever ElasticSearch pushes back.
+    """
+
+    def __init__(self, size=BATCH_SIZE):
+        self.size = size
+        self.lock = threading.Lock()
+
+    def grow(self):
+        with self.lock:
+            self.size = min(MAX_BATCH_SIZE, int(self.size * 1.25) + 1)
+
+    def shrink(self):
+        with self.lock:
+            self.size = max(MIN_BATCH_SIZE, self.size // 2)
+
+
+class Checkpoint(object):
+    """
+    The log files that have been completely loaded, so an interrupted load can resume.
+    A file with a document that failed to index isn't recorded, so it is loaded again.
+    Each completed file is appended as a line, identified by its path, size and modification time.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.completed = set()
+        self.lock = threading.Lock()
+        if os.path.exists(path):
+            with open(path) as f:
+                for line in f:
+                    self.completed.add(line.rstrip("\n"))
+
+    def get_key(self, log_file):
+        stat = os.stat(log_file)
+        return "{}\t{}\t{}".format(os.path.abspath(log_file), stat.st_size, int(stat.st_mtime))
+
+    def is_completed(self, log_file):
+        return self.get_key(log_file) in self.completed
+
+    def mark_completed(self, log_file):
+        key = self.get_key(log_file)
+        with self.lock:
+            self.completed.add(key)
+            with open(self.path, "a") as f:
+                f.write(key + "\n")
+
+
+class BulkIngester(object):
+    """
+    Loads CloudTrail log files into ElasticSearch.  Files are decoded on a pool of processes,
+    and the documents are sent as _bulk requests over several connections at once.
+    """
+
+    def __init__(
+        self, es, index, doc_type, key_prefix, checkpoint, workers=None, connections=4
+    ):
+        self.es = es
+        self.index = index
+        self.doc_type = doc_type
+        self.key_prefix = key_prefix
+        self.checkpoint = checkpoint
+        self.workers = workers or os.cpu_count()
+        self.connections = connections
+        self.batch_size = AdaptiveBatchSize()
+
+        # For each log file, the number of its documents not yet sent, whether all of them
+        # have been read, and whether any of them failed to index
+        self.pending = {}
+        self.fully_read = set()
+        self.failed_files = set()
+        self.lock = threading.Lock()
+
+        self.indexed_count = 0
+        self.failed_count = 0
+
+    def ingest(self, path):
+        """Load all the log files under path that haven't already been loaded"""
+        log_files = [
+            log_file
+            for log_file in find_log_files(path)
+            if not self.checkpoint.is_completed(log_file)
+        ]
+        logging.info("{} log files to load".format(len(log_files)))
+
+        # Limit the batches waiting to be sent, so reading files stalls while ElasticSearch is busy
+        send_slots = threading.BoundedSemaphore(self.connections * 2)
+        send_futures = []
+
+        def submit(batch):
+            send_slots.acquire()
+            future = send_pool.submit(self.send_batch, batch)
+            future.add_done_callback(lambda _: send_slots.release())
+            send_futures.append(future)
+
+        with ProcessPoolExecutor(max_workers=self.workers) as read_pool, ThreadPoolExecutor(
+            max_workers=self.connections
+        ) as send_pool:
+            batch = []
+            batch_bytes = 0
+            read_count = 0
+
+            # Submit files to the worker processes a window at a time, to bound memory use
+            window = self.workers * 4
+            for start in range(0, len(log_files), window):
+                results = read_pool.map(
+                    get_bulk_lines,
+                    log_files[start : start + window],
+                    [self.index] * window,
+                    [self.doc_type] * window,
+                    [self.key_prefix] * window,
+                )
+                for log_file, lines in results:
+                    with self.lock:
+                        self.pending[log_file] = len(lines)
+                    for line in lines:
+                        batch.append((log_file, line))
+                        batch_bytes += len(line)
+                        if (
+                            len(batch) >= self.batch_size.size
+                            or batch_bytes >= MAX_BATCH_BYTES
+                        ):
+                            submit(batch)
+                            batch = []
+                            batch_bytes = 0
+                    self.finish_reading(log_file)
+
+                    read_count += 1
+                    if read_count % 1000 == 0:
+                        logging.info(
+                            "{} of {} log files read".format(read_count, len(log_files))
+                        )
+
+            if batch:
+                submit(batch)
+
+            for future in send_futures:
+                future.result()
+
+        logging.info(
+            "Indexed {} documents, {} failed".format(
+                self.indexed_count, self.failed_count
+            )
+        )
+        if self.failed_files:
+            logging.warning(
+                "{} documents failed to index, so {} log files were not recorded as loaded "
+                "and will be loaded again on the next run".format(
+                    self.failed_count, len(self.failed_files)
+                )
+            )
+
+    def finish_reading(self, log_file):
+        """Record all the documents of a file have been read, and check if it is complete"""
+        with self.lock:
+            self.fully_read.add(log_file)
+            completed = (
+                self.pending[log_file] == 0 and log_file not in self.failed_files
+            )
+        if completed:
+            self.checkpoint.mark_completed(log_file)
+
+    def finish_sending(self, batch):
+        """Record the documents in a batch have been sent, and checkpoint any files now complete"""
+        completed = []
+        with self.lock:
+            for log_file, _ in batch:
+                self.pending[log_file] -= 1
+                if (
+                    self.pending[log_file] == 0
+                    and log_file in self.fully_read
+                    and log_file not in self.failed_files
+                ):
+                    completed.append(log_file)
+        for log_file in completed:
+            self.checkpoint.mark_completed(log_file)
+
+    def send_batch(self, batch):
+        """
+        Send a batch of documents in a _bulk request.  Documents rejected because the cluster
+        is overloaded (429) are retried after a jittered backoff, and the batch size is reduced.
+        Documents that fail otherwise are counted, and keep their files from being checkpointed.
+        """
+        remaining = batch
+        for attempt in range(MAX_RETRIES + 1):
+            if attempt > 0:
+                backoff = min(MAX_BACKOFF_SECONDS, BACKOFF_SECONDS * 2 ** attempt)
+                time.sleep(random.uniform(backoff / 2, backoff))
+
+            try:
+                response = self.es.bulk(body="".join(line for _, line in remaining))
+            except TransportError as e:
+                if e.status_code != 429 and not isinstance(e, ConnectionError):
+                    raise
+                logging.debug("Bulk request rejected, retrying: {}".format(e))
+                self.batch_size.shrink()
+                continue
+
+            rejected = []
+            failed = []
+            for item, document in zip(response["items"], remaining):
+                result = list(item.values())[0]
+                status = result.get("status", 200)
+                if status == 429:
+                    rejected.append(document)
+                elif status >= 300:
+                    # Most likely bad input, which would fail again, so it isn't retried
+                    failed.append((document[0], result.get("error")))
+
+            if failed:
+                logging.warning(
+                    "Failed to index {} documents, such as one from {}: {}".format(
+                        len(failed), *failed[0]
+                    )
+                )
+            with self.lock:
+                self.indexed_count += len(remaining) - len(rejected) - len(failed)
+                self.failed_count += len(failed)
+                self.failed_files.update(log_file for log_file, _ in failed)
+            if not rejected:
+                self.batch_size.grow()
+                self.finish_sending(batch)
+                return
+
+            self.batch_size.shrink()
+            remaining = rejected
+
+        raise Exception(
+            "Giving up on {} documents after {} retries".format(
+                len(remaining), MAX_RETRIES
+            )
+        )
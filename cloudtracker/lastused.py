@@ -0,0 +1,181 @@
+"""
+Copyright 2018 Duo Security
+
+Redistribution and use in source and binary forms, with or without modification, are permitted provided that the
+following conditions are met:
+
+1. Redistributions of source code must retain the above copyright notice, this list of conditions and the following
+disclaimer.
+
+2. Redistributions in binary form must reproduce the above copyright notice, this list of conditions and the
+following disclaimer in the documentation and/or other materials provided with the distribution.
+
+3. Neither the name of the copyright holder nor the names of its contributors may be used to endorse or promote
+products derived from this software without specific prior written permission.
+
+THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES,
+INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL,
+SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY,
+WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE
+USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+---------------------------------------------------------------------------
+
+An index of when each user and role last used each API call, which doesn't depend on the date
+range asked about.  It is built with one grouped query of the datasource, kept in the cache
+directory, and extended with only the days not already covered, so that asking whether
+privileges were unused for 90 days, and then for 180 days, costs a single scan.
+"""
+
+import datetime
+
+from cloudtracker.cache import load_json, save_json
+from cloudtracker.stream import get_action
+
+PRINCIPAL_TYPES = ("users", "roles")
+
+
+def get_day(date):
+    """Return the day of a date or timestamp string, no later than today"""
+    return min(date[:10], datetime.date.today().isoformat())
+
+
+class LastUsedIndex(object):
+    """
+    For each user and role, the first and last time each API call was seen, over the days
+    from `start` through `end`.  Whether an API call was used in a date range within those
+    days can be told from these, unless the range falls between the first and last time.
+    """
+
+    def __init__(self, state=None):
+        state = state or {}
+        self.start = state.get("start")
+        self.end = state.get("end")
+        self.principals = {
+            principal_type: state.get(principal_type, {})
+            for principal_type in PRINCIPAL_TYPES
+        }
+
+    @classmethod
+    def load(cls, path):
+        """Load the index saved by a previous run, or start empty"""
+        return cls(load_json(path, {}))
+
+    def save(self, path):
+        state = dict(self.principals)
+        state["start"] = self.start
+        state["end"] = self.end
+        save_json(path, state)
+
+    def add(
+        self, principal_type, arn, name, event_source, event_name, first_seen, last_seen
+    ):
+        """Add when a principal first and last made an API call"""
+        principal = self.principals[principal_type].get(arn)
+        if principal is None:
+            principal = {"name": name, "actions": {}}
+            self.principals[principal_type][arn] = principal
+
+        action = get_action(event_source, event_name)
+        seen = principal["actions"].get(action)
+        if seen is None:
+            principal["actions"][action] = [first_seen, last_seen]
+        else:
+            seen[0] = min(seen[0], first_seen)
+            seen[1] = max(seen[1], last_seen)
+
+    def covers(self, start, end):
+        """Returns True if the index covers every day from start through end"""
+        if self.start is None:
+            return False
+        return self.start <= get_day(start) and get_day(end) <= self.end
+
+    def get_missing_days(self, start, end):
+        """Return the ranges of days from start through end that the index doesn't cover"""
+        start, end = get_day(start), get_day(end)
+        if self.start is None:
+            return [(start, end)]
+
+        missing = []
+        if start < self.start:
+            day_before = datetime.datetime.strptime(
+                self.start, "%Y-%m-%d"
+            ) - datetime.timedelta(days=1)
+            missing.append((start, day_before.date().isoformat()))
+        if end > self.end:
+            # The last day covered may not have been over when it was added
+            missing.append((self.end, end))
+        return missing
+
+    def update(self, get_rows, start, end):
+        """
+        Extend the index to cover start through end.  get_rows(first_day, last_day) returns
+        the rows of (principal type, ARN, name, eventSource, eventName, first seen, last seen)
+        for the days the index doesn't cover yet.  Returns True if the index changed.
+        """
+        missing = self.get_missing_days(start, end)
+        for first_day, last_day in missing:
+            for row in get_rows(first_day, last_day):
+                self.add(*row)
+            self.start = min(self.start or first_day, first_day)
+            self.end = max(self.end or last_day, last_day)
+        return len(missing) > 0
+
+    def was_used(self, seen, start, end):
+        """
+        Given the first and last time an API call was seen, return True if it was used from
+        start through end, False if it wasn't, or None if that can't be told
+        """
+        first_day, last_day = seen[0][:10], seen[1][:10]
+        if start <= first_day <= end or start <= last_day <= end:
+            return True
+        if last_day < start or first_day > end:
+            return False
+        # It was seen before and after the date range, but maybe not during it
+        return None
+
+    def get_event_names(self, principal_type, arn, start, end):
+        """
+        Return the API calls a user or role made from start through end, or None if the
+        index can't tell
+        """
+        if not self.covers(start, end):
+            return None
+        start, end = get_day(start), get_day(end)
+
+        principal = self.principals[principal_type].get(arn, {"actions": {}})
+        event_names = {}
+        for action, seen in principal["actions"].items():
+            used = self.was_used(seen, start, end)
+            if used is None:
+                return None
+            if used:
+                event_names[action] = True
+        return event_names
+
+    def get_names(self, principal_type, start, end):
+        """
+        Return the names of the users or roles that were active from start through end, or
+        None if the index can't tell
+        """
+        if not self.covers(start, end):
+            return None
+        start, end = get_day(start), get_day(end)
+
+        names = {}
+        for principal in self.principals[principal_type].values():
+            used = [
+                self.was_used(seen, start, end) for seen in principal["actions"].values()
+            ]
+            if any(used):
+                if principal["name"]:
+                    names[principal["name"]] = True
+            elif None in used:
+                return None
+        return names
+
+    def get_last_used(self, principal_type, arn):
+        """Return the last time a user or role made each API call, by API call"""
+        principal = self.principals[principal_type].get(arn, {"actions": {}})
+        return {action: seen[1] for action, seen in principal["actions"].items()}
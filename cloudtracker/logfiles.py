@@ -0,0 +1,135 @@
+"""
+Copyright 2018 Duo Security
+
+Redistribution and use in source and binary forms, with or without modification, are permitted provided that the
+following conditions are met:
+
+1. Redistributions of source code must retain the above copyright notice, this list of conditions and the following
+disclaimer.
+
+2. Redistributions in binary form must reproduce the above copyright notice, this list of conditions and the
+following disclaimer in the documentation and/or other materials provided with the distribution.
+
+3. Neither the name of the copyright holder nor the names of its contributors may be used to endorse or promote
+products derived from this software without specific prior written permission.
+
+THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES,
+INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL,
+SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY,
+WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE
+USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+---------------------------------------------------------------------------
+"""
+
+import gzip
+import json
+import os
+
+# Extensions of the files CloudTrail delivers, and of uncompressed copies of them
+LOG_FILE_EXTENSIONS = (".json.gz", ".json")
+
+
+def find_log_files(path):
+    """Return the paths of all the CloudTrail log files under a directory, in sorted order"""
+    if os.path.isfile(path):
+        return [path]
+
+    log_files = []
+    for dirpath, dirnames, filenames in os.walk(path):
+        dirnames.sort()
+        for filename in sorted(filenames):
+            if filename.endswith(LOG_FILE_EXTENSIONS):
+                log_files.append(os.path.join(dirpath, filename))
+    return log_files
+
+
+def read_log_file(path):
+    """Return the records in a CloudTrail log file"""
+    if path.endswith(".gz"):
+        with gzip.open(path, "rb") as f:
+            data = f.read()
+    else:
+        with open(path, "rb") as f:
+            data = f.read()
+    return json.loads(data.decode("utf-8")).get("Records", [])
+
+
+def prepare_record(record):
+    """
+    Remove the values from a record that can't be indexed.  responseElements.endpoint is
+    an object for some API calls and a string for others, which ElasticSearch can't handle,
+    and it is of little use, so it is dropped.
+    """
+    response_elements = record.get("responseElements")
+    if isinstance(response_elements, dict):
+        response_elements.pop("endpoint", None)
+    return record
+
+
+def find_account_log_files(root, account_id, start, end, regions=None, org_id=None):
+    """
+    Return the paths of the CloudTrail log files for an account, within a date range, in a
+    directory laid out as CloudTrail delivers to S3:
+    AWSLogs/[org_id/]<account_id>/CloudTrail/<region>/<yyyy>/<mm>/<dd>/
+    Directories outside the date range, or for regions not in the list given, are skipped
+    without being read.
+    """
+    account_dir = os.path.join(root, "AWSLogs")
+    if org_id:
+        account_dir = os.path.join(account_dir, org_id)
+    account_dir = os.path.join(account_dir, str(account_id), "CloudTrail")
+    if not os.path.isdir(account_dir):
+        return []
+
+    start = start.replace("-", "")[:8]
+    end = end.replace("-", "")[:8]
+
+    log_files = []
+    for region in sorted(os.listdir(account_dir)):
+        if regions and region not in regions:
+            continue
+        region_dir = os.path.join(account_dir, region)
+        for year in list_numbered_dirs(region_dir):
+            if not start[:4] <= year <= end[:4]:
+                continue
+            year_dir = os.path.join(region_dir, year)
+            for month in list_numbered_dirs(year_dir):
+                if not start[:6] <= year + month <= end[:6]:
+                    continue
+                month_dir = os.path.join(year_dir, month)
+                for day in list_numbered_dirs(month_dir):
+                    if not start <= year + month + day <= end:
+                        continue
+                    log_files.extend(find_log_files(os.path.join(month_dir, day)))
+    return log_files
+
+
+def list_numbered_dirs(path):
+    """Return the sorted names of the directories in path that are numbers, such as years and days"""
+    if not os.path.isdir(path):
+        return []
+    return sorted(
+        name
+        for name in os.listdir(path)
+        if name.isdigit() and os.path.isdir(os.path.join(path, name))
+    )
+
+
+def get_field(record, field):
+    """Return the value of a dotted field name such as userIdentity.arn from a record, or None"""
+    value = record
+    for name in field.split("."):
+        if not isinstance(value, dict):
+            return None
+        value = value.get(name)
+    return value
+
+
+def get_account_id(arn):
+    """Return the account id from an ARN such as arn:aws:iam::111111111111:user/alice"""
+    parts = arn.split(":")
+    if len(parts) > 4:
+        return parts[4]
+    return ""
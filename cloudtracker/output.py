@@ -0,0 +1,157 @@
+"""
+Copyright 2018 Duo Security
+
+Redistribution and use in source and binary forms, with or without modification, are permitted provided that the
+following conditions are met:
+
+1. Redistributions of source code must retain the above copyright notice, this list of conditions and the following
+disclaimer.
+
+2. Redistributions in binary form must reproduce the above copyright notice, this list of conditions and the
+following disclaimer in the documentation and/or other materials provided with the distribution.
+
+3. Neither the name of the copyright holder nor the names of its contributors may be used to endorse or promote
+products derived from this software without specific prior written permission.
+
+THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES,
+INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL,
+SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY,
+WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE
+USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+---------------------------------------------------------------------------
+"""
+
+
+import abc
+import csv
+import json
+import threading
+
+from cloudtracker import Classification, is_action_shown
+from cloudtracker.profiling import profiler
+
+# Output formats other than the default colored text
+FORMATS = ("json", "ndjson", "csv")
+
+# The fields of each record written
+FIELDS = (
+    "account",
+    "principal",
+    "assumed_role",
+    "kind",
+    "name",
+    "classification",
+    "code",
+    "symbol",
+)
+
+# The symbol of each Classification in the text output
+SYMBOLS = {
+    Classification.PERFORMED_AND_ALLOWED: " ",
+    Classification.PERFORMED_BUT_NOT_ALLOWED: "+",
+    Classification.ALLOWED_BUT_NOT_PERFORMED: "-",
+    Classification.ALLOWED_BUT_NOT_KNOWN_IF_PERFORMED: "?",
+}
+
+
+class DiffWriter(abc.ABC):
+    """
+    Writes the diffs of actors and actions as records, one at a time as they are found,
+    rather than as colored text.  Writes from many threads, such as for many accounts at
+    once, are not interleaved.  Subclasses format the records, by implementing write_record.
+    """
+
+    def __init__(self, f):
+        self.f = f
+        self.lock = threading.Lock()
+
+    def write_actors(self, account, actors):
+        """Write the Classification of each actor in an account, as print_actor_diff shows them"""
+        with self.lock, profiler.span("write_records"):
+            for actor in sorted(actors):
+                if actors[actor] == Classification.PERFORMED_BUT_NOT_ALLOWED:
+                    # Don't show users that existed but have since been deleted
+                    continue
+                self.write_record(
+                    get_record(account, None, None, "actor", actor, actors[actor])
+                )
+
+    def write_actions(self, account, principal, actions, printfilter, assumed_role=None):
+        """Write the Classification of each action of a principal, as print_diff shows them"""
+        with self.lock, profiler.span("write_records"):
+            for action in sorted(actions):
+                if not is_action_shown(action, actions[action], printfilter):
+                    continue
+                self.write_record(
+                    get_record(
+                        account, principal, assumed_role, "action", action, actions[action]
+                    )
+                )
+
+    @abc.abstractmethod
+    def write_record(self, record):
+        """Write one record, holding the FIELDS"""
+
+    def close(self):
+        """Finish the output"""
+        self.f.flush()
+
+
+class NdjsonWriter(DiffWriter):
+    """Writes each record as a line of JSON"""
+
+    def write_record(self, record):
+        self.f.write(json.dumps(record))
+        self.f.write("\n")
+
+
+class JsonWriter(DiffWriter):
+    """Writes the records as a JSON array, one record to a line"""
+
+    started = False
+
+    def write_record(self, record):
+        self.f.write(",\n" if self.started else "[\n")
+        self.started = True
+        self.f.write(json.dumps(record))
+
+    def close(self):
+        with self.lock:
+            self.f.write("\n]\n" if self.started else "[]\n")
+        super(JsonWriter, self).close()
+
+
+class CsvWriter(DiffWriter):
+    """Writes the records as CSV, with a header row"""
+
+    def __init__(self, f):
+        super(CsvWriter, self).__init__(f)
+        self.writer = csv.DictWriter(f, FIELDS)
+        self.writer.writeheader()
+
+    def write_record(self, record):
+        self.writer.writerow(record)
+
+
+WRITERS = {"json": JsonWriter, "ndjson": NdjsonWriter, "csv": CsvWriter}
+
+
+def get_record(account, principal, assumed_role, kind, name, classification):
+    """Return a record of the Classification of an actor or action"""
+    return {
+        "account": account,
+        "principal": principal,
+        "assumed_role": assumed_role,
+        "kind": kind,
+        "name": name,
+        "classification": classification.name,
+        "code": int(classification),
+        "symbol": SYMBOLS[classification],
+    }
+
+
+def get_writer(output_format, f):
+    """Return a DiffWriter for one of the FORMATS, writing to the file f"""
+    return WRITERS[output_format](f)
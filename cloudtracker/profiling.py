@@ -0,0 +1,160 @@
+"""
+Copyright 2018 Duo Security
+
+Redistribution and use in source and binary forms, with or without modification, are permitted provided that the
+following conditions are met:
+
+1. Redistributions of source code must retain the above copyright notice, this list of conditions and the following
+disclaimer.
+
+2. Redistributions in binary form must reproduce the above copyright notice, this list of conditions and the
+following disclaimer in the documentation and/or other materials provided with the distribution.
+
+3. Neither the name of the copyright holder nor the names of its contributors may be used to endorse or promote
+products derived from this software without specific prior written permission.
+
+THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES,
+INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL,
+SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY,
+WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE
+USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+---------------------------------------------------------------------------
+
+Lightweight instrumentation of where the time of a run goes.  Phases of a run are recorded as
+spans, and events such as queries made or cache hits as counters, by the module's profiler.
+It does nothing until enabled, by the --profile option, and can then write what it recorded
+as a JSON summary, or as a Chrome trace to view in chrome://tracing or Perfetto.
+"""
+
+import collections
+import contextlib
+import json
+import os
+import threading
+import time
+
+
+class Profiler(object):
+    """Record spans of time spent in the phases of a run, and counters of events in them"""
+
+    enabled = False
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        """Forget everything recorded"""
+        self.spans = []
+        self.counters = collections.Counter()
+        self.thread_names = {}
+        self.origin = time.perf_counter()
+
+    def enable(self):
+        """Start recording, from now"""
+        self.reset()
+        self.enabled = True
+
+    def disable(self):
+        self.enabled = False
+
+    @contextlib.contextmanager
+    def span(self, name, **args):
+        """Record the time spent in the body of the with statement as a phase named name"""
+        if not self.enabled:
+            yield
+            return
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            end = time.perf_counter()
+            thread = threading.current_thread()
+            with self.lock:
+                self.spans.append((name, thread.ident, start, end, args))
+                self.thread_names[thread.ident] = thread.name
+
+    def count(self, name, value=1):
+        """Add value to the counter named name"""
+        if not self.enabled:
+            return
+        with self.lock:
+            self.counters[name] += value
+
+    def get_summary(self):
+        """Return the number of spans of each phase, and the time spent in them, and the counters"""
+        phases = {}
+        with self.lock:
+            spans = list(self.spans)
+            counters = dict(sorted(self.counters.items()))
+        for name, _, start, end, _ in spans:
+            phase = phases.setdefault(name, {"calls": 0, "seconds": 0.0, "max_seconds": 0.0})
+            phase["calls"] += 1
+            phase["seconds"] += end - start
+            phase["max_seconds"] = max(phase["max_seconds"], end - start)
+        for phase in phases.values():
+            phase["seconds"] = round(phase["seconds"], 6)
+            phase["max_seconds"] = round(phase["max_seconds"], 6)
+        return {
+            "seconds": round(time.perf_counter() - self.origin, 6),
+            "phases": dict(sorted(phases.items(), key=lambda item: -item[1]["seconds"])),
+            "counters": counters,
+        }
+
+    def get_trace(self):
+        """Return the spans and counters in the Chrome trace event format"""
+        pid = os.getpid()
+        events = []
+        with self.lock:
+            spans = list(self.spans)
+            counters = dict(self.counters)
+            thread_names = dict(self.thread_names)
+
+        for ident, thread_name in thread_names.items():
+            events.append(
+                {
+                    "name": "thread_name",
+                    "ph": "M",
+                    "pid": pid,
+                    "tid": ident,
+                    "args": {"name": thread_name},
+                }
+            )
+        for name, ident, start, end, args in spans:
+            events.append(
+                {
+                    "name": name,
+                    "cat": name.split("_")[0],
+                    "ph": "X",
+                    "pid": pid,
+                    "tid": ident,
+                    "ts": round((start - self.origin) * 1e6, 3),
+                    "dur": round((end - start) * 1e6, 3),
+                    "args": args,
+                }
+            )
+        if counters:
+            events.append(
+                {
+                    "name": "counters",
+                    "ph": "C",
+                    "pid": pid,
+                    "ts": round((time.perf_counter() - self.origin) * 1e6, 3),
+                    "args": counters,
+                }
+            )
+        return {"traceEvents": events, "displayTimeUnit": "ms"}
+
+    def write(self, f, format="json"):
+        """Write what was recorded to a file, as a JSON summary or a Chrome trace"""
+        if format == "chrome":
+            json.dump(self.get_trace(), f)
+        else:
+            json.dump(self.get_summary(), f, indent=2)
+            f.write("\n")
+
+
+# The profiler of the running process
+profiler = Profiler()
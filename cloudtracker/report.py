@@ -0,0 +1,212 @@
+"""
+Copyright 2018 Duo Security
+
+Redistribution and use in source and binary forms, with or without modification, are permitted provided that the
+following conditions are met:
+
+1. Redistributions of source code must retain the above copyright notice, this list of conditions and the following
+disclaimer.
+
+2. Redistributions in binary form must reproduce the above copyright notice, this list of conditions and the
+following disclaimer in the documentation and/or other materials provided with the distribution.
+
+3. Neither the name of the copyright holder nor the names of its contributors may be used to endorse or promote
+products derived from this software without specific prior written permission.
+
+THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES,
+INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL,
+SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY,
+WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE
+USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+---------------------------------------------------------------------------
+"""
+
+
+import csv
+import threading
+
+import numpy
+
+from cloudtracker import NO_IAM, get_iam_name
+
+# The counts reported for each user or role, overall and for each service
+CATEGORIES = ("allowed", "used", "unused", "unknown", "not_allowed")
+
+
+class UsageMatrix(object):
+    """
+    The API calls many users and roles were allowed and performed, as boolean matrices of
+    principals by API calls, so that what was used, unused, or unknown can be counted for
+    all of them at once.  Principals are added one at a time, from any thread, and then
+    the matrices are made with build.  The API calls a principal performed can be given as
+    those of it in an EventFrame, which are then marked in the matrix straight from the
+    frame's code arrays.
+    """
+
+    recorded_actions = None
+    principals = None
+    actions = None
+    services = None
+    service_starts = None
+    allowed = None
+    performed = None
+    recorded = None
+    no_iam = None
+
+    def __init__(self, recorded_actions):
+        self.recorded_actions = recorded_actions
+        self.principals = []
+        self.rows = []
+        # The EventFrames principals' performed API calls are in, by id, and the rows of
+        # those principals
+        self.frames = {}
+        self.frame_rows = {}
+        self.lock = threading.Lock()
+
+    def add_principal(self, arn, allowed_actions, performed_actions=(), frame=None):
+        """
+        Add the API calls a user or role was allowed, and those it performed, which are
+        converted to their IAM names as classify_actions does.  With a frame, the API calls
+        it performed are instead those of its ARN in the frame.
+        """
+        performed_actions = {get_iam_name(action) for action in performed_actions}
+        with self.lock:
+            if frame is not None:
+                self.frames[id(frame)] = frame
+                self.frame_rows.setdefault(id(frame), []).append((arn, len(self.rows)))
+            self.principals.append(arn)
+            self.rows.append((list(allowed_actions), list(performed_actions)))
+
+    def get_frame_events(self, frame, principal_rows):
+        """
+        Return the matrix row and the frame's action code of each event in a frame of the
+        principals added with it
+        """
+        # The row of each principal code, or -1 for principals not in the matrix
+        row_of = numpy.full(len(frame.principals), -1, dtype=numpy.int64)
+        for arn, row in principal_rows:
+            code = frame.principals.codes.get(arn)
+            if code is not None:
+                row_of[code] = row
+        event_rows = row_of[numpy.asarray(frame.principal_codes, dtype=numpy.int64)]
+        wanted = event_rows >= 0
+        action_codes = numpy.asarray(frame.action_codes, dtype=numpy.int64)[wanted]
+        return event_rows[wanted], action_codes
+
+    def build(self):
+        """Make the matrices of the principals added"""
+        frame_events = []
+        for key, principal_rows in self.frame_rows.items():
+            frame = self.frames[key]
+            event_rows, action_codes = self.get_frame_events(frame, principal_rows)
+            action_names = [get_iam_name(action) for action in frame.actions.strings]
+            frame_events.append((event_rows, action_codes, action_names))
+
+        actions = set()
+        for allowed_actions, performed_actions in self.rows:
+            actions.update(allowed_actions)
+            actions.update(performed_actions)
+        for _, action_codes, action_names in frame_events:
+            actions.update(action_names[code] for code in numpy.unique(action_codes))
+
+        # Sorting the API calls puts those of each service next to each other
+        self.actions = sorted(actions)
+        action_ids = {action: i for i, action in enumerate(self.actions)}
+
+        shape = (len(self.principals), len(self.actions))
+        self.allowed = numpy.zeros(shape, dtype=bool)
+        self.performed = numpy.zeros(shape, dtype=bool)
+        for row, (allowed_actions, performed_actions) in enumerate(self.rows):
+            self.allowed[row, [action_ids[action] for action in allowed_actions]] = True
+            self.performed[
+                row, [action_ids[action] for action in performed_actions]
+            ] = True
+        for event_rows, action_codes, action_names in frame_events:
+            # The column of each of the frame's API calls, or -1 for those not performed by
+            # any principal in the matrix
+            column_of = numpy.array(
+                [action_ids.get(action, -1) for action in action_names], dtype=numpy.int64
+            )
+            self.performed[event_rows, column_of[action_codes]] = True
+        self.rows = []
+        self.frames = {}
+        self.frame_rows = {}
+
+        self.recorded = numpy.array(
+            [action in self.recorded_actions for action in self.actions], dtype=bool
+        )
+        self.no_iam = numpy.array(
+            [action in NO_IAM for action in self.actions], dtype=bool
+        )
+
+        self.services = []
+        self.service_starts = []
+        for i, action in enumerate(self.actions):
+            service = action.split(":")[0]
+            if not self.services or self.services[-1] != service:
+                self.services.append(service)
+                self.service_starts.append(i)
+
+    def get_categories(self):
+        """
+        Return a matrix for each category, marking the API calls of each principal that are
+        in it, as print_diff would show them
+        """
+        not_performed = ~self.performed
+        return {
+            "allowed": self.allowed,
+            "used": self.allowed & self.performed,
+            "unused": self.allowed & not_performed & self.recorded,
+            "unknown": self.allowed & not_performed & ~self.recorded,
+            "not_allowed": self.performed & ~self.allowed & ~self.no_iam,
+        }
+
+    def get_counts(self):
+        """Return the number of API calls in each category, for each principal"""
+        return {
+            category: matrix.sum(axis=1)
+            for category, matrix in self.get_categories().items()
+        }
+
+    def get_service_counts(self):
+        """
+        Return the number of API calls in each category, as a matrix of principals by
+        services
+        """
+        if not self.actions:
+            return {
+                category: numpy.zeros((len(self.principals), 0), dtype=numpy.int64)
+                for category in CATEGORIES
+            }
+        return {
+            category: numpy.add.reduceat(
+                matrix, self.service_starts, axis=1, dtype=numpy.int64
+            )
+            for category, matrix in self.get_categories().items()
+        }
+
+    def write_report(self, f):
+        """
+        Write the counts of each principal as CSV, with a row for each principal overall
+        (service *), followed by a row for each service it has any API calls in
+        """
+        counts = self.get_counts()
+        service_counts = self.get_service_counts()
+        # Each principal has a row for the services it was allowed, or performed without
+        # being allowed, any API calls in
+        has_actions = service_counts["allowed"] + service_counts["not_allowed"] > 0
+
+        writer = csv.writer(f)
+        writer.writerow(("account", "principal", "service") + CATEGORIES)
+        for row, arn in enumerate(self.principals):
+            account = arn.split(":")[4]
+            writer.writerow(
+                [account, arn, "*"] + [counts[category][row] for category in CATEGORIES]
+            )
+            for column in numpy.flatnonzero(has_actions[row]):
+                writer.writerow(
+                    [account, arn, self.services[column]]
+                    + [service_counts[category][row, column] for category in CATEGORIES]
+                )
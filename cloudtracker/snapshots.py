@@ -0,0 +1,191 @@
+"""
+Copyright 2018 Duo Security
+
+Redistribution and use in source and binary forms, with or without modification, are permitted provided that the
+following conditions are met:
+
+1. Redistributions of source code must retain the above copyright notice, this list of conditions and the following
+disclaimer.
+
+2. Redistributions in binary form must reproduce the above copyright notice, this list of conditions and the
+following disclaimer in the documentation and/or other materials provided with the distribution.
+
+3. Neither the name of the copyright holder nor the names of its contributors may be used to endorse or promote
+products derived from this software without specific prior written permission.
+
+THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES,
+INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL,
+SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY,
+WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE
+USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+---------------------------------------------------------------------------
+"""
+
+
+import logging
+
+from cloudtracker.cache import get_content_hash, load_json, save_json
+
+# The parts of the IAM data of each kind of principal that decide what it is allowed to do
+POLICY_FIELDS = {
+    "users": ("GroupList", "AttachedManagedPolicies", "UserPolicyList"),
+    "roles": ("AttachedManagedPolicies", "RolePolicyList"),
+    "groups": ("AttachedManagedPolicies", "GroupPolicyList"),
+}
+
+
+def get_default_document(policy):
+    """Return the document of the default version of a managed policy"""
+    for version in policy.get("PolicyVersionList") or []:
+        if version.get("IsDefaultVersion"):
+            return version.get("Document")
+    return None
+
+
+def get_hashes(account_iam):
+    """
+    Return hashes of the parts of an account's IAM data that decide what its users and roles
+    are allowed to do: the policies of each user, role and group, and the default version of
+    each managed policy
+    """
+    hashes = {
+        "users": {
+            user["Arn"]: get_content_hash([user.get(f) for f in POLICY_FIELDS["users"]])
+            for user in account_iam.get("UserDetailList") or []
+        },
+        "roles": {
+            role["Arn"]: get_content_hash([role.get(f) for f in POLICY_FIELDS["roles"]])
+            for role in account_iam.get("RoleDetailList") or []
+        },
+        "groups": {
+            group["GroupName"]: get_content_hash(
+                [group.get(f) for f in POLICY_FIELDS["groups"]]
+            )
+            for group in account_iam.get("GroupDetailList") or []
+        },
+        "policies": {
+            policy["Arn"]: get_content_hash(get_default_document(policy))
+            for policy in account_iam.get("Policies") or []
+        },
+    }
+    return hashes
+
+
+def get_changed(previous, current):
+    """Return the keys that were added, removed, or whose hash changed"""
+    return {
+        key
+        for key in set(previous) | set(current)
+        if previous.get(key) != current.get(key)
+    }
+
+
+class IamSnapshot(object):
+    """
+    The allowed actions of the users and roles of an account, as of the last time its IAM
+    data was looked at.  When the IAM data is next loaded, it is compared with the snapshot,
+    and only the users and roles affected by the changes have their allowed actions worked
+    out again.  The snapshot is only reused with the same API list.
+    """
+
+    path = None
+    version = None
+    hashes = None
+    allowed = None
+    changes = None
+    affected = None
+
+    def __init__(self, path, version):
+        self.path = path
+        self.version = version
+
+        snapshot = load_json(path, {})
+        if snapshot.get("version") != version:
+            snapshot = {}
+        self.hashes = snapshot.get("hashes")
+        self.allowed = snapshot.get("allowed", {})
+
+    def update(self, account_iam):
+        """
+        Compare the snapshot with the account's current IAM data, and find the users and roles
+        whose allowed actions may have changed
+        """
+        hashes = get_hashes(account_iam)
+
+        if self.hashes is None:
+            # Nothing to compare with, so everything needs working out
+            self.changes = None
+            self.affected = None
+            self.allowed = {}
+            self.hashes = hashes
+            return
+
+        self.changes = {
+            kind: get_changed(self.hashes[kind], hashes[kind]) for kind in hashes
+        }
+        self.hashes = hashes
+        logging.info(
+            "IAM changes since the last snapshot: {} users, {} roles, {} groups, {} policies".format(
+                len(self.changes["users"]),
+                len(self.changes["roles"]),
+                len(self.changes["groups"]),
+                len(self.changes["policies"]),
+            )
+        )
+
+        groups = {
+            group["GroupName"]: group
+            for group in account_iam.get("GroupDetailList") or []
+        }
+
+        def is_affected(principal, changed_principals):
+            if principal["Arn"] in changed_principals:
+                return True
+            attached = list(principal.get("AttachedManagedPolicies") or [])
+            for group_name in principal.get("GroupList") or []:
+                if group_name in self.changes["groups"]:
+                    return True
+                attached.extend(
+                    groups.get(group_name, {}).get("AttachedManagedPolicies") or []
+                )
+            return any(
+                policy["PolicyArn"] in self.changes["policies"] for policy in attached
+            )
+
+        self.affected = {
+            user["Arn"]
+            for user in account_iam.get("UserDetailList") or []
+            if is_affected(user, self.changes["users"])
+        } | {
+            role["Arn"]
+            for role in account_iam.get("RoleDetailList") or []
+            if is_affected(role, self.changes["roles"])
+        }
+
+        # Forget what was stored for principals that have changed or no longer exist
+        self.allowed = {
+            arn: allowed
+            for arn, allowed in self.allowed.items()
+            if arn not in self.affected
+            and (arn in hashes["users"] or arn in hashes["roles"])
+        }
+
+    def get_allowed_actions(self, actor_iam, get_allowed_actions):
+        """
+        Return the allowed actions of a user or role from the snapshot if it is unaffected by
+        any changes, otherwise work them out with get_allowed_actions(actor_iam)
+        """
+        allowed = self.allowed.get(actor_iam["Arn"])
+        if allowed is None:
+            allowed = list(get_allowed_actions(actor_iam))
+            self.allowed[actor_iam["Arn"]] = allowed
+        return allowed
+
+    def save(self):
+        """Save the snapshot, to compare the next version of the IAM data with"""
+        save_json(
+            self.path,
+            {"version": self.version, "hashes": self.hashes, "allowed": self.allowed},
+        )
@@ -0,0 +1,253 @@
+"""
+Copyright 2018 Duo Security
+
+Redistribution and use in source and binary forms, with or without modification, are permitted provided that the
+following conditions are met:
+
+1. Redistributions of source code must retain the above copyright notice, this list of conditions and the following
+disclaimer.
+
+2. Redistributions in binary form must reproduce the above copyright notice, this list of conditions and the
+following disclaimer in the documentation and/or other materials provided with the distribution.
+
+3. Neither the name of the copyright holder nor the names of its contributors may be used to endorse or promote
+products derived from this software without specific prior written permission.
+
+THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES,
+INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL,
+SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY,
+WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE
+USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+---------------------------------------------------------------------------
+"""
+
+import datetime
+import functools
+import json
+import logging
+import os
+import time
+
+from cloudtracker import normalize_api_call
+from cloudtracker.cache import load_json, save_json
+from cloudtracker.logfiles import LOG_FILE_EXTENSIONS, get_field, read_log_file
+
+# For each type of principal, the fields identifying it in a CloudTrail record
+PRINCIPAL_FIELDS = {
+    "users": ("userIdentity.arn", "userIdentity.userName"),
+    "roles": (
+        "userIdentity.sessionContext.sessionIssuer.arn",
+        "userIdentity.sessionContext.sessionIssuer.userName",
+    ),
+}
+
+
+@functools.lru_cache(maxsize=None)
+def get_action(event_source, event_name):
+    """Return the API call for an eventSource and eventName, normalizing each distinct pair only once"""
+    return normalize_api_call(event_source.split(".")[0], event_name)
+
+
+def parse_day(day):
+    """Convert a date string such as 2018-01-21 to a date"""
+    return datetime.datetime.strptime(day[:10], "%Y-%m-%d").date()
+
+
+def add_day(seen, day):
+    """
+    Add a day an API call was seen to its [first day, last day, days], where bit i of days is
+    set if it was seen i days after the first day
+    """
+    if len(seen) < 3:
+        # State from before the days were kept only has the first and last day
+        seen[0] = min(seen[0], day)
+        seen[1] = max(seen[1], day)
+        return
+    offset = (parse_day(day) - parse_day(seen[0])).days
+    if offset < 0:
+        seen[0] = day
+        seen[2] = (seen[2] << -offset) | 1
+    else:
+        seen[1] = max(seen[1], day)
+        seen[2] |= 1 << offset
+
+
+def was_used(seen, start, end):
+    """Given the days an API call was seen, return True if it was seen from start through end"""
+    start, end = start[:10], end[:10]
+    if seen[0] > end or seen[1] < start:
+        return False
+    if len(seen) < 3:
+        # Without the days, the best that can be said is that it was seen either side
+        return True
+    first = parse_day(seen[0])
+    low = max(0, (parse_day(start) - first).days)
+    high = (parse_day(end) - first).days
+    mask = ((1 << (high - low + 1)) - 1) << low
+    return seen[2] & mask != 0
+
+
+class UsageTracker(object):
+    """
+    Keeps track of the API calls each user and role has made, updated as CloudTrail records
+    arrive.  For each principal, the first and last day each API call was seen is kept, with
+    a bit for each day in between saying whether it was seen on that day.
+    """
+
+    def __init__(self, state=None):
+        state = state or {}
+        self.principals = {
+            principal_type: state.get(principal_type, {})
+            for principal_type in PRINCIPAL_FIELDS
+        }
+        # For each directory of log files read, the latest subdirectory read in it, and the
+        # files read in it
+        self.marks = state.get("marks", {})
+        for log_file in state.get("files", []):
+            # State from before the marks were kept lists every file read
+            dirpath, filename = os.path.split(log_file)
+            mark = self.marks.setdefault(dirpath, [None, []])
+            mark[1].append(filename)
+        self.record_count = state.get("record_count", 0)
+
+    @classmethod
+    def load(cls, path):
+        """Load the state saved by a previous run, or start empty"""
+        return cls(load_json(path, {}))
+
+    def save(self, path):
+        state = dict(self.principals)
+        state["marks"] = self.marks
+        state["record_count"] = self.record_count
+        save_json(path, state)
+
+    def add_record(self, record):
+        """Update the API calls of the principal that made a record"""
+        if "errorCode" in record or "eventTime" not in record:
+            return
+        self.record_count += 1
+        action = get_action(record.get("eventSource", ""), record.get("eventName", ""))
+        day = record["eventTime"][:10]
+
+        for principal_type, (arn_field, name_field) in PRINCIPAL_FIELDS.items():
+            arn = get_field(record, arn_field)
+            name = get_field(record, name_field)
+            if arn is None or name is None:
+                continue
+            principal = self.principals[principal_type].get(arn)
+            if principal is None:
+                principal = {"name": name, "actions": {}}
+                self.principals[principal_type][arn] = principal
+
+            seen = principal["actions"].get(action)
+            if seen is None:
+                principal["actions"][action] = [day, day, 1]
+            else:
+                add_day(seen, day)
+
+    def add_records(self, data):
+        """Add the records from a decoded JSON line, which is either a record or a CloudTrail log file"""
+        if "Records" in data:
+            for record in data["Records"]:
+                self.add_record(record)
+        else:
+            self.add_record(data)
+
+
+def consume_lines(tracker, lines, state_path, checkpoint_interval):
+    """Add the records from lines of JSON, such as stdin, saving the state periodically"""
+    last_checkpoint = time.time()
+    for line in lines:
+        line = line.strip()
+        if not line:
+            continue
+        try:
+            tracker.add_records(json.loads(line))
+        except ValueError:
+            logging.warning("Skipping line that is not JSON: {}".format(line[:100]))
+
+        if time.time() - last_checkpoint >= checkpoint_interval:
+            tracker.save(state_path)
+            last_checkpoint = time.time()
+    tracker.save(state_path)
+
+
+def is_date_dir(name):
+    """Returns True for the directories CloudTrail delivers a year, month or day's logs to"""
+    return name.isdigit() and len(name) <= 4
+
+
+def find_new_log_files(path, marks):
+    """
+    Return the log files under a directory that haven't been read, given the marks of the
+    directories already read.  Of the directories for each year, month and day, only the
+    latest one read, and the one before it for logs delivered late, are walked again, and in
+    those any file not yet read is new, as CloudTrail can deliver the files of a directory
+    out of order.  The marks of directories that are no longer walked are dropped.
+    """
+    path = os.path.abspath(path)
+    walked = set()
+    log_files = []
+    for dirpath, dirnames, filenames in os.walk(path):
+        walked.add(dirpath)
+        dirnames.sort()
+        last_dir, read = marks.get(dirpath, (None, []))
+        if isinstance(read, str):
+            # Marks from before the files read were kept have the latest file read
+            read = [name for name in filenames if name <= read]
+            marks[dirpath] = [last_dir, read]
+        date_dirs = [name for name in dirnames if is_date_dir(name)]
+        if last_dir in date_dirs:
+            first_dir = date_dirs[max(0, date_dirs.index(last_dir) - 1)]
+            dirnames[:] = [
+                name for name in dirnames if not is_date_dir(name) or name >= first_dir
+            ]
+        read = set(read)
+        for filename in sorted(filenames):
+            if filename.endswith(LOG_FILE_EXTENSIONS) and filename not in read:
+                log_files.append(os.path.join(dirpath, filename))
+
+    for dirpath in list(marks):
+        if dirpath.startswith(path + os.sep) and dirpath not in walked:
+            del marks[dirpath]
+    return log_files
+
+
+def mark_log_file(marks, path, log_file):
+    """Record a log file under the directory path as read, in the marks of its directories"""
+    path = os.path.abspath(path)
+    dirpath, name = os.path.split(os.path.abspath(log_file))
+    mark = marks.setdefault(dirpath, [None, []])
+    if name not in mark[1]:
+        mark[1].append(name)
+    # Its directory is the latest read in the one above, and so on up to the path
+    while dirpath != path and len(dirpath) > len(path):
+        dirpath, name = os.path.split(dirpath)
+        mark = marks.setdefault(dirpath, [None, []])
+        mark[0] = max(mark[0] or name, name)
+
+
+def consume_directory(tracker, path, state_path, checkpoint_interval, poll_interval):
+    """
+    Add the records from each new log file delivered to a directory, until interrupted,
+    saving the state every checkpoint_interval seconds.
+    """
+    last_checkpoint = time.time()
+    try:
+        while True:
+            new_files = find_new_log_files(path, tracker.marks)
+            for log_file in new_files:
+                for record in read_log_file(log_file):
+                    tracker.add_record(record)
+                mark_log_file(tracker.marks, path, log_file)
+            if new_files:
+                logging.info("Added {} new log files".format(len(new_files)))
+
+            if time.time() - last_checkpoint >= checkpoint_interval:
+                tracker.save(state_path)
+                last_checkpoint = time.time()
+            time.sleep(poll_interval)
+    except KeyboardInterrupt:
+        tracker.save(state_path)
@@ -39,6 +39,7 @@ setup(
         "dev": TESTS_REQUIRE + ["autoflake", "autopep8", "pylint", "invoke"],
         "es1": ["elasticsearch==1.9.0", "elasticsearch_dsl==0.0.11"],
         "es6": ["elasticsearch==6.1.1", "elasticsearch_dsl==6.1.0"],
+        "report": ["numpy"],
     },
     install_requires=[
         "ansicolors==1.1.8",
@@ -125,12 +125,30 @@ def run_pytest(c):
         sys.exit(1)
 
 
+@task
+def run_benchmarks(c, compare=False):
+    """Benchmarks: Runs the benchmarks and saves the results, to compare across commits"""
+    c.run('echo "Running benchmarks"')
+    try:
+        command = "python -m pytest tests/benchmarks --benchmark-autosave"
+        if compare:
+            command += " --benchmark-compare --benchmark-compare-fail=mean:10%"
+        c.run(command)
+    except UnexpectedExit as u_e:
+        logger.critical(f"FAIL! UnexpectedExit: {u_e}")
+        sys.exit(1)
+    except Failure as f_e:
+        logger.critical(f"FAIL: Failure: {f_e}")
+        sys.exit(1)
+
+
 build.add_task(build_package, "build")
 build.add_task(install_package, "install")
 build.add_task(uninstall_package, "uninstall")
 
 unit.add_task(run_nosetests, "nose")
 unit.add_task(run_pytest, "pytest")
+unit.add_task(run_benchmarks, "bench")
 
 test.add_task(run_linter, "lint")
 test.add_task(fmt, "format")
@@ -0,0 +1,87 @@
+"""
+Copyright 2018 Duo Security
+
+Redistribution and use in source and binary forms, with or without modification, are permitted provided that the
+following conditions are met:
+
+1. Redistributions of source code must retain the above copyright notice, this list of conditions and the following
+disclaimer.
+
+2. Redistributions in binary form must reproduce the above copyright notice, this list of conditions and the
+following disclaimer in the documentation and/or other materials provided with the distribution.
+
+3. Neither the name of the copyright holder nor the names of its contributors may be used to endorse or promote
+products derived from this software without specific prior written permission.
+
+THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES,
+INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL,
+SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY,
+WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE
+USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+---------------------------------------------------------------------------
+"""
+
+import tracemalloc
+
+import pytest
+
+pytest.importorskip("pytest_benchmark")
+
+from cloudtracker import read_aws_api_list, read_cloudtrail_supported_actions
+from synthetic import generate_account_iam
+
+
+@pytest.fixture(scope="session")
+def aws_api_list():
+    return read_aws_api_list()
+
+
+@pytest.fixture(scope="session")
+def supported_actions():
+    return read_cloudtrail_supported_actions()
+
+
+@pytest.fixture(scope="session")
+def account_iam(aws_api_list):
+    return generate_account_iam(
+        aws_api_list, users=200, roles=200, groups=20, managed_policies=100
+    )
+
+
+@pytest.fixture(scope="session")
+def wildcard_account_iam(aws_api_list):
+    return generate_account_iam(
+        aws_api_list,
+        users=50,
+        roles=50,
+        groups=10,
+        managed_policies=40,
+        wildcard_density=0.8,
+        deny_density=0.5,
+        seed=1,
+    )
+
+
+@pytest.fixture
+def measure(benchmark):
+    """
+    Benchmark a function, and record the peak memory it allocates in a run of its own, so
+    that saved runs can be compared for memory as well as time
+    """
+
+    def measure(fn, *args, rounds=None, **kwargs):
+        tracemalloc.start()
+        try:
+            fn(*args, **kwargs)
+            _, peak = tracemalloc.get_traced_memory()
+        finally:
+            tracemalloc.stop()
+        benchmark.extra_info["peak_memory"] = peak
+
+        if rounds is not None:
+            return benchmark.pedantic(fn, args=args, kwargs=kwargs, rounds=rounds)
+        return benchmark(fn, *args, **kwargs)
+
+    return measure
@@ -0,0 +1,634 @@
+"""
+Copyright 2018 Duo Security
+
+Redistribution and use in source and binary forms, with or without modification, are permitted provided that the
+following conditions are met:
+
+1. Redistributions of source code must retain the above copyright notice, this list of conditions and the following
+disclaimer.
+
+2. Redistributions in binary form must reproduce the above copyright notice, this list of conditions and the
+following disclaimer in the documentation and/or other materials provided with the distribution.
+
+3. Neither the name of the copyright holder nor the names of its contributors may be used to endorse or promote
+products derived from this software without specific prior written permission.
+
+THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES,
+INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL,
+SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY,
+WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE
+USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+---------------------------------------------------------------------------
+
+Stand-ins for the AWS and ElasticSearch clients CloudTracker uses, so that it can be run end to
+end, offline.  The clients answer from synthetic CloudTrail activity and count every call made
+to them.  Time is simulated: each call, query and page of results costs the time a
+LatencyModel gives it on a SimulatedClock, and the clock stands in for the `time` module of
+the datasources, so waiting on a query costs no real time.
+"""
+
+import collections
+import contextlib
+import datetime
+import itertools
+import random
+import re
+import threading
+from unittest import mock
+
+from botocore.exceptions import ClientError
+from elasticsearch import NotFoundError
+
+# Fields are matched with or without the suffix of their ElasticSearch keyword mapping
+FIELD_SUFFIXES = (".keyword", ".raw")
+
+SHARDS = {"total": 1, "successful": 1, "skipped": 0, "failed": 0}
+
+
+class LatencyModel(object):
+    """
+    The simulated cost of using a backend.  Every call costs `call` seconds, and a query
+    runs for `query` seconds after `queue` seconds in the queue, plus `per_row` seconds for
+    each row it returns.  Results are returned in pages of `page_size` rows.  Each Athena
+    SELECT scans `scanned_bytes`, and with `max_active_queries`, starting more queries than
+    that at once is throttled.
+    """
+
+    def __init__(
+        self,
+        call=0.05,
+        query=2.0,
+        queue=0.0,
+        per_row=0.0001,
+        page_size=1000,
+        scanned_bytes=10 * 1024 * 1024,
+        max_active_queries=None,
+    ):
+        self.call = call
+        self.query = query
+        self.queue = queue
+        self.per_row = per_row
+        self.page_size = page_size
+        self.scanned_bytes = scanned_bytes
+        self.max_active_queries = max_active_queries
+
+
+class SimulatedClock(object):
+    """
+    Simulated time, kept for each thread on its own, as threads wait at the same time.  The
+    elapsed time of a run is that of the thread that made the clock, plus the longest of the
+    others.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.times = {}
+        self.owner = threading.get_ident()
+
+    def time(self):
+        return self.times.get(threading.get_ident(), 0.0)
+
+    monotonic = time
+
+    def sleep(self, seconds):
+        with self.lock:
+            ident = threading.get_ident()
+            self.times[ident] = self.times.get(ident, 0.0) + seconds
+
+    def elapsed(self):
+        """Return the simulated seconds the run took"""
+        with self.lock:
+            others = [t for ident, t in self.times.items() if ident != self.owner]
+            return self.times.get(self.owner, 0.0) + max(others, default=0.0)
+
+
+class CallCounter(object):
+    """Count the calls made to the fake clients, by service and operation"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counts = collections.Counter()
+
+    def add(self, name):
+        with self.lock:
+            self.counts[name] += 1
+
+    def __getitem__(self, name):
+        return self.counts[name]
+
+    def total(self):
+        return sum(self.counts.values())
+
+    def as_dict(self):
+        return dict(sorted(self.counts.items()))
+
+
+class CloudTrailActivity(object):
+    """Synthetic CloudTrail activity: the API calls made by the users and roles of some accounts"""
+
+    def __init__(self, aws_api_list, actions_per_principal=20, active_ratio=0.8, seed=0):
+        self.random = random.Random(seed)
+        self.api_calls = sorted(aws_api_list)
+        self.actions_per_principal = actions_per_principal
+        self.active_ratio = active_ratio
+        # The (eventsource, eventname) of the calls made by each ARN
+        self.events = {}
+        # The account, type ("users" or "roles") and name of each ARN
+        self.principals = {}
+
+    def add_account(self, account_iam):
+        """Make some of the users and roles of an account active"""
+        for principal_type, detail_list, name_key in (
+            ("users", "UserDetailList", "UserName"),
+            ("roles", "RoleDetailList", "RoleName"),
+        ):
+            for principal in account_iam[detail_list]:
+                if self.random.random() >= self.active_ratio:
+                    continue
+                arn = principal["Arn"]
+                calls = self.random.sample(self.api_calls, self.actions_per_principal)
+                self.events[arn] = [
+                    ("{}.amazonaws.com".format(service), event)
+                    for service, event in (call.split(":", 1) for call in calls)
+                ]
+                self.principals[arn] = (arn.split(":")[4], principal_type, principal[name_key])
+
+    def get_arns(self, principal_type, account_ids=None):
+        """Return the active ARNs of a type, in some or all accounts"""
+        return [
+            arn
+            for arn, (account_id, arn_type, _) in sorted(self.principals.items())
+            if arn_type == principal_type and (account_ids is None or account_id in account_ids)
+        ]
+
+    def get_names(self, principal_type, account_ids=None):
+        """Return the names of the active users or roles"""
+        return sorted(
+            {self.principals[arn][2] for arn in self.get_arns(principal_type, account_ids)}
+        )
+
+
+def get_cloudtrail_objects(
+    path, account_ids, start, end, regions=("us-east-1",), files_per_day=24, file_size=50000
+):
+    """Return {key: size} for the CloudTrail log files of some accounts, as laid out in S3"""
+    objects = {}
+    day = datetime.date.fromisoformat(start)
+    while day <= datetime.date.fromisoformat(end):
+        for account_id, region, i in itertools.product(
+            account_ids, regions, range(files_per_day)
+        ):
+            key = "{path}/AWSLogs/{account_id}/CloudTrail/{region}/{day}/{account_id}_CloudTrail_{region}_{i}.json.gz".format(
+                path=path,
+                account_id=account_id,
+                region=region,
+                day=day.strftime("%Y/%m/%d"),
+                i=i,
+            )
+            objects[key] = file_size
+        day += datetime.timedelta(days=1)
+    return objects
+
+
+class FakeClient(object):
+    """Base of the fake clients, which count their calls and charge them to the clock"""
+
+    service = None
+
+    def __init__(self, clock, latency, calls):
+        self.clock = clock
+        self.latency = latency
+        self.calls = calls
+
+    def call(self, operation, seconds=0.0):
+        self.calls.add("{}.{}".format(self.service, operation))
+        self.clock.sleep(self.latency.call + seconds)
+
+
+class FakePaginator(object):
+    """Stands in for a boto3 paginator, by calling an operation until it has no more pages"""
+
+    def __init__(self, operation, token_key):
+        self.operation = operation
+        self.token_key = token_key
+
+    def paginate(self, **kwargs):
+        while True:
+            page = self.operation(**kwargs)
+            yield page
+            if not page.get(self.token_key):
+                return
+            kwargs[self.token_key] = page[self.token_key]
+
+
+class FakeSts(FakeClient):
+    service = "sts"
+
+    def get_caller_identity(self):
+        self.call("get_caller_identity")
+        return {
+            "UserId": "AIDABENCHMARK",
+            "Account": "999999999999",
+            "Arn": "arn:aws:iam::999999999999:user/benchmark",
+        }
+
+
+class FakeS3(FakeClient):
+    service = "s3"
+
+    def __init__(self, clock, latency, calls, objects=None):
+        super().__init__(clock, latency, calls)
+        self.objects = objects or {}
+
+    def list_objects_v2(self, Bucket, Prefix="", MaxKeys=1000, ContinuationToken=None, **_):
+        keys = sorted(key for key in self.objects if key.startswith(Prefix))
+        first = int(ContinuationToken or 0)
+        page = keys[first : first + min(MaxKeys, 1000)]
+        self.call("list_objects_v2", len(page) * self.latency.per_row)
+
+        response = {"KeyCount": len(page), "IsTruncated": first + len(page) < len(keys)}
+        if page:
+            response["Contents"] = [{"Key": key, "Size": self.objects[key]} for key in page]
+        if response["IsTruncated"]:
+            response["NextContinuationToken"] = str(first + len(page))
+        return response
+
+    def get_paginator(self, operation):
+        assert operation == "list_objects_v2"
+        return FakePaginator(self.list_objects_v2, "ContinuationToken")
+
+
+class FakeAthena(FakeClient):
+    """
+    Stands in for the Athena client.  Queries are answered from the activity by recognizing
+    the queries the Athena datasource makes, and partitions added with ALTER TABLE are
+    remembered, so a second setup finds them.
+    """
+
+    service = "athena"
+
+    def __init__(self, clock, latency, calls, activity, partitions=None):
+        super().__init__(clock, latency, calls)
+        self.activity = activity
+        self.partitions = set(partitions or [])
+        self.lock = threading.Lock()
+        self.ids = itertools.count()
+        self.queries = {}
+
+    def start_query_execution(self, QueryString, **_):
+        self.call("start_query_execution")
+        header, rows = self.get_rows(QueryString)
+        now = self.clock.time()
+        with self.lock:
+            if self.latency.max_active_queries is not None:
+                active = sum(
+                    query["state"] == "RUNNING" and query["finish"] > now
+                    for query in self.queries.values()
+                )
+                if active >= self.latency.max_active_queries:
+                    raise ClientError(
+                        {
+                            "Error": {
+                                "Code": "TooManyRequestsException",
+                                "Message": "Too many queries are already running",
+                            }
+                        },
+                        "StartQueryExecution",
+                    )
+            query_id = "query-{}".format(next(self.ids))
+            self.queries[query_id] = {
+                "query": QueryString,
+                "header": header,
+                "rows": rows,
+                "state": "RUNNING",
+                # DDL statements don't scan any data
+                "scanned": self.latency.scanned_bytes
+                if QueryString.lower().startswith("select")
+                else 0,
+                "start": now,
+                "finish": now
+                + self.latency.queue
+                + self.latency.query
+                + len(rows) * self.latency.per_row,
+            }
+        return {"QueryExecutionId": query_id}
+
+    def get_execution(self, query_id):
+        """Return the QueryExecution of a query, as of the time of the calling thread"""
+        query = self.queries[query_id]
+        now = self.clock.time()
+        if query["state"] == "RUNNING" and now >= query["finish"]:
+            query["state"] = "SUCCEEDED"
+        if query["state"] == "RUNNING":
+            done = max(0.0, now - query["start"] - self.latency.queue) / max(
+                query["finish"] - query["start"] - self.latency.queue, 1e-9
+            )
+            state = "RUNNING" if now - query["start"] >= self.latency.queue else "QUEUED"
+        else:
+            done = 1.0
+            state = query["state"]
+        engine_time = max(0.0, min(now, query["finish"]) - query["start"] - self.latency.queue)
+        return {
+            "QueryExecutionId": query_id,
+            "Query": query["query"],
+            "Status": {"State": state, "StateChangeReason": query.get("reason", "")},
+            "Statistics": {
+                "DataScannedInBytes": int(query["scanned"] * min(done, 1.0)),
+                "EngineExecutionTimeInMillis": int(engine_time * 1000),
+                "QueryQueueTimeInMillis": int(self.latency.queue * 1000),
+            },
+        }
+
+    def get_query_execution(self, QueryExecutionId):
+        self.call("get_query_execution")
+        with self.lock:
+            return {"QueryExecution": self.get_execution(QueryExecutionId)}
+
+    def batch_get_query_execution(self, QueryExecutionIds):
+        self.call("batch_get_query_execution")
+        with self.lock:
+            return {
+                "QueryExecutions": [
+                    self.get_execution(query_id) for query_id in QueryExecutionIds
+                ],
+                "UnprocessedQueryExecutionIds": [],
+            }
+
+    def stop_query_execution(self, QueryExecutionId):
+        self.call("stop_query_execution")
+        with self.lock:
+            query = self.queries[QueryExecutionId]
+            if query["state"] == "RUNNING":
+                query["state"] = "CANCELLED"
+                query["reason"] = "Query was cancelled by user"
+                query["finish"] = self.clock.time()
+        return {}
+
+    def get_query_results(self, QueryExecutionId, NextToken=None, MaxResults=1000):
+        query = self.queries[QueryExecutionId]
+        rows = query["rows"]
+        if query["header"] is not None:
+            rows = [query["header"]] + rows
+        first = int(NextToken or 0)
+        page = rows[first : first + min(MaxResults, self.latency.page_size)]
+        self.call("get_query_results", len(page) * self.latency.per_row)
+
+        response = {
+            "ResultSet": {
+                "Rows": [
+                    {"Data": [{"VarCharValue": value} for value in row]} for row in page
+                ]
+            }
+        }
+        if first + len(page) < len(rows):
+            response["NextToken"] = str(first + len(page))
+        return response
+
+    def get_paginator(self, operation):
+        assert operation == "get_query_results"
+        return FakePaginator(self.get_query_results, "NextToken")
+
+    def get_rows(self, query):
+        """Return the header and rows of the results of a query"""
+        if query.startswith("SHOW PARTITIONS"):
+            return None, [[partition] for partition in sorted(self.partitions)]
+        if query.startswith("ALTER TABLE"):
+            for region, year, month in re.findall(
+                r"PARTITION \(region='([^']*)',year='([^']*)',month='([^']*)'\)", query
+            ):
+                self.partitions.add(
+                    "region={}/year={}/month={}".format(region, year, month)
+                )
+            return None, []
+        if query.startswith("CREATE"):
+            return None, []
+
+        table_account = re.search(r"cloudtrail_logs_(\d{12}) ", query)
+        filter_account = re.search(r"account = '(\d{12})'", query)
+        account_ids = None
+        if table_account or filter_account:
+            account_ids = [(filter_account or table_account).group(1)]
+        principal_type = "roles" if "sessionIssuer" in query else "users"
+
+        if query.startswith("select distinct account,"):
+            account_ids = re.findall(r"'(\d{12})'", query.split(" IN ")[1].split(")")[0])
+            return ["account", "arn", "eventsource", "eventname"], [
+                [self.activity.principals[arn][0], arn, source, name]
+                for arn in self.activity.get_arns(principal_type, account_ids)
+                for source, name in self.activity.events[arn]
+            ]
+        if query.startswith("select distinct (eventsource, eventname)"):
+            arn = re.search(r"arn = '([^']*)'", query).group(1)
+            return ["_col0"], [
+                ["{{field0={}, field1={}}}".format(source, name)]
+                for source, name in self.activity.events.get(arn, [])
+            ]
+        if query.startswith("select\n"):
+            # Every call is first seen at the start of the range, and last seen on its last day
+            start, end = re.search(
+                r"eventtime >= '([^']*)' and eventtime < '([^']*)'", query
+            ).groups()
+            last_day = datetime.date.fromisoformat(end) - datetime.timedelta(days=1)
+            return ["_col0", "_col1", "_col2", "eventsource", "eventname", "_col5", "_col6"], [
+                [
+                    arn_type,
+                    arn,
+                    name,
+                    source,
+                    event_name,
+                    "{}T00:00:00Z".format(start),
+                    "{}T23:59:59Z".format(last_day.isoformat()),
+                ]
+                for principal_type in ("users", "roles")
+                for arn in self.activity.get_arns(principal_type, account_ids)
+                for _, arn_type, name in [self.activity.principals[arn]]
+                for source, event_name in self.activity.events[arn]
+            ]
+        if query.startswith("select distinct userIdentity"):
+            return ["userName"], [
+                [name] for name in self.activity.get_names(principal_type, account_ids)
+            ]
+        raise Exception("FakeAthena does not know the query: {}".format(query))
+
+
+class FakeAws(object):
+    """The fake AWS clients of one simulated environment, sharing a clock and call counts"""
+
+    def __init__(self, activity, latency=None, s3_objects=None, partitions=None, clock=None):
+        self.clock = clock or SimulatedClock()
+        self.latency = latency or LatencyModel()
+        self.calls = CallCounter()
+        self.sts = FakeSts(self.clock, self.latency, self.calls)
+        self.s3 = FakeS3(
+            self.clock, self.latency, self.calls, s3_objects or {"cloudtrail/": 0}
+        )
+        self.athena = FakeAthena(self.clock, self.latency, self.calls, activity, partitions)
+
+    def get_clients(self):
+        return {"sts": self.sts, "athena": self.athena, "s3": self.s3}
+
+    @contextlib.contextmanager
+    def patch(self):
+        """Use these clients, and the simulated clock, in the Athena datasource"""
+        with mock.patch(
+            "cloudtracker.datasources.athena.get_clients", self.get_clients
+        ), mock.patch("cloudtracker.datasources.athena.time", self.clock):
+            yield self
+
+
+def get_matches(body):
+    """Return the fields and values of the match queries in the body of a search"""
+    matches = {}
+
+    def walk(node):
+        if isinstance(node, dict):
+            for key, value in node.items():
+                if key == "match":
+                    for field, match in value.items():
+                        for suffix in FIELD_SUFFIXES:
+                            if field.endswith(suffix):
+                                field = field[: -len(suffix)]
+                        if isinstance(match, dict):
+                            match = match["query"]
+                        matches[field] = match
+                else:
+                    walk(value)
+        elif isinstance(node, list):
+            for item in node:
+                walk(item)
+
+    walk(body)
+    return matches
+
+
+class FakeElasticsearch(FakeClient):
+    """
+    Stands in for the ElasticSearch client.  Searches are answered from the activity by the
+    aggregations they ask for, and every role assumption scanned for has `sessions` sessions.
+    """
+
+    service = "es"
+
+    def __init__(self, activity, latency=None, sessions=10, clock=None):
+        super().__init__(
+            clock or SimulatedClock(), latency or LatencyModel(query=0.05), CallCounter()
+        )
+        self.activity = activity
+        self.sessions = sessions
+        self.scrolls = {}
+        self.scroll_ids = itertools.count()
+        self.lock = threading.Lock()
+
+    def info(self, **_):
+        self.call("info")
+        return {"version": {"number": "6.8.0"}}
+
+    def get(self, index, id, **_):
+        self.call("get")
+        raise NotFoundError(404, "not_found", {"_index": index, "_id": id, "found": False})
+
+    def search(self, index=None, body=None, scroll=None, size=None, **_):
+        if scroll is not None:
+            return self.start_scroll(body, size or 10)
+        self.call("search", self.latency.query)
+        return self.get_response(body or {})
+
+    def msearch(self, body, index=None, **_):
+        self.call("msearch", self.latency.query)
+        searches = body[1::2]
+        return {"responses": [self.get_response(search) for search in searches]}
+
+    def start_scroll(self, body, size):
+        """Scan for role assumptions, returning a session for each"""
+        matches = get_matches(body)
+        source = matches.get(
+            "userIdentity.arn", matches.get("userIdentity.sessionContext.sessionIssuer.arn")
+        )
+        with self.lock:
+            scroll_id = str(next(self.scroll_ids))
+        hits = [
+            {
+                "_index": "cloudtrail",
+                "_type": "doc",
+                "_id": "{}-{}-{}".format(source, scroll_id, i),
+                "_score": None,
+                "_source": {
+                    "responseElements": {
+                        "credentials": {
+                            "accessKeyId": "ASIA{:08d}{:08d}".format(int(scroll_id), i)
+                        }
+                    }
+                },
+            }
+            for i in range(self.sessions)
+        ]
+        self.scrolls[scroll_id] = (hits, size)
+        self.call("search", self.latency.query)
+        return self.get_scroll_page(scroll_id, 0)
+
+    def get_scroll_page(self, scroll_id, first):
+        hits, size = self.scrolls[scroll_id]
+        page = hits[first : first + size]
+        self.clock.sleep(len(page) * self.latency.per_row)
+        return {
+            "_scroll_id": "{}:{}".format(scroll_id, first + len(page)) if page else None,
+            "_shards": SHARDS,
+            "hits": {"total": len(hits), "max_score": None, "hits": page},
+        }
+
+    def scroll(self, scroll_id=None, body=None, **_):
+        self.call("scroll")
+        if scroll_id is None:
+            scroll_id = body["scroll_id"]
+        scroll_id, first = scroll_id.split(":")
+        return self.get_scroll_page(scroll_id, int(first))
+
+    def clear_scroll(self, **_):
+        self.call("clear_scroll")
+        return {}
+
+    def get_response(self, body):
+        """Answer a search by the aggregations it asks for"""
+        aggregations = {}
+        aggs = body.get("aggs", {})
+        for agg_name, principal_type in (("user_names", "users"), ("role_names", "roles")):
+            if agg_name in aggs:
+                aggregations[agg_name] = {
+                    "buckets": [
+                        {"key": name, "doc_count": 1}
+                        for name in self.activity.get_names(principal_type)
+                    ]
+                }
+        if "event_names" in aggs:
+            matches = get_matches(body)
+            arn = matches.get(
+                "userIdentity.arn",
+                matches.get("userIdentity.sessionContext.sessionIssuer.arn"),
+            )
+            aggregations["event_names"] = {
+                "buckets": [
+                    {
+                        "key": name,
+                        "doc_count": 1,
+                        "service_names": {"buckets": [{"key": source, "doc_count": 1}]},
+                    }
+                    for source, name in self.activity.events.get(arn, [])
+                ]
+            }
+        return {
+            "took": 1,
+            "timed_out": False,
+            "_shards": SHARDS,
+            "hits": {"total": 0, "max_score": None, "hits": []},
+            "aggregations": aggregations,
+        }
+
+    @contextlib.contextmanager
+    def patch(self):
+        """Use this client in the ElasticSearch datasource"""
+        with mock.patch(
+            "cloudtracker.datasources.es.Elasticsearch", lambda *args, **kwargs: self
+        ):
+            yield self
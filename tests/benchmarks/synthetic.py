@@ -0,0 +1,248 @@
+"""
+Copyright 2018 Duo Security
+
+Redistribution and use in source and binary forms, with or without modification, are permitted provided that the
+following conditions are met:
+
+1. Redistributions of source code must retain the above copyright notice, this list of conditions and the following
+disclaimer.
+
+2. Redistributions in binary form must reproduce the above copyright notice, this list of conditions and the
+following disclaimer in the documentation and/or other materials provided with the distribution.
+
+3. Neither the name of the copyright holder nor the names of its contributors may be used to endorse or promote
+products derived from this software without specific prior written permission.
+
+THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES,
+INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL,
+SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY,
+WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE
+USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+---------------------------------------------------------------------------
+
+Generate synthetic IAM data, in the format of `aws iam get-account-authorization-details`, for
+benchmarking.  The generated accounts are shaped like real ones: a pool of managed policies
+shared by many groups, users and roles, a few inline policies, wildcards in some of the
+actions, and some Deny statements.
+
+Run as a script to write an account to a file for use with the command line:
+
+    python tests/benchmarks/synthetic.py --users 1000 --roles 500 > account-data/bench.json
+"""
+
+import argparse
+import json
+import random
+import sys
+
+ACCOUNT_ID = "111111111111"
+CREATE_DATE = "2018-01-01T00:00:00Z"
+
+
+class IamGenerator(object):
+    """Generate IAM authorization details from a list of API calls"""
+
+    def __init__(
+        self, aws_api_list, wildcard_density=0.2, deny_density=0.05, seed=0, account_id=ACCOUNT_ID
+    ):
+        self.random = random.Random(seed)
+        self.account_id = account_id
+        self.wildcard_density = wildcard_density
+        self.deny_density = deny_density
+
+        # Group the API calls by service, so that statements grant related actions
+        self.services = {}
+        for action in sorted(aws_api_list):
+            service, event = action.split(":", 1)
+            self.services.setdefault(service, []).append(event)
+        self.service_names = sorted(self.services)
+
+    def get_action(self, service):
+        """Return an action of a service, sometimes with a wildcard"""
+        if self.random.random() >= self.wildcard_density:
+            return "{}:{}".format(service, self.random.choice(self.services[service]))
+        kind = self.random.random()
+        if kind < 0.05:
+            return "*"
+        if kind < 0.4:
+            return "{}:*".format(service)
+        event = self.random.choice(self.services[service])
+        return "{}:{}*".format(service, event[: self.random.randint(1, min(6, len(event)))])
+
+    def get_statement(self, effect="Allow"):
+        """Return a statement granting or denying a few actions of one service"""
+        service = self.random.choice(self.service_names)
+        actions = sorted(
+            {self.get_action(service) for _ in range(self.random.randint(1, 8))}
+        )
+        return {
+            "Effect": effect,
+            "Action": actions if len(actions) > 1 else actions[0],
+            "Resource": "*",
+        }
+
+    def get_document(self, max_statements=6):
+        """Return a policy document"""
+        stmts = [self.get_statement() for _ in range(self.random.randint(1, max_statements))]
+        if self.random.random() < self.deny_density:
+            stmts.append(self.get_statement("Deny"))
+        return {"Version": "2012-10-17", "Statement": stmts}
+
+    def get_inline_policies(self, name, probability=0.2):
+        """Return a list of inline policies, usually empty"""
+        if self.random.random() >= probability:
+            return []
+        return [{"PolicyName": "{}-inline".format(name), "PolicyDocument": self.get_document(3)}]
+
+    def get_attached(self, policies, max_count):
+        """Return references to a few managed policies"""
+        if not policies:
+            return []
+        count = min(len(policies), self.random.randint(0, max_count))
+        return [
+            {"PolicyName": policy["PolicyName"], "PolicyArn": policy["Arn"]}
+            for policy in self.random.sample(policies, count)
+        ]
+
+    def generate(self, users=100, roles=100, groups=10, managed_policies=50):
+        """Return the authorization details of an account"""
+        policies = []
+        for i in range(managed_policies):
+            name = "policy-{}".format(i)
+            policies.append(
+                {
+                    "PolicyName": name,
+                    "PolicyId": "ANPA{:016d}".format(i),
+                    "Arn": "arn:aws:iam::{}:policy/{}".format(self.account_id, name),
+                    "Path": "/",
+                    "DefaultVersionId": "v2",
+                    "AttachmentCount": 0,
+                    "IsAttachable": True,
+                    "PolicyVersionList": [
+                        {"Document": self.get_document(), "VersionId": "v2", "IsDefaultVersion": True},
+                        {"Document": self.get_document(), "VersionId": "v1", "IsDefaultVersion": False},
+                    ],
+                }
+            )
+
+        group_list = []
+        for i in range(groups):
+            name = "group-{}".format(i)
+            group_list.append(
+                {
+                    "GroupName": name,
+                    "GroupId": "AGPA{:016d}".format(i),
+                    "Arn": "arn:aws:iam::{}:group/{}".format(self.account_id, name),
+                    "Path": "/",
+                    "AttachedManagedPolicies": self.get_attached(policies, 4),
+                    "GroupPolicyList": self.get_inline_policies(name),
+                }
+            )
+
+        user_list = []
+        for i in range(users):
+            name = "user-{}".format(i)
+            group_names = [group["GroupName"] for group in group_list]
+            user_list.append(
+                {
+                    "UserName": name,
+                    "UserId": "AIDA{:016d}".format(i),
+                    "Arn": "arn:aws:iam::{}:user/{}".format(self.account_id, name),
+                    "Path": "/",
+                    "CreateDate": CREATE_DATE,
+                    "GroupList": self.random.sample(
+                        group_names, min(len(group_names), self.random.randint(0, 3))
+                    ),
+                    "AttachedManagedPolicies": self.get_attached(policies, 2),
+                    "UserPolicyList": self.get_inline_policies(name, 0.1),
+                }
+            )
+
+        role_list = []
+        for i in range(roles):
+            name = "role-{}".format(i)
+            role_list.append(
+                {
+                    "RoleName": name,
+                    "RoleId": "AROA{:016d}".format(i),
+                    "Arn": "arn:aws:iam::{}:role/{}".format(self.account_id, name),
+                    "Path": "/",
+                    "CreateDate": CREATE_DATE,
+                    "AssumeRolePolicyDocument": {
+                        "Version": "2012-10-17",
+                        "Statement": [
+                            {
+                                "Effect": "Allow",
+                                "Principal": {"AWS": "arn:aws:iam::{}:root".format(self.account_id)},
+                                "Action": "sts:AssumeRole",
+                            }
+                        ],
+                    },
+                    "AttachedManagedPolicies": self.get_attached(policies, 4),
+                    "RolePolicyList": self.get_inline_policies(name),
+                }
+            )
+
+        for policy in policies:
+            policy["AttachmentCount"] = sum(
+                attached["PolicyArn"] == policy["Arn"]
+                for actor in group_list + user_list + role_list
+                for attached in actor["AttachedManagedPolicies"]
+            )
+
+        return {
+            "UserDetailList": user_list,
+            "GroupDetailList": group_list,
+            "RoleDetailList": role_list,
+            "Policies": policies,
+        }
+
+
+def generate_account_iam(
+    aws_api_list,
+    users=100,
+    roles=100,
+    groups=10,
+    managed_policies=50,
+    wildcard_density=0.2,
+    deny_density=0.05,
+    seed=0,
+    account_id=ACCOUNT_ID,
+):
+    """Return synthetic authorization details for an account"""
+    generator = IamGenerator(aws_api_list, wildcard_density, deny_density, seed, account_id)
+    return generator.generate(users, roles, groups, managed_policies)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Write synthetic IAM authorization details as JSON"
+    )
+    parser.add_argument("--users", type=int, default=100)
+    parser.add_argument("--roles", type=int, default=100)
+    parser.add_argument("--groups", type=int, default=10)
+    parser.add_argument("--managed-policies", type=int, default=50)
+    parser.add_argument("--wildcard-density", type=float, default=0.2)
+    parser.add_argument("--deny-density", type=float, default=0.05)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    from cloudtracker import read_aws_api_list
+
+    account_iam = generate_account_iam(
+        read_aws_api_list(),
+        users=args.users,
+        roles=args.roles,
+        groups=args.groups,
+        managed_policies=args.managed_policies,
+        wildcard_density=args.wildcard_density,
+        deny_density=args.deny_density,
+        seed=args.seed,
+    )
+    json.dump(account_iam, sys.stdout, indent=2)
+
+
+if __name__ == "__main__":
+    main()
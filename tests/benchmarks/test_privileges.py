@@ -0,0 +1,79 @@
+"""
+Copyright 2018 Duo Security
+
+Redistribution and use in source and binary forms, with or without modification, are permitted provided that the
+following conditions are met:
+
+1. Redistributions of source code must retain the above copyright notice, this list of conditions and the following
+disclaimer.
+
+2. Redistributions in binary form must reproduce the above copyright notice, this list of conditions and the
+following disclaimer in the documentation and/or other materials provided with the distribution.
+
+3. Neither the name of the copyright holder nor the names of its contributors may be used to endorse or promote
+products derived from this software without specific prior written permission.
+
+THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES,
+INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL,
+SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY,
+WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE
+USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+---------------------------------------------------------------------------
+"""
+
+import io
+
+from cloudtracker import (ExpansionCache, Privileges, get_role_allowed_actions,
+                          get_user_allowed_actions, print_diff, read_aws_api_list)
+from cloudtracker.analyzer import Analyzer
+
+
+def test_read_aws_api_list(measure):
+    measure(read_aws_api_list)
+
+
+def test_get_actions_from_statement(measure, aws_api_list):
+    privileges = Privileges(aws_api_list)
+    stmt = {
+        "Effect": "Allow",
+        "Action": ["s3:Get*", "s3:PutObject", "ec2:Describe*", "iam:*"],
+        "Resource": "*",
+    }
+    measure(privileges.get_actions_from_statement, stmt)
+
+
+def test_determine_allowed_wildcards(measure, aws_api_list, wildcard_account_iam):
+    privileges = Privileges(aws_api_list)
+    for policy in wildcard_account_iam["Policies"][:5]:
+        privileges.add_policy(policy["PolicyVersionList"][0]["Document"])
+    measure(privileges.determine_allowed, rounds=3)
+
+
+def test_get_user_allowed_actions(measure, aws_api_list, account_iam):
+    user_iam = account_iam["UserDetailList"][0]
+    measure(get_user_allowed_actions, aws_api_list, user_iam, account_iam, rounds=3)
+
+
+def test_get_all_allowed_actions_with_expansions(measure, aws_api_list, account_iam):
+    def get_all_allowed_actions():
+        expansions = ExpansionCache(aws_api_list)
+        for user_iam in account_iam["UserDetailList"]:
+            get_user_allowed_actions(aws_api_list, user_iam, account_iam, expansions)
+        for role_iam in account_iam["RoleDetailList"]:
+            get_role_allowed_actions(aws_api_list, role_iam, account_iam, expansions)
+
+    measure(get_all_allowed_actions, rounds=1)
+
+
+def test_print_diff(measure, aws_api_list, supported_actions):
+    analyzer = Analyzer(aws_api_list, supported_actions)
+    actions = sorted(aws_api_list)
+    allowed = actions[::2]
+    performed = actions[::3]
+
+    def print_all():
+        print_diff(analyzer.diff_actions(performed, allowed), {}, True, output=io.StringIO())
+
+    measure(print_all)
@@ -0,0 +1,223 @@
+"""
+Copyright 2018 Duo Security
+
+Redistribution and use in source and binary forms, with or without modification, are permitted provided that the
+following conditions are met:
+
+1. Redistributions of source code must retain the above copyright notice, this list of conditions and the following
+disclaimer.
+
+2. Redistributions in binary form must reproduce the above copyright notice, this list of conditions and the
+following disclaimer in the documentation and/or other materials provided with the distribution.
+
+3. Neither the name of the copyright holder nor the names of its contributors may be used to endorse or promote
+products derived from this software without specific prior written permission.
+
+THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES,
+INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL,
+SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY,
+WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE
+USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+---------------------------------------------------------------------------
+"""
+
+import datetime
+import json
+from argparse import Namespace
+
+import pytest
+
+from cloudtracker import run
+from cloudtracker.datasources.athena import Athena
+from fakes import CloudTrailActivity, FakeAws, FakeElasticsearch
+from synthetic import generate_account_iam
+
+ACCOUNT_IDS = ["111111111111", "222222222222", "333333333333"]
+
+END = datetime.date.today()
+START = END - datetime.timedelta(days=30)
+
+
+@pytest.fixture(scope="module")
+def accounts_iam(aws_api_list):
+    return [
+        generate_account_iam(
+            aws_api_list,
+            users=20,
+            roles=20,
+            groups=4,
+            managed_policies=10,
+            seed=i,
+            account_id=account_id,
+        )
+        for i, account_id in enumerate(ACCOUNT_IDS)
+    ]
+
+
+@pytest.fixture(scope="module")
+def activity(aws_api_list, accounts_iam):
+    activity = CloudTrailActivity(aws_api_list)
+    for account_iam in accounts_iam:
+        activity.add_account(account_iam)
+    return activity
+
+
+@pytest.fixture
+def config(tmp_path, accounts_iam):
+    accounts = []
+    for i, (account_id, account_iam) in enumerate(zip(ACCOUNT_IDS, accounts_iam)):
+        iam_path = tmp_path / "{}.json".format(account_id)
+        iam_path.write_text(json.dumps(account_iam))
+        accounts.append({"name": "account{}".format(i), "id": account_id, "iam": str(iam_path)})
+    return {"accounts": accounts, "cache_dir": str(tmp_path / "cache")}
+
+
+def get_args(**kwargs):
+    """Return the command line arguments, with the defaults of the CLI"""
+    args = dict(
+        list=None,
+        user=None,
+        role=None,
+        all=None,
+        account="account0",
+        accounts=None,
+        workers=4,
+        format="text",
+        report=None,
+        processes=1,
+        destrole=None,
+        destaccount=None,
+        show_used=False,
+        show_benign=True,
+        show_unknown=True,
+        use_color=False,
+        skip_setup=False,
+    )
+    args.update(kwargs)
+    return Namespace(**args)
+
+
+def measure_scenario(benchmark, make_backend, scenario, rounds=3):
+    """
+    Benchmark a scenario, each round against a new backend, and record the calls made to
+    the backend and the simulated seconds they took
+    """
+    backends = []
+
+    def setup():
+        backends.append(make_backend())
+        return (backends[-1],), {}
+
+    def run_scenario(backend):
+        with backend.patch():
+            scenario(backend)
+
+    benchmark.pedantic(run_scenario, setup=setup, rounds=rounds)
+    backend = backends[-1]
+    benchmark.extra_info["round_trips"] = backend.calls.as_dict()
+    benchmark.extra_info["simulated_seconds"] = round(backend.clock.elapsed(), 3)
+    return backend
+
+
+@pytest.mark.parametrize("existing_partitions", [False, True])
+def test_athena_setup(benchmark, activity, existing_partitions):
+    config = {"s3_bucket": "bucket", "path": "cloudtrail"}
+    account = {"name": "account0", "id": ACCOUNT_IDS[0]}
+    partitions = None
+    if existing_partitions:
+        # Let a first setup create the partitions
+        aws = FakeAws(activity)
+        with aws.patch():
+            Athena(config, account, START.isoformat(), END.isoformat(), get_args())
+        partitions = aws.athena.partitions
+
+    def scenario(aws):
+        Athena(config, account, START.isoformat(), END.isoformat(), get_args())
+
+    aws = measure_scenario(benchmark, lambda: FakeAws(activity, partitions=partitions), scenario)
+    # The database, table and list of partitions, plus any partitions to add
+    queries = 3 if existing_partitions else 15
+    assert aws.calls["athena.start_query_execution"] == queries
+
+
+def test_athena_all_users(benchmark, capsys, config, activity):
+    config = dict(config, athena={"s3_bucket": "bucket", "path": "cloudtrail"})
+    args = get_args(all="users", skip_setup=True)
+
+    def scenario(aws):
+        run(args, config, START.isoformat(), END.isoformat())
+
+    aws = measure_scenario(benchmark, lambda: FakeAws(activity), scenario)
+    # A query for each user
+    assert aws.calls["athena.start_query_execution"] == 20
+    assert "user-0" in capsys.readouterr().out
+
+
+def test_athena_last_used_index(benchmark, capsys, config, tmp_path, activity):
+    config = dict(
+        config, athena={"s3_bucket": "bucket", "path": "cloudtrail", "last_used_index": True}
+    )
+    args = get_args(all="users", skip_setup=True)
+
+    def scenario(aws):
+        # Each round builds its own index, which then answers a second, shorter date range
+        round_config = dict(config, cache_dir=str(tmp_path / "cache{}".format(id(aws))))
+        run(args, round_config, START.isoformat(), END.isoformat())
+        run(args, round_config, (END - datetime.timedelta(days=7)).isoformat(), END.isoformat())
+
+    aws = measure_scenario(benchmark, lambda: FakeAws(activity), scenario)
+    # One grouped query builds the index, rather than a query for each user in each run
+    assert aws.calls["athena.start_query_execution"] == 1
+    assert "last used" in capsys.readouterr().out
+
+
+def test_athena_org_table_all_accounts(benchmark, capsys, config, activity):
+    config = dict(
+        config,
+        athena={
+            "s3_bucket": "bucket",
+            "path": "cloudtrail",
+            "org_table": True,
+            "org_id": "o-benchmark",
+        },
+    )
+    args = get_args(all="roles", account=None, accounts="all")
+
+    def scenario(aws):
+        run(args, config, START.isoformat(), END.isoformat())
+
+    aws = measure_scenario(benchmark, lambda: FakeAws(activity), scenario)
+    # The database, the table and its projected years, and one query for every account
+    assert aws.calls["athena.start_query_execution"] == 4
+    assert "role-0" in capsys.readouterr().out
+
+
+def test_es_all_roles(benchmark, capsys, config, activity):
+    config = dict(config, elasticsearch={"index": "cloudtrail", "es_version": 6})
+    args = get_args(all="roles")
+
+    def scenario(es):
+        run(args, config, START.isoformat(), END.isoformat())
+
+    es = measure_scenario(benchmark, lambda: FakeElasticsearch(activity), scenario)
+    # The roles are searched for in one _msearch request
+    assert es.calls["es.msearch"] == 1
+    assert "role-0" in capsys.readouterr().out
+
+
+@pytest.mark.parametrize("sessions", [10, 1000])
+def test_es_role_in_role(benchmark, capsys, config, activity, sessions):
+    config = dict(config, elasticsearch={"index": "cloudtrail", "es_version": 6})
+    args = get_args(role="role-0", destrole="role-1")
+
+    def scenario(es):
+        run(args, config, START.isoformat(), END.isoformat())
+
+    es = measure_scenario(
+        benchmark, lambda: FakeElasticsearch(activity, sessions=sessions), scenario
+    )
+    # The sessions are searched for in batches of 100 searches
+    assert es.calls["es.msearch"] == -(-sessions // 100)
+    assert "Getting info for AssumeRole into role-1" in capsys.readouterr().out
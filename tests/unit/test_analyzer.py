@@ -0,0 +1,101 @@
+"""
+Copyright 2018 Duo Security
+
+Redistribution and use in source and binary forms, with or without modification, are permitted provided that the
+following conditions are met:
+
+1. Redistributions of source code must retain the above copyright notice, this list of conditions and the following
+disclaimer.
+
+2. Redistributions in binary form must reproduce the above copyright notice, this list of conditions and the
+following disclaimer in the documentation and/or other materials provided with the distribution.
+
+3. Neither the name of the copyright holder nor the names of its contributors may be used to endorse or promote
+products derived from this software without specific prior written permission.
+
+THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES,
+INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL,
+SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY,
+WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE
+USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+---------------------------------------------------------------------------
+"""
+
+import unittest
+from concurrent.futures import ThreadPoolExecutor
+from unittest.mock import MagicMock
+
+from cloudtracker import Classification
+from cloudtracker.analyzer import Analyzer
+
+ROLE_IAM = {
+    "RoleName": "admin",
+    "Arn": "arn:aws:iam::111111111111:role/admin",
+    "AttachedManagedPolicies": [],
+    "RolePolicyList": [
+        {
+            "PolicyName": "s3",
+            "PolicyDocument": {
+                "Statement": {"Effect": "Allow", "Action": "s3:*", "Resource": "*"}
+            },
+        }
+    ],
+}
+ACCOUNT_IAM = {
+    "RoleDetailList": [ROLE_IAM],
+    "UserDetailList": [],
+    "GroupDetailList": [],
+    "Policies": [],
+}
+
+
+class TestAnalyzer(unittest.TestCase):
+    """Test class for the Analyzer"""
+
+    def setUp(self):
+        self.analyzer = Analyzer(
+            aws_api_list={
+                "s3:getobject": True,
+                "s3:putobject": True,
+                "s3:listbuckets": True,
+                "ec2:runinstances": True,
+            },
+            cloudtrail_supported_actions={"s3:listbuckets": True, "s3:putobject": True},
+        )
+
+    def test_diff_role(self):
+        """Test each action of a role is classified"""
+        datasource = MagicMock()
+        datasource.get_performed_event_names_by_role.return_value = {
+            "s3:listbuckets": True,
+            "ec2:runinstances": True,
+        }
+
+        diff = self.analyzer.diff_role(datasource, ROLE_IAM, ACCOUNT_IAM)
+        self.assertEqual({"s3:listallmybuckets"}, diff.used)
+        self.assertEqual({"ec2:runinstances"}, diff.not_allowed)
+        self.assertEqual({"s3:putobject"}, diff.unused)
+        self.assertEqual({"s3:getobject"}, diff.unknown)
+        self.assertEqual(
+            ("ec2:runinstances", Classification.PERFORMED_BUT_NOT_ALLOWED), list(diff)[0]
+        )
+
+    def test_diff_actors(self):
+        """Test actors that have been deleted are classified as not allowed"""
+        diff = self.analyzer.diff_actors(["alice", "bob"], ["alice", "charlie"])
+        self.assertEqual({"alice"}, diff.used)
+        self.assertEqual({"bob"}, diff.not_allowed)
+        self.assertEqual({"charlie"}, diff.unused)
+
+    def test_threads(self):
+        """Test one Analyzer gives the same results when used by many threads at once"""
+        def diff(performed):
+            allowed = self.analyzer.get_role_allowed_actions(ROLE_IAM, ACCOUNT_IAM)
+            return self.analyzer.diff_actions(performed, allowed).classifications
+
+        performed = [{"s3:getobject": True}, {"s3:listbuckets": True}, {}] * 20
+        with ThreadPoolExecutor(max_workers=8) as executor:
+            results = list(executor.map(diff, performed))
+        self.assertEqual([diff(p) for p in performed], results)
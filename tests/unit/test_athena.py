@@ -0,0 +1,339 @@
+"""
+Copyright 2018 Duo Security
+
+Redistribution and use in source and binary forms, with or without modification, are permitted provided that the
+following conditions are met:
+
+1. Redistributions of source code must retain the above copyright notice, this list of conditions and the following
+disclaimer.
+
+2. Redistributions in binary form must reproduce the above copyright notice, this list of conditions and the
+following disclaimer in the documentation and/or other materials provided with the distribution.
+
+3. Neither the name of the copyright holder nor the names of its contributors may be used to endorse or promote
+products derived from this software without specific prior written permission.
+
+THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES,
+INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL,
+SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY,
+WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE
+USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+---------------------------------------------------------------------------
+"""
+
+import datetime
+import io
+import unittest
+from argparse import Namespace
+from unittest.mock import MagicMock, patch
+
+from botocore.exceptions import ClientError
+
+from cloudtracker.datasources.athena import (
+    Athena,
+    QueryFailed,
+    QueryScheduler,
+    ScanBudgetExceeded,
+    ScanLedger,
+    get_months,
+    parse_size,
+)
+
+CONFIG = {
+    "s3_bucket": "my_log_bucket",
+    "path": "my_prefix",
+    "org_id": "o-myid123",
+    "org_table": True,
+    "output_s3_bucket": "s3://my_output_bucket",
+}
+ACCOUNT = {"name": "demo", "id": 111111111111, "iam": "demo.json"}
+
+
+def get_datasource(skip_setup=True, config=CONFIG):
+    clients = {"sts": MagicMock(), "athena": MagicMock(), "s3": MagicMock()}
+    clients["sts"].get_caller_identity.return_value = {
+        "Arn": "arn:aws:iam::111111111111:user/alice",
+        "Account": "111111111111",
+    }
+    clients["s3"].list_objects_v2.return_value = {"Contents": [{"Key": "my_prefix/AWSLogs"}]}
+    start = (datetime.date.today() - datetime.timedelta(days=30)).isoformat()
+    end = datetime.date.today().isoformat()
+    return Athena(
+        config, ACCOUNT, start, end, Namespace(skip_setup=skip_setup), clients=clients
+    )
+
+
+def get_query_execution(state, **status):
+    status["State"] = state
+    return {"QueryExecution": {"QueryExecutionId": "q1", "Status": status}}
+
+
+class TestAthena(unittest.TestCase):
+    """Test class for the Athena datasource"""
+
+    def test_org_table(self):
+        """An organization table is shared by accounts, and projects its partitions"""
+        with patch.object(Athena, "query_athena") as query_athena:
+            datasource = get_datasource(skip_setup=False)
+
+        self.assertEqual("cloudtrail_logs_o_myid123", datasource.table_name)
+        self.assertTrue(datasource.search_filter.startswith("(account = '111111111111' and "))
+
+        queries = [call[0][0] for call in query_athena.call_args_list]
+        self.assertFalse(any("PARTITION (region=" in query for query in queries))
+        self.assertIn("PARTITIONED BY (account string,", queries[-2])
+        self.assertIn(
+            "'storage.location.template'='s3://my_log_bucket/my_prefix/AWSLogs/o-myid123/${account}/CloudTrail/${region}/${year}/${month}/'",
+            queries[-2],
+        )
+        # The years projected by a table created before are extended through next year
+        self.assertEqual(
+            "ALTER TABLE `cloudtrail_logs_o_myid123` SET TBLPROPERTIES "
+            "('projection.year.range'='2013,{}')".format(datetime.date.today().year + 1),
+            queries[-1],
+        )
+
+    def test_get_performed_event_names_by_accounts(self):
+        """Many accounts are queried at once, and their events returned by account and ARN"""
+        datasource = get_datasource()
+        admin = "arn:aws:iam::111111111111:role/admin"
+        rows = [
+            ["111111111111", admin, "s3.amazonaws.com", "ListBuckets"],
+            ["111111111111", admin, "ec2.amazonaws.com", "DescribeInstances"],
+        ]
+        with patch.object(Athena, "query_athena", return_value=rows) as query_athena:
+            events = datasource.get_performed_event_names_by_accounts(
+                [111111111111, 222222222222], "roles"
+            )
+
+        self.assertIn("account IN ('111111111111', '222222222222')", query_athena.call_args[0][0])
+        self.assertEqual(
+            {
+                "111111111111": {admin: {"s3:listbuckets": True, "ec2:describeinstances": True}},
+                "222222222222": {},
+            },
+            events,
+        )
+
+        datasource.use_performed_events(events["111111111111"])
+        self.assertEqual(
+            {admin: {"s3:listbuckets": True, "ec2:describeinstances": True}},
+            datasource.get_performed_event_names_by_roles(None, [{"Arn": admin}]),
+        )
+
+    def test_get_last_used_rows(self):
+        """When every principal last used each API call is found with one grouped query"""
+        datasource = get_datasource()
+        rows = [["users", "arn:aws:iam::111111111111:user/alice", "alice", "s3.amazonaws.com",
+                 "CreateBucket", "2018-11-21T01:00:00Z", "2018-12-01T01:00:00Z"]]
+        with patch.object(Athena, "query_athena", return_value=rows) as query_athena:
+            self.assertEqual(rows, datasource.get_last_used_rows("2018-11-21", "2019-01-02"))
+
+        query = query_athena.call_args[0][0]
+        self.assertIn("account = '111111111111' and ", query)
+        self.assertIn("(year = '2019' and month = '01')", query)
+        self.assertIn("eventtime >= '2018-11-21' and eventtime < '2019-01-03'", query)
+        self.assertIn("min(eventtime), max(eventtime)", query)
+        self.assertIn("group by 1, 2, 3, 4, 5", query)
+
+    def test_parse_size(self):
+        """Sizes in the config are bytes, or have units"""
+        self.assertEqual(500, parse_size(500))
+        self.assertEqual(500 * 1024 ** 2, parse_size("500 MB"))
+        self.assertEqual(int(1.5 * 1024 ** 4), parse_size("1.5TB"))
+        with self.assertRaises(SystemExit):
+            parse_size("lots")
+
+    def test_get_months(self):
+        """The months of a date range run across years"""
+        self.assertEqual(
+            [(2018, 11), (2018, 12), (2019, 1)], get_months("2018-11-21", "2019-01-02")
+        )
+
+    def test_scan_estimate_over_budget(self):
+        """A query estimated to scan more than the budget isn't started"""
+        datasource = get_datasource(config=dict(CONFIG, max_scan_per_query="1 MB"))
+        datasource.s3.list_objects_v2.return_value = {
+            "CommonPrefixes": [
+                {"Prefix": "my_prefix/AWSLogs/o-myid123/111111111111/CloudTrail/us-east-1/"}
+            ]
+        }
+        datasource.s3.get_paginator.return_value.paginate.return_value = [
+            {"Contents": [{"Key": "a", "Size": 600 * 1024}, {"Key": "b", "Size": 600 * 1024}]}
+        ]
+
+        with self.assertRaises(ScanBudgetExceeded):
+            datasource.get_performed_users()
+        datasource.athena.start_query_execution.assert_not_called()
+        # One day of each month of the date range is listed
+        self.assertEqual(
+            len(datasource.months),
+            datasource.s3.get_paginator.return_value.paginate.call_count,
+        )
+
+    def test_scan_estimate(self):
+        """The scan is estimated from one day of each month queried"""
+        datasource = get_datasource(config=dict(CONFIG, max_scan_per_query="50 MB"))
+        datasource.s3.list_objects_v2.return_value = {
+            "CommonPrefixes": [
+                {"Prefix": "my_prefix/AWSLogs/o-myid123/111111111111/CloudTrail/us-east-1/"}
+            ]
+        }
+        paginate = datasource.s3.get_paginator.return_value.paginate
+        paginate.return_value = [{"Contents": [{"Key": "a", "Size": 1024 ** 2}]}]
+
+        # The months of the date range queried are estimated, not those of the datasource
+        with self.assertRaises(ScanBudgetExceeded):
+            datasource.get_last_used_rows("2018-11-21", "2019-01-02")
+        self.assertEqual(
+            [
+                "my_prefix/AWSLogs/o-myid123/111111111111/CloudTrail/us-east-1/2018/11/15/",
+                "my_prefix/AWSLogs/o-myid123/111111111111/CloudTrail/us-east-1/2018/12/15/",
+                "my_prefix/AWSLogs/o-myid123/111111111111/CloudTrail/us-east-1/2019/01/15/",
+            ],
+            [call[1]["Prefix"] for call in paginate.call_args_list],
+        )
+        self.assertEqual(
+            (30 + 31 + 31) * 1024 ** 2,
+            datasource.get_scan_estimate(111111111111, get_months("2018-11-21", "2019-01-02")),
+        )
+        # The regions and days already listed are not listed again
+        self.assertEqual(1, datasource.s3.list_objects_v2.call_count)
+        self.assertEqual(3, paginate.call_count)
+
+    def test_scan_estimate_first_of_month(self):
+        """On the first of the month, its estimate comes from the last day of the month before"""
+        datasource = get_datasource()
+        datasource.get_prefix_size = MagicMock(return_value=1024 ** 2)
+
+        class Today(datetime.date):
+            @classmethod
+            def today(cls):
+                return cls(2019, 1, 1)
+
+        with patch("cloudtracker.datasources.athena.datetime.date", Today):
+            self.assertEqual(1024 ** 2, datasource.get_month_estimate("us-east-1/", 2019, 1))
+            self.assertEqual(31 * 1024 ** 2, datasource.get_month_estimate("us-east-1/", 2018, 12))
+        self.assertEqual(
+            [(("us-east-1/2018/12/31/",),), (("us-east-1/2018/12/15/",),)],
+            datasource.get_prefix_size.call_args_list,
+        )
+
+    def test_stop_query_over_budget(self):
+        """A query that scans more than the budget while running is stopped"""
+        datasource = get_datasource(config=dict(CONFIG, max_scan_per_run=1000))
+        datasource.ledger.regions[datasource.get_log_prefix(111111111111)] = []
+        datasource.athena.start_query_execution.return_value = {"QueryExecutionId": "q1"}
+        datasource.athena.get_query_execution.return_value = {
+            "QueryExecution": {
+                "QueryExecutionId": "q1",
+                "Status": {"State": "RUNNING"},
+                "Statistics": {"DataScannedInBytes": 2000},
+            }
+        }
+
+        with self.assertRaises(ScanBudgetExceeded):
+            datasource.get_performed_users()
+        datasource.athena.stop_query_execution.assert_called_once_with(QueryExecutionId="q1")
+        self.assertEqual(2000, datasource.ledger.get_scanned())
+
+    def test_run_budget(self):
+        """The budget of a run is shared by its queries"""
+        ledger = ScanLedger({"max_scan_per_query": "1 GB", "max_scan_per_run": "1.5 GB"})
+        self.assertIsNone(ledger.get_over_budget(1024 ** 3))
+        self.assertIn("per query", ledger.get_over_budget(2 * 1024 ** 3))
+
+        ledger.add("q1", "select distinct userIdentity.userName from t", 1024 ** 3)
+        self.assertIsNone(ledger.get_over_budget(256 * 1024 ** 2))
+        self.assertIn("per run, of which 1.0 GB is used", ledger.get_over_budget(1024 ** 3))
+
+    def test_ledger_report(self):
+        """The report has the bytes and cost of each query, with Athena's 10 MB minimum"""
+        ledger = ScanLedger({"price_per_tb": 5})
+        ledger.add("q1", "CREATE DATABASE cloudtracker", 0)
+        ledger.add("q2", "select distinct userIdentity.userName from t", 1024)
+        ledger.add("q3", "select distinct userIdentity.userName from t", 1024 ** 4)
+
+        f = io.StringIO()
+        ledger.write_report(f)
+        lines = f.getvalue().splitlines()
+        self.assertIn("$0.000000", lines[0])
+        self.assertIn("$0.000048", lines[1])
+        self.assertIn("1.0 TB", lines[2])
+        self.assertEqual("Athena scanned 1.0 TB in 3 queries, costing about $5.0000", lines[3])
+
+    @patch("cloudtracker.datasources.athena.time")
+    def test_throttled_start(self, mock_time):
+        """A start that is throttled is tried again after a backoff"""
+        datasource = get_datasource()
+        throttled = ClientError(
+            {"Error": {"Code": "TooManyRequestsException", "Message": "Rate exceeded"}},
+            "StartQueryExecution",
+        )
+        datasource.athena.start_query_execution.side_effect = [
+            throttled,
+            {"QueryExecutionId": "q1"},
+        ]
+        datasource.athena.get_query_execution.return_value = get_query_execution("SUCCEEDED")
+        datasource.athena.get_query_results.return_value = {
+            "ResultSet": {"Rows": [{"Data": [{"VarCharValue": "username"}]}]}
+        }
+
+        self.assertEqual([], datasource.query_athena("select 1"))
+        self.assertEqual(2, datasource.athena.start_query_execution.call_count)
+        mock_time.sleep.assert_called_once()
+        # The query's place in the quota is given up once it finishes
+        self.assertEqual({}, datasource.scheduler.active)
+
+    @patch("cloudtracker.datasources.athena.time")
+    def test_retryable_failure(self, mock_time):
+        """A query that fails in passing is run again, and one that can't succeed is not"""
+        datasource = get_datasource(config=dict(CONFIG, max_attempts=2))
+        datasource.athena.start_query_execution.return_value = {"QueryExecutionId": "q1"}
+        datasource.athena.get_query_execution.return_value = get_query_execution(
+            "FAILED", StateChangeReason="Rate exceeded", AthenaError={"Retryable": True}
+        )
+
+        with self.assertRaises(QueryFailed):
+            datasource.query_athena("select 1")
+        self.assertEqual(2, datasource.athena.start_query_execution.call_count)
+
+        datasource.athena.start_query_execution.reset_mock()
+        datasource.athena.get_query_execution.return_value = get_query_execution(
+            "FAILED", StateChangeReason="SYNTAX_ERROR: line 1:8"
+        )
+        with self.assertRaises(QueryFailed):
+            datasource.query_athena("select 1")
+        self.assertEqual(1, datasource.athena.start_query_execution.call_count)
+
+    @patch("cloudtracker.datasources.athena.time")
+    def test_query_timeout(self, mock_time):
+        """A query that runs past its timeout is stopped"""
+        mock_time.monotonic.side_effect = [0, 30, 90]
+        datasource = get_datasource(config=dict(CONFIG, query_timeout=60))
+        datasource.athena.start_query_execution.return_value = {"QueryExecutionId": "q1"}
+        datasource.athena.get_query_execution.return_value = get_query_execution("RUNNING")
+
+        with self.assertRaises(QueryFailed):
+            datasource.query_athena("select 1")
+        datasource.athena.stop_query_execution.assert_called_once_with(QueryExecutionId="q1")
+        self.assertEqual(1, datasource.athena.start_query_execution.call_count)
+
+    def test_cancel(self):
+        """Cancelling stops the queries still running, and any more from starting"""
+        scheduler = QueryScheduler({"max_active_queries": 2})
+        athena = MagicMock()
+        athena.start_query_execution.side_effect = [
+            {"QueryExecutionId": "q1"},
+            {"QueryExecutionId": "q2"},
+        ]
+        scheduler.start(athena, QueryString="select 1")
+        scheduler.start(athena, QueryString="select 2")
+        scheduler.finish("q1")
+
+        scheduler.cancel()
+        athena.stop_query_execution.assert_called_once_with(QueryExecutionId="q2")
+        with self.assertRaises(QueryFailed):
+            scheduler.start(athena, QueryString="select 3")
@@ -0,0 +1,148 @@
+"""
+Copyright 2018 Duo Security
+
+Redistribution and use in source and binary forms, with or without modification, are permitted provided that the
+following conditions are met:
+
+1. Redistributions of source code must retain the above copyright notice, this list of conditions and the following
+disclaimer.
+
+2. Redistributions in binary form must reproduce the above copyright notice, this list of conditions and the
+following disclaimer in the documentation and/or other materials provided with the distribution.
+
+3. Neither the name of the copyright holder nor the names of its contributors may be used to endorse or promote
+products derived from this software without specific prior written permission.
+
+THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES,
+INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL,
+SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY,
+WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE
+USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+---------------------------------------------------------------------------
+"""
+
+import json
+import os
+import tempfile
+import unittest
+from unittest.mock import patch
+
+from cloudtracker.cache import PolicyStore, get_cache_dir
+
+READ_ONLY = {
+    "Version": "2012-10-17",
+    "Statement": [{"Effect": "Allow", "Action": ["s3:Get*", "s3:List*"], "Resource": "*"}],
+}
+
+
+def write_account_iam(path, documents):
+    """Write an IAM file with a managed policy for each document"""
+    account_iam = {
+        "UserDetailList": [],
+        "GroupDetailList": [],
+        "RoleDetailList": [],
+        "Policies": [
+            {
+                "PolicyName": "Policy{}".format(i),
+                "Arn": "arn:aws:iam::aws:policy/Policy{}".format(i),
+                "DefaultVersionId": "v1",
+                "PolicyVersionList": [
+                    {"Document": document, "VersionId": "v1", "IsDefaultVersion": True}
+                ],
+            }
+            for i, document in enumerate(documents)
+        ],
+    }
+    with open(path, "w") as f:
+        json.dump(account_iam, f)
+
+
+def get_document(account_iam, i):
+    return account_iam["Policies"][i]["PolicyVersionList"][0]["Document"]
+
+
+class TestPolicyStore(unittest.TestCase):
+    """Test class for the PolicyStore"""
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.cache_dir = os.path.join(self.tmp_dir.name, "cache")
+        self.demo_path = os.path.join(self.tmp_dir.name, "demo.json")
+        self.prod_path = os.path.join(self.tmp_dir.name, "prod.json")
+        write_account_iam(self.demo_path, [READ_ONLY])
+        write_account_iam(self.prod_path, [{"Statement": []}, READ_ONLY])
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def test_shared_documents(self):
+        """Identical documents in the IAM files of different accounts are stored once"""
+        store = PolicyStore(self.cache_dir)
+        demo_iam = store.load_account_iam(self.demo_path)
+        prod_iam = store.load_account_iam(self.prod_path)
+
+        self.assertEqual(READ_ONLY, get_document(demo_iam, 0))
+        self.assertIs(get_document(demo_iam, 0), get_document(prod_iam, 1))
+        self.assertEqual(2, len(os.listdir(os.path.join(self.cache_dir, "policies"))))
+
+    def test_cached_references(self):
+        """The cached copy of an account's IAM data only references the documents"""
+        store = PolicyStore(self.cache_dir)
+        store.load_account_iam(self.prod_path)
+
+        with open(store.get_account_cache_path(self.prod_path)) as f:
+            self.assertNotIn("s3:Get*", f.read())
+
+    def test_read_cached(self):
+        """A new store reads the cached IAM data, resolving the documents from disk"""
+        PolicyStore(self.cache_dir).load_account_iam(self.prod_path)
+
+        with patch.object(PolicyStore, "add", side_effect=AssertionError):
+            prod_iam = PolicyStore(self.cache_dir).load_account_iam(self.prod_path)
+        self.assertEqual(READ_ONLY, get_document(prod_iam, 1))
+        self.assertEqual({"Statement": []}, get_document(prod_iam, 0))
+
+    def test_changed_file(self):
+        """Changing an IAM file means it is read again"""
+        store = PolicyStore(self.cache_dir)
+        store.load_account_iam(self.demo_path)
+
+        write_account_iam(self.demo_path, [{"Statement": []}, {"Statement": [], "Version": "2"}])
+        self.assertEqual(2, len(store.load_account_iam(self.demo_path)["Policies"]))
+
+    def test_unreadable_cache(self):
+        """A cached copy that can't be read is ignored, and the IAM file read again"""
+        store = PolicyStore(self.cache_dir)
+        store.load_account_iam(self.prod_path)
+        with open(store.get_account_cache_path(self.prod_path), "w") as f:
+            f.write("{")
+
+        with self.assertLogs(level="WARNING"):
+            prod_iam = PolicyStore(self.cache_dir).load_account_iam(self.prod_path)
+        self.assertEqual(READ_ONLY, get_document(prod_iam, 1))
+
+    def test_missing_document(self):
+        """A document that was never stored can't be returned"""
+        store = PolicyStore(self.cache_dir)
+        with self.assertRaises(KeyError):
+            store.get("0" * 64)
+
+    def test_in_memory(self):
+        """Without a cache directory, documents are still shared, but nothing is written"""
+        write_account_iam(self.prod_path, [READ_ONLY])
+
+        store = PolicyStore(get_cache_dir({}))
+        demo_iam = store.load_account_iam(self.demo_path)
+        prod_iam = store.load_account_iam(self.prod_path)
+
+        self.assertIs(get_document(demo_iam, 0), get_document(prod_iam, 0))
+        self.assertEqual(["demo.json", "prod.json"], sorted(os.listdir(self.tmp_dir.name)))
+
+    def test_get_cache_dir(self):
+        """Nothing is cached between runs unless a cache directory is given"""
+        self.assertIsNone(get_cache_dir({}))
+        self.assertEqual(
+            os.path.join(os.path.expanduser("~"), "cache"), get_cache_dir({"cache_dir": "~/cache"})
+        )
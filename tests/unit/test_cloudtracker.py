@@ -24,19 +24,29 @@ USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
 """
 
 import sys
+import tempfile
 import unittest
-from unittest.mock import patch
+from argparse import Namespace
+from unittest.mock import MagicMock, patch
 from io import StringIO
 from contextlib import contextmanager
 
-from cloudtracker import (get_role_allowed_actions,
+from cloudtracker import (classify_actions,
+                          classify_actors,
+                          ExpansionCache,
+                          get_accounts,
+                          get_role_allowed_actions,
                           get_role_iam,
                           make_list,
                           normalize_api_call,
                           print_actor_diff,
+                          print_all_actor_diffs,
                           print_diff,
                           Privileges,
-                          read_aws_api_list)
+                          read_aws_api_list,
+                          run_accounts)
+from cloudtracker.analyzer import Analyzer, Diff
+from cloudtracker.datasources.athena import ScanBudgetExceeded
 
 
 @contextmanager
@@ -192,57 +202,68 @@ class TestCloudtracker(unittest.TestCase):
 
     def test_print_actor_diff(self):
         """Test print_actor_diff"""
-        with capture(print_actor_diff, [], [], False) as output:
+        with capture(print_actor_diff, Diff(classify_actors([], [])), False) as output:
             self.assertEquals('', output)
 
         # Test output when you have 3 configured users, but only two actually did anything
-        with capture(print_actor_diff, ['alice', 'bob'], ['alice', 'bob', 'charlie'], False) as output:
+        diff = Diff(classify_actors(['alice', 'bob'], ['alice', 'bob', 'charlie']))
+        with capture(print_actor_diff, diff, False) as output:
             self.assertEquals('  alice\n  bob\n- charlie\n', output)
 
 
     def test_print_diff(self):
         """Test print_diff"""
 
-        with capture(print_diff, [], [], {}, False) as output:
-            self.assertEquals('', output)
-
-        def mocked_is_recorded_by_cloudtrail(action):
+        def is_recorded(action):
             """Instead of reading the whole file, just cherry pick this one action used in the tests"""
             if action == 's3:putobject':
                 return False
             return True
 
+        def diff(performed_actions, allowed_actions):
+            return Diff(classify_actions(performed_actions, allowed_actions, is_recorded))
+
+        with capture(print_diff, diff([], []), {}, False) as output:
+            self.assertEquals('', output)
+
         # One action allowed, and performed, and should be shown
-        with patch('cloudtracker.is_recorded_by_cloudtrail', side_effect=mocked_is_recorded_by_cloudtrail):
-            with capture(print_diff,
-                         ['s3:createbucket'], # performed
-                         ['s3:createbucket'], # allowed
-                         {'show_benign': True, 'show_used': False, 'show_unknown': True}, False) as output:
-                self.assertEquals('  s3:createbucket\n', output)
+        with capture(print_diff,
+                     diff(['s3:createbucket'], # performed
+                          ['s3:createbucket']), # allowed
+                     {'show_benign': True, 'show_used': False, 'show_unknown': True}, False) as output:
+            self.assertEquals('  s3:createbucket\n', output)
 
         # 3 actions allowed, one is used, one is unused, and one is unknown; show all
-        with patch('cloudtracker.is_recorded_by_cloudtrail', side_effect=mocked_is_recorded_by_cloudtrail):
-            with capture(print_diff,
-                         ['s3:createbucket', 'sts:getcalleridentity'], # performed
-                         ['s3:createbucket', 's3:putobject', 's3:deletebucket'], # allowed
-                         {'show_benign': True, 'show_used': False, 'show_unknown': True}, False) as output:
-                self.assertEquals('  s3:createbucket\n- s3:deletebucket\n? s3:putobject\n', output)
+        with capture(print_diff,
+                     diff(['s3:createbucket', 'sts:getcalleridentity'], # performed
+                          ['s3:createbucket', 's3:putobject', 's3:deletebucket']), # allowed
+                     {'show_benign': True, 'show_used': False, 'show_unknown': True}, False) as output:
+            self.assertEquals('  s3:createbucket\n- s3:deletebucket\n? s3:putobject\n', output)
 
         # Same as above, but only show the used one
-        with patch('cloudtracker.is_recorded_by_cloudtrail', side_effect=mocked_is_recorded_by_cloudtrail):
-            with capture(print_diff,
-                         ['s3:createbucket', 'sts:getcalleridentity'], # performed
-                         ['s3:createbucket', 's3:putobject', 's3:deletebucket'], # allowed
-                         {'show_benign': True, 'show_used': True, 'show_unknown': True}, False) as output:
-                self.assertEquals('  s3:createbucket\n', output)
+        with capture(print_diff,
+                     diff(['s3:createbucket', 'sts:getcalleridentity'], # performed
+                          ['s3:createbucket', 's3:putobject', 's3:deletebucket']), # allowed
+                     {'show_benign': True, 'show_used': True, 'show_unknown': True}, False) as output:
+            self.assertEquals('  s3:createbucket\n', output)
 
         # Hide the unknown
-        with patch('cloudtracker.is_recorded_by_cloudtrail', side_effect=mocked_is_recorded_by_cloudtrail):
-            with capture(print_diff,
-                         ['s3:createbucket', 'sts:getcalleridentity'], # performed
-                         ['s3:createbucket', 's3:putobject', 's3:deletebucket'], # allowed
-                         {'show_benign': True, 'show_used': False, 'show_unknown': False}, False) as output:
-                self.assertEquals('  s3:createbucket\n- s3:deletebucket\n', output)
+        with capture(print_diff,
+                     diff(['s3:createbucket', 'sts:getcalleridentity'], # performed
+                          ['s3:createbucket', 's3:putobject', 's3:deletebucket']), # allowed
+                     {'show_benign': True, 'show_used': False, 'show_unknown': False}, False) as output:
+            self.assertEquals('  s3:createbucket\n- s3:deletebucket\n', output)
+
+        # Show when actions were last used, including ones not used in the date range
+        with capture(print_diff,
+                     diff(['s3:createbucket'], # performed
+                          ['s3:createbucket', 's3:listallmybuckets', 's3:deletebucket']), # allowed
+                     {'show_benign': True, 'show_used': False, 'show_unknown': True}, False,
+                     None,
+                     {'s3:createbucket': '2018-05-01T01:00:00Z', 's3:listbuckets': '2017-12-24T01:00:00Z'}) as output:
+            self.assertEquals('  s3:createbucket  (last used 2018-05-01)\n'
+                              '- s3:deletebucket\n'
+                              '- s3:listallmybuckets  (last used 2017-12-24)\n', output)
 
     # Role IAM policy to be used in different tests
     role_iam = {
@@ -316,3 +337,143 @@ class TestCloudtracker(unittest.TestCase):
         aws_api_list = read_aws_api_list()
         self.assertEquals(sorted(['s3:putobject', 'kms:describekey', 'kms:decrypt', 's3:putobjectacl']),
                           sorted(get_role_allowed_actions(aws_api_list, self.role_iam, account_iam)))
+
+
+    def test_expansion_cache(self):
+        """Test policies expanded with the ExpansionCache grant the same actions, and are saved"""
+        account_iam = {
+            "RoleDetailList": [self.role_iam],
+            "UserDetailList": [],
+            "GroupDetailList": [],
+            "Policies": []
+        }
+        expected = sorted(get_role_allowed_actions(self.aws_api_list, self.role_iam, account_iam))
+
+        with tempfile.TemporaryDirectory() as cache_dir:
+            expansions = ExpansionCache(self.aws_api_list, cache_dir)
+            self.assertEquals(expected, sorted(
+                get_role_allowed_actions(self.aws_api_list, self.role_iam, account_iam, expansions)))
+            expansions.save()
+
+            # A new cache reads the expansions back, rather than expanding the policy again
+            expansions = ExpansionCache(self.aws_api_list, cache_dir)
+            with patch("cloudtracker.Privileges.get_actions_from_statement") as get_actions:
+                self.assertEquals(expected, sorted(
+                    get_role_allowed_actions(self.aws_api_list, self.role_iam, account_iam, expansions)))
+            get_actions.assert_not_called()
+
+        # A deny of everything with no condition removes the actions allowed by other policies
+        deny_role_iam = dict(self.role_iam, RolePolicyList=self.role_iam["RolePolicyList"] + [{
+            "PolicyName": "deny_kms",
+            "PolicyDocument": {"Statement": {"Effect": "Deny", "Action": "kms:*", "Resource": "*"}}
+        }])
+        self.assertEquals(['s3:putobject', 's3:putobjectacl'], sorted(
+            get_role_allowed_actions(self.aws_api_list, deny_role_iam, account_iam, ExpansionCache(self.aws_api_list))))
+
+
+    def test_expand_policies(self):
+        """Test policies expanded on worker processes match those expanded in process"""
+        policies = [
+            [{"Effect": "Allow", "Action": "s3:{}*".format(prefix), "Resource": "*"},
+             {"Effect": "Deny", "Action": "s3:{}bucket*".format(prefix), "Resource": "*"}]
+            for prefix in "abcdefghijklmnopqrstuvwxyz"
+        ]
+        expansions = ExpansionCache(self.aws_api_list, workers=2)
+        try:
+            expansions.expand_policies(policies)
+            self.assertEquals(len(policies), len(expansions.policies))
+        finally:
+            expansions.close()
+
+        in_process = ExpansionCache(self.aws_api_list, workers=1)
+        for stmts in policies:
+            self.assertEquals(in_process.get_policy_actions(stmts), expansions.get_policy_actions(stmts))
+        self.assertIn("s3:listallmybuckets", expansions.get_policy_actions(policies[11])[0])
+
+
+    def test_print_all_actor_diffs(self):
+        """Test the allowed actions are only worked out once for roles with the same policies"""
+        copy_iam = dict(self.role_iam, RoleName="copy_role", Arn="arn:aws:iam::111111111111:role/copy_role")
+        other_iam = dict(self.role_iam, RoleName="other_role", Arn="arn:aws:iam::111111111111:role/other_role",
+                         RolePolicyList=self.role_iam["RolePolicyList"][:1])
+        account_iam = {
+            "RoleDetailList": [self.role_iam, copy_iam, other_iam],
+            "UserDetailList": [],
+            "GroupDetailList": [],
+            "Policies": []
+        }
+        datasource = MagicMock()
+        datasource.get_performed_event_names_by_roles.return_value = {
+            copy_iam["Arn"]: {"s3:putobject": True}
+        }
+        datasource.get_last_used.return_value = {}
+
+        analyzer = Analyzer(self.aws_api_list, cloudtrail_supported_actions=self.aws_api_list)
+
+        with patch("cloudtracker.get_role_allowed_actions", wraps=get_role_allowed_actions) as get_allowed:
+            with capture(print_all_actor_diffs, datasource, "roles", analyzer, account_iam,
+                         {"show_used": True}, False) as output:
+                self.assertEquals(
+                    "Getting info for test_role\n"
+                    "Getting info for copy_role\n  s3:putobject\n"
+                    "Getting info for other_role\n",
+                    output)
+        self.assertEquals(2, get_allowed.call_count)
+
+
+    accounts = [
+        {"name": "demo", "id": 111111111111, "iam": "demo.json"},
+        {"name": "prod", "id": 222222222222, "iam": "prod.json"},
+        {"name": "dev", "id": 333333333333, "iam": "dev.json"},
+    ]
+
+    def test_get_accounts(self):
+        """Test get_accounts"""
+        self.assertEquals(self.accounts, get_accounts(self.accounts, "all"))
+        self.assertEquals([self.accounts[2], self.accounts[0]],
+                          get_accounts(self.accounts, "dev, 111111111111"))
+
+
+    def test_run_accounts(self):
+        """Test run_accounts reports every account in order, even when one fails"""
+        def mocked_run_account(args, config, account, datasource, analyzer, output, **kwargs):
+            if account["name"] == "prod":
+                raise Exception("no access")
+            print("  {}".format(account["name"]), file=output)
+
+        args = Namespace(accounts="all", destaccount=None, workers=2, use_color=False)
+        config = {"accounts": self.accounts, "local": {"path": "."}}
+        with patch("cloudtracker.get_datasource"), \
+                patch("cloudtracker.run_account", side_effect=mocked_run_account):
+            out, sys.stdout = sys.stdout, StringIO()
+            try:
+                with self.assertRaises(SystemExit):
+                    run_accounts(args, config, "2018-01-01", "2018-02-01", MagicMock())
+                output = sys.stdout.getvalue()
+            finally:
+                sys.stdout = out
+
+        self.assertEquals(
+            "Account demo (111111111111)\n  demo\n"
+            "Account prod (222222222222)\n"
+            "Account dev (333333333333)\n  dev\n",
+            output)
+
+
+    def test_run_accounts_over_budget(self):
+        """Test run_accounts ends the run when an account goes over a scan budget"""
+        def mocked_run_account(args, config, account, datasource, analyzer, output, **kwargs):
+            if account["name"] == "prod":
+                raise ScanBudgetExceeded("over the budget of 1.0 GB per run")
+
+        args = Namespace(accounts="all", destaccount=None, workers=2, use_color=False)
+        config = {"accounts": self.accounts, "local": {"path": "."}}
+        with patch("cloudtracker.get_datasource"), \
+                patch("cloudtracker.run_account", side_effect=mocked_run_account):
+            out, sys.stdout = sys.stdout, StringIO()
+            try:
+                with self.assertRaises(ScanBudgetExceeded):
+                    run_accounts(args, config, "2018-01-01", "2018-02-01", MagicMock(),
+                                 scan_ledger=MagicMock())
+            finally:
+                sys.stdout = out
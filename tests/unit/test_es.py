@@ -0,0 +1,283 @@
+"""
+Copyright 2018 Duo Security
+
+Redistribution and use in source and binary forms, with or without modification, are permitted provided that the
+following conditions are met:
+
+1. Redistributions of source code must retain the above copyright notice, this list of conditions and the following
+disclaimer.
+
+2. Redistributions in binary form must reproduce the above copyright notice, this list of conditions and the
+following disclaimer in the documentation and/or other materials provided with the distribution.
+
+3. Neither the name of the copyright holder nor the names of its contributors may be used to endorse or promote
+products derived from this software without specific prior written permission.
+
+THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES,
+INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL,
+SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY,
+WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE
+USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+---------------------------------------------------------------------------
+"""
+
+import datetime
+import tempfile
+import unittest
+from unittest.mock import MagicMock, patch
+
+try:
+    from elasticsearch import NotFoundError
+    from cloudtracker.datasources.es import ElasticSearch, SUMMARY_MAPPING
+except ImportError:
+    ElasticSearch = None
+
+
+def events_response(*events):
+    """Build an _msearch response entry for the given (eventsource, eventname) pairs"""
+    buckets = []
+    for service, event in events:
+        buckets.append(
+            {"key": event, "service_names": {"buckets": [{"key": service}]}}
+        )
+    return {"aggregations": {"event_names": {"buckets": buckets}}}
+
+
+@unittest.skipIf(ElasticSearch is None, "Elasticsearch support not installed")
+class TestElasticSearch(unittest.TestCase):
+    """Test class for the ElasticSearch datasource"""
+
+    def setUp(self):
+        self.cache_dir = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.cache_dir.cleanup()
+
+    def get_datasource(self, config):
+        with patch("cloudtracker.datasources.es.Elasticsearch") as es_class:
+            es_class.return_value.info.return_value = {"version": {"number": "6.1.1"}}
+            # No summary index has been built
+            es_class.return_value.get.side_effect = NotFoundError(404, "not found")
+            datasource = ElasticSearch(
+                config, "2018-01-01", "2018-12-31", cache_dir=self.cache_dir.name
+            )
+        return datasource
+
+    def test_es_version_is_cached(self):
+        """Test the cluster version is only looked up once per cluster"""
+        datasource = self.get_datasource({"host": "localhost", "index": "one"})
+        self.assertEqual(6, datasource.es_version)
+        self.assertEqual(1, datasource.es.info.call_count)
+
+        datasource = self.get_datasource({"host": "localhost", "index": "two"})
+        self.assertEqual(6, datasource.es_version)
+        self.assertEqual(0, datasource.es.info.call_count)
+
+    def test_es_version_cache_expires(self):
+        """Test the cached cluster version is looked up again once it is a day old"""
+        with patch("cloudtracker.datasources.es.time.time", return_value=1000000):
+            self.get_datasource({"host": "localhost"})
+        with patch("cloudtracker.datasources.es.time.time", return_value=1000000 + 23 * 3600):
+            datasource = self.get_datasource({"host": "localhost"})
+        self.assertEqual(0, datasource.es.info.call_count)
+        with patch("cloudtracker.datasources.es.time.time", return_value=1000000 + 25 * 3600):
+            datasource = self.get_datasource({"host": "localhost"})
+        self.assertEqual(1, datasource.es.info.call_count)
+
+    def test_get_performed_event_names_by_roles(self):
+        """Test the per-role searches are batched through _msearch and mapped back to roles"""
+        datasource = self.get_datasource(
+            {"msearch_batch_size": 2, "max_concurrent_queries": 2}
+        )
+        role_events = {
+            "arn:aws:iam::111111111111:role/alpha": events_response(
+                ("s3.amazonaws.com", "CreateBucket")
+            ),
+            "arn:aws:iam::111111111111:role/beta": events_response(),
+            "arn:aws:iam::111111111111:role/gamma": events_response(
+                ("monitoring.amazonaws.com", "DescribeAlarms")
+            ),
+        }
+
+        def msearch(index, body):
+            """Answer each search with the events of the role it matches on"""
+            responses = []
+            for search in body[1::2]:
+                for arn, response in role_events.items():
+                    if arn in str(search["query"]):
+                        responses.append(response)
+            return {"responses": responses}
+
+        datasource.es.msearch = MagicMock(side_effect=msearch)
+
+        roles_iam = [
+            {"Arn": "arn:aws:iam::111111111111:role/alpha"},
+            {"Arn": "arn:aws:iam::111111111111:role/beta"},
+            {"Arn": "arn:aws:iam::111111111111:role/gamma"},
+        ]
+        events = datasource.get_performed_event_names_by_roles(
+            datasource.get_search_query(), roles_iam
+        )
+
+        self.assertEqual(2, datasource.es.msearch.call_count)
+        self.assertEqual(
+            {
+                "arn:aws:iam::111111111111:role/alpha": {"s3:createbucket": True},
+                "arn:aws:iam::111111111111:role/beta": {},
+                "arn:aws:iam::111111111111:role/gamma": {
+                    "cloudwatch:describealarms": True
+                },
+            },
+            events,
+        )
+
+        # Each search in a request is a header followed by the query, without any hits
+        bodies = [call[1]["body"] for call in datasource.es.msearch.call_args_list]
+        self.assertEqual([2, 4], sorted(len(body) for body in bodies))
+        self.assertEqual(0, bodies[0][1]["size"])
+
+    def test_summary_index_covers_start_of_range(self):
+        """Test the summary index is used for the days it covers, and raw events for the rest"""
+        with patch("cloudtracker.datasources.es.Elasticsearch") as es_class:
+            es_class.return_value.get.return_value = {
+                "_source": {"firstDay": "2018-01-01", "lastDay": "2018-06-30"}
+            }
+            datasource = ElasticSearch(
+                {"es_version": 6, "summary_index": "cloudtrail_summary"},
+                "2018-02-01",
+                "2018-12-31",
+                cache_dir=self.cache_dir.name,
+            )
+        self.assertEqual(("2018-02-01", "2018-06-30"), datasource.summary_days)
+
+        datasource.es.msearch = MagicMock(
+            return_value={
+                "responses": [
+                    events_response(("s3.amazonaws.com", "CreateBucket")),
+                    events_response(("s3.amazonaws.com", "DeleteBucket")),
+                ]
+            }
+        )
+        events = datasource.get_performed_event_names_by_role(
+            datasource.get_search_query(),
+            {"Arn": "arn:aws:iam::111111111111:role/alpha"},
+        )
+        self.assertEqual({"s3:createbucket": True, "s3:deletebucket": True}, events)
+
+        body = datasource.es.msearch.call_args[1]["body"]
+        self.assertEqual("cloudtrail_summary", body[0]["index"])
+        self.assertEqual("cloudtrail", body[2]["index"])
+        self.assertIn("'gte': '2018-07-01'", str(body[3]["query"]))
+
+    def test_summary_index_mappings(self):
+        """Test the summary index is only created with a mapping type before ElasticSearch 7"""
+        for es_version, mappings in [
+            (6, {"doc": SUMMARY_MAPPING}),
+            (7, SUMMARY_MAPPING),
+        ]:
+            datasource = self.get_datasource(
+                {"es_version": es_version, "summary_index": "cloudtrail_summary"}
+            )
+            datasource.es.indices.exists.return_value = False
+            # Nothing to summarize, so only the index is created
+            datasource.build_summary("2018-01-02", "2018-01-01")
+            datasource.es.indices.create.assert_called_once_with(
+                index="cloudtrail_summary", body={"mappings": mappings}
+            )
+
+    def test_summary_stops_at_yesterday(self):
+        """Test a day that isn't over is left out of the summary index and its checkpoint"""
+        datasource = self.get_datasource({"summary_index": "cloudtrail_summary"})
+        datasource.get_summary_docs = MagicMock(return_value=[])
+        yesterday = datetime.datetime.utcnow().date() - datetime.timedelta(days=1)
+        start = yesterday - datetime.timedelta(days=1)
+        end = yesterday + datetime.timedelta(days=2)
+
+        datasource.build_summary(start.isoformat(), end.isoformat())
+        self.assertEqual(2, datasource.es.index.call_count)
+        self.assertEqual(
+            yesterday.isoformat(), datasource.es.index.call_args[1]["body"]["lastDay"]
+        )
+
+    def test_get_summary_docs(self):
+        """Test summary documents are built from the composite aggregation buckets"""
+        datasource = self.get_datasource({"summary_index": "cloudtrail_summary"})
+        datasource.es.search = MagicMock(
+            return_value={
+                "aggregations": {
+                    "summary": {
+                        "buckets": [
+                            {
+                                "key": {
+                                    "arn": "arn:aws:iam::111111111111:user/alice",
+                                    "name": "alice",
+                                    "eventSource": "s3.amazonaws.com",
+                                    "eventName": "CreateBucket",
+                                },
+                                "doc_count": 3,
+                                "first_seen": {"value_as_string": "2018-01-02T01:00:00.000Z"},
+                                "last_seen": {"value_as_string": "2018-01-02T05:00:00.000Z"},
+                            }
+                        ]
+                    }
+                }
+            }
+        )
+
+        docs = list(datasource.get_summary_docs("user", datetime.date(2018, 1, 2)))
+        self.assertEqual(1, len(docs))
+        self.assertEqual("cloudtrail_summary", docs[0]["_index"])
+        self.assertEqual(
+            {
+                "principalType": "user",
+                "arn": "arn:aws:iam::111111111111:user/alice",
+                "name": "alice",
+                "eventSource": "s3.amazonaws.com",
+                "eventName": "CreateBucket",
+                "day": "2018-01-02",
+                "count": 3,
+                "firstSeen": "2018-01-02T01:00:00.000Z",
+                "lastSeen": "2018-01-02T05:00:00.000Z",
+            },
+            docs[0]["_source"],
+        )
+
+    def test_get_last_used_rows(self):
+        """Test the first and last use of each API call are paged through for users and roles"""
+        datasource = self.get_datasource({"host": "localhost"})
+        bucket = {
+            "key": {
+                "arn": "arn:aws:iam::111111111111:user/alice",
+                "name": "alice",
+                "eventSource": "s3.amazonaws.com",
+                "eventName": "CreateBucket",
+            },
+            "first_seen": {"value_as_string": "2018-01-02T01:00:00.000Z"},
+            "last_seen": {"value_as_string": "2018-03-02T05:00:00.000Z"},
+        }
+        datasource.es.search = MagicMock(
+            side_effect=[
+                {"aggregations": {"last_used": {"buckets": [bucket]}}},
+                {"aggregations": {"last_used": {"buckets": []}}},
+            ]
+        )
+
+        rows = list(datasource.get_last_used_rows("2018-01-01", "2018-12-31"))
+        self.assertEqual(
+            [
+                (
+                    "users",
+                    "arn:aws:iam::111111111111:user/alice",
+                    "alice",
+                    "s3.amazonaws.com",
+                    "CreateBucket",
+                    "2018-01-02T01:00:00.000Z",
+                    "2018-03-02T05:00:00.000Z",
+                )
+            ],
+            rows,
+        )
+        # One search for users, and one for roles
+        self.assertEqual(2, datasource.es.search.call_count)
@@ -0,0 +1,110 @@
+"""
+Copyright 2018 Duo Security
+
+Redistribution and use in source and binary forms, with or without modification, are permitted provided that the
+following conditions are met:
+
+1. Redistributions of source code must retain the above copyright notice, this list of conditions and the following
+disclaimer.
+
+2. Redistributions in binary form must reproduce the above copyright notice, this list of conditions and the
+following disclaimer in the documentation and/or other materials provided with the distribution.
+
+3. Neither the name of the copyright holder nor the names of its contributors may be used to endorse or promote
+products derived from this software without specific prior written permission.
+
+THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES,
+INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL,
+SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY,
+WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE
+USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+---------------------------------------------------------------------------
+"""
+
+import pickle
+import unittest
+
+from cloudtracker.events import EventFrame
+
+ALICE = "arn:aws:iam::111111111111:user/alice"
+ADMIN = "arn:aws:iam::111111111111:role/admin"
+
+
+class TestEventFrame(unittest.TestCase):
+    """Test class for EventFrame"""
+
+    def test_add_records(self):
+        """Test records are counted by principal, API call, region and day"""
+        frame = EventFrame("2018-03-01")
+        record = {
+            "eventTime": "2018-03-02T01:00:00Z",
+            "eventSource": "s3.amazonaws.com",
+            "eventName": "GetObject",
+            "awsRegion": "us-east-1",
+            "userIdentity": {"type": "IAMUser", "arn": ALICE},
+        }
+        frame.add_records([
+            record,
+            record,
+            dict(record, errorCode="AccessDenied"),
+            dict(record, eventTime="2018-02-28T01:00:00Z"),
+            dict(record, eventTime="2018-04-01T01:00:00Z"),
+        ], "2018-03-31")
+
+        self.assertEqual(1, len(frame))
+        self.assertEqual([1], list(frame.day_offsets))
+        self.assertEqual({"s3:getobject": 2}, frame.get_action_counts(ALICE))
+
+    def test_extend(self):
+        """Test frames are combined, converting their codes, and compacted"""
+        frame = EventFrame("2018-03-01")
+        frame.add(ALICE, "s3:getobject", "us-east-1", "2018-03-02")
+
+        other = EventFrame("2018-03-02")
+        other.add(ADMIN, "iam:createuser", "eu-west-1", "2018-03-02")
+        other.add(ALICE, "s3:getobject", "us-east-1", "2018-03-02", 2)
+        frame.extend(pickle.loads(pickle.dumps(other)))
+        frame.compact()
+
+        self.assertEqual(2, len(frame))
+        self.assertEqual({"s3:getobject": 3}, frame.get_action_counts(ALICE))
+        self.assertEqual(
+            {ALICE: {"s3:getobject": True}, ADMIN: {"iam:createuser": True}, "unknown": {}},
+            frame.get_performed_event_names_by_principals([ALICE, ADMIN, "unknown"]),
+        )
+
+    def test_days_outside_frame(self):
+        """Test events before the base day are rejected rather than overflowing"""
+        frame = EventFrame("2018-03-01")
+        with self.assertRaises(ValueError):
+            frame.add(ALICE, "s3:getobject", "us-east-1", "2018-02-28")
+        self.assertEqual(0, len(frame))
+
+        earlier = EventFrame("2018-02-01")
+        earlier.add(ALICE, "s3:getobject", "us-east-1", "2018-02-28")
+        with self.assertRaises(ValueError):
+            frame.extend(earlier)
+        self.assertEqual(0, len(frame))
+
+    def test_principal_field(self):
+        """Test the principals of a frame can be taken from a given field"""
+        record = {
+            "eventTime": "2018-03-02T01:00:00Z",
+            "eventSource": "s3.amazonaws.com",
+            "eventName": "GetObject",
+            "awsRegion": "us-east-1",
+            "userIdentity": {
+                "type": "AssumedRole",
+                "arn": "arn:aws:sts::111111111111:assumed-role/admin/alice",
+                "sessionContext": {"sessionIssuer": {"arn": ADMIN}},
+            },
+        }
+        frame = EventFrame("2018-03-01")
+        frame.add_records([record])
+        self.assertEqual([ADMIN], frame.principals.strings)
+
+        frame = EventFrame("2018-03-01")
+        frame.add_records([record], principal_field="userIdentity.arn")
+        self.assertEqual(["arn:aws:sts::111111111111:assumed-role/admin/alice"], frame.principals.strings)
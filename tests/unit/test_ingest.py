@@ -0,0 +1,176 @@
+"""
+Copyright 2018 Duo Security
+
+Redistribution and use in source and binary forms, with or without modification, are permitted provided that the
+following conditions are met:
+
+1. Redistributions of source code must retain the above copyright notice, this list of conditions and the following
+disclaimer.
+
+2. Redistributions in binary form must reproduce the above copyright notice, this list of conditions and the
+following disclaimer in the documentation and/or other materials provided with the distribution.
+
+3. Neither the name of the copyright holder nor the names of its contributors may be used to endorse or promote
+products derived from this software without specific prior written permission.
+
+THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES,
+INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL,
+SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY,
+WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE
+USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+---------------------------------------------------------------------------
+"""
+
+import gzip
+import json
+import os
+import tempfile
+import unittest
+from unittest.mock import MagicMock, patch
+
+try:
+    from elasticsearch import TransportError
+    from cloudtracker.ingest import MAX_RETRIES, BulkIngester, Checkpoint
+except ImportError:
+    BulkIngester = None
+
+
+def write_log_file(path, records):
+    """Write records as a gzipped CloudTrail log file"""
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with gzip.open(path, "wt") as f:
+        json.dump({"Records": records}, f)
+
+
+@unittest.skipIf(BulkIngester is None, "Elasticsearch support not installed")
+class TestIngest(unittest.TestCase):
+    """Test class for loading CloudTrail logs into ElasticSearch"""
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.logs = os.path.join(self.tmp.name, "logs")
+        write_log_file(
+            os.path.join(self.logs, "a.json.gz"),
+            [
+                {"eventID": "1", "eventName": "CreateBucket"},
+                {"eventID": "2", "eventName": "ListBuckets", "responseElements": {"endpoint": "x"}},
+            ],
+        )
+        write_log_file(os.path.join(self.logs, "b.json.gz"), [{"eventID": "3"}])
+        self.checkpoint_path = os.path.join(self.tmp.name, "checkpoint.log")
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def ingest(self, bulk):
+        """Load the log files, answering each _bulk request with bulk"""
+        es = MagicMock()
+        es.bulk.side_effect = bulk
+        ingester = BulkIngester(
+            es, "cloudtrail", "doc", "", Checkpoint(self.checkpoint_path), workers=2, connections=1
+        )
+        with patch("cloudtracker.ingest.time.sleep"):
+            ingester.ingest(self.logs)
+        return ingester
+
+    def is_completed(self, name):
+        return Checkpoint(self.checkpoint_path).is_completed(os.path.join(self.logs, name))
+
+    def test_ingest(self):
+        """Test each record is sent as a document, and completed files are checkpointed"""
+        sent = []
+
+        def bulk(body):
+            lines = body.splitlines()
+            for action, doc in zip(lines[::2], lines[1::2]):
+                sent.append((json.loads(action), json.loads(doc)))
+            return {"items": [{"index": {"status": 201}}] * (len(lines) // 2)}
+
+        ingester = self.ingest(bulk)
+        self.assertEqual(3, ingester.indexed_count)
+        self.assertEqual(["1", "2", "3"], sorted(action["index"]["_id"] for action, _ in sent))
+        doc = [doc for _, doc in sent if doc["eventID"] == "2"][0]
+        self.assertNotIn("endpoint", doc["responseElements"])
+        self.assertTrue(self.is_completed("a.json.gz"))
+        self.assertTrue(self.is_completed("b.json.gz"))
+
+        # Running again skips the files already loaded
+        bulk = MagicMock()
+        self.ingest(bulk)
+        self.assertEqual(0, bulk.call_count)
+
+    def test_changed_file_loaded_again(self):
+        """Test a file that has changed since it was checkpointed is loaded again"""
+        self.ingest(lambda body: {"items": [{"index": {"status": 201}}] * (len(body.splitlines()) // 2)})
+        write_log_file(os.path.join(self.logs, "b.json.gz"), [{"eventID": "3"}, {"eventID": "4"}])
+        self.assertFalse(self.is_completed("b.json.gz"))
+        self.assertTrue(self.is_completed("a.json.gz"))
+
+    def test_rejected_documents_retried(self):
+        """Test documents rejected as the cluster is overloaded are sent again"""
+        rejected = set()
+
+        def bulk(body):
+            """Reject each document the first time it is seen"""
+            items = []
+            for action in body.splitlines()[::2]:
+                event_id = json.loads(action)["index"]["_id"]
+                items.append({"index": {"status": 201 if event_id in rejected else 429}})
+                rejected.add(event_id)
+            return {"items": items}
+
+        ingester = self.ingest(bulk)
+        self.assertEqual(3, ingester.indexed_count)
+        self.assertTrue(self.is_completed("a.json.gz"))
+
+    def test_rejected_requests_retried(self):
+        """Test _bulk requests rejected as the cluster is overloaded are sent again"""
+        responses = [TransportError(429, "es_rejected_execution_exception")]
+
+        def bulk(body):
+            if responses:
+                raise responses.pop()
+            return {"items": [{"index": {"status": 201}}] * (len(body.splitlines()) // 2)}
+
+        self.assertEqual(3, self.ingest(bulk).indexed_count)
+
+    def test_retries_exhausted(self):
+        """Test giving up on documents that are rejected every time, without checkpointing their files"""
+        def bulk(body):
+            return {"items": [{"index": {"status": 429}}] * (len(body.splitlines()) // 2)}
+
+        with self.assertRaises(Exception) as context:
+            self.ingest(bulk)
+        self.assertIn("after {} retries".format(MAX_RETRIES), str(context.exception))
+        self.assertFalse(self.is_completed("a.json.gz"))
+        self.assertFalse(self.is_completed("b.json.gz"))
+
+    def test_request_failed(self):
+        """Test a _bulk request that fails other than for overload isn't retried"""
+        bulk = MagicMock(side_effect=TransportError(400, "illegal_argument_exception"))
+        with self.assertRaises(TransportError):
+            self.ingest(bulk)
+        self.assertEqual(1, bulk.call_count)
+
+    def test_failed_documents(self):
+        """Test a file with a document that fails to index is counted, and not checkpointed"""
+        def bulk(body):
+            """Fail the second document with a mapping error"""
+            items = []
+            for action in body.splitlines()[::2]:
+                if json.loads(action)["index"]["_id"] == "2":
+                    items.append({"index": {"status": 400, "error": {"type": "mapper_parsing_exception"}}})
+                else:
+                    items.append({"index": {"status": 201}})
+            return {"items": items}
+
+        with self.assertLogs(level="WARNING") as logs_output:
+            ingester = self.ingest(bulk)
+
+        self.assertEqual(2, ingester.indexed_count)
+        self.assertEqual(1, ingester.failed_count)
+        self.assertIn("mapper_parsing_exception", logs_output.output[0])
+        self.assertFalse(self.is_completed("a.json.gz"))
+        self.assertTrue(self.is_completed("b.json.gz"))
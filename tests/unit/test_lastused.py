@@ -0,0 +1,111 @@
+"""
+Copyright 2018 Duo Security
+
+Redistribution and use in source and binary forms, with or without modification, are permitted provided that the
+following conditions are met:
+
+1. Redistributions of source code must retain the above copyright notice, this list of conditions and the following
+disclaimer.
+
+2. Redistributions in binary form must reproduce the above copyright notice, this list of conditions and the
+following disclaimer in the documentation and/or other materials provided with the distribution.
+
+3. Neither the name of the copyright holder nor the names of its contributors may be used to endorse or promote
+products derived from this software without specific prior written permission.
+
+THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES,
+INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL,
+SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY,
+WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE
+USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+---------------------------------------------------------------------------
+"""
+
+import os
+import tempfile
+import unittest
+from unittest.mock import MagicMock
+
+from cloudtracker.datasources.lastused import LastUsed
+from cloudtracker.lastused import LastUsedIndex
+
+ALICE = "arn:aws:iam::111111111111:user/alice"
+ADMIN = "arn:aws:iam::111111111111:role/admin"
+
+ROWS = [
+    ("users", ALICE, "alice", "s3.amazonaws.com", "CreateBucket", "2018-03-01T01:00:00Z", "2018-05-01T01:00:00Z"),
+    ("users", ALICE, "alice", "s3.amazonaws.com", "ListBuckets", "2018-06-20T01:00:00Z", "2018-06-21T01:00:00Z"),
+    ("roles", ADMIN, "admin", "ec2.amazonaws.com", "DescribeInstances", "2018-01-05T01:00:00Z", "2018-01-06T01:00:00Z"),
+]
+
+
+def get_rows(first_day, last_day):
+    return [row for row in ROWS if first_day <= row[5][:10] and row[6][:10] <= last_day]
+
+
+class TestLastUsed(unittest.TestCase):
+    """Test class for the index of when API calls were last used"""
+
+    def test_update(self):
+        """The index is only extended with the days it doesn't cover, and is saved"""
+        get_rows_mock = MagicMock(side_effect=get_rows)
+        index = LastUsedIndex()
+        self.assertTrue(index.update(get_rows_mock, "2018-02-01", "2018-06-30"))
+        get_rows_mock.assert_called_once_with("2018-02-01", "2018-06-30")
+
+        # A range within the one covered needs no query, and an earlier one only the days before it
+        get_rows_mock.reset_mock()
+        self.assertFalse(index.update(get_rows_mock, "2018-04-01", "2018-05-31"))
+        get_rows_mock.assert_not_called()
+        self.assertTrue(index.update(get_rows_mock, "2018-01-01", "2018-06-30"))
+        get_rows_mock.assert_called_once_with("2018-01-01", "2018-01-31")
+        self.assertEqual(("2018-01-01", "2018-06-30"), (index.start, index.end))
+
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "index.json")
+            index.save(path)
+            index = LastUsedIndex.load(path)
+        self.assertEqual(
+            {"s3:createbucket": "2018-05-01T01:00:00Z", "s3:listbuckets": "2018-06-21T01:00:00Z"},
+            index.get_last_used("users", ALICE),
+        )
+
+    def test_date_ranges(self):
+        """Date ranges are answered from the first and last use, unless they fall between them"""
+        index = LastUsedIndex()
+        index.update(get_rows, "2018-01-01", "2018-06-30")
+
+        self.assertEqual(
+            {"s3:listbuckets": True},
+            index.get_event_names("users", ALICE, "2018-06-01", "2018-06-30"),
+        )
+        self.assertEqual({}, index.get_event_names("users", ALICE, "2018-01-01", "2018-02-28"))
+        self.assertEqual({"admin": True}, index.get_names("roles", "2018-01-01", "2018-02-28"))
+        # CreateBucket was used before and after April, but maybe not in it
+        self.assertIsNone(index.get_event_names("users", ALICE, "2018-04-01", "2018-04-30"))
+        self.assertIsNone(index.get_names("users", "2018-04-01", "2018-04-30"))
+        # The index doesn't cover the previous year
+        self.assertIsNone(index.get_event_names("users", ALICE, "2017-06-01", "2018-06-30"))
+
+    def test_datasource_fallback(self):
+        """Only the principals the index can't answer for are queried"""
+        index = LastUsedIndex()
+        index.update(get_rows, "2018-01-01", "2018-06-30")
+        datasource = MagicMock()
+        datasource.get_performed_event_names_by_users.return_value = {
+            ALICE: {"s3:createbucket": True}
+        }
+        bob = "arn:aws:iam::111111111111:user/bob"
+
+        last_used = LastUsed(datasource, index, "2018-04-01", "2018-04-30")
+        self.assertEqual(
+            {ALICE: {"s3:createbucket": True}, bob: {}},
+            last_used.get_performed_event_names_by_users(None, [{"Arn": ALICE}, {"Arn": bob}]),
+        )
+        datasource.get_performed_event_names_by_users.assert_called_once_with(
+            datasource.get_search_query.return_value, [{"Arn": ALICE}]
+        )
+        self.assertEqual({}, last_used.get_performed_roles())
+        datasource.get_performed_roles.assert_not_called()
@@ -0,0 +1,262 @@
+"""
+Copyright 2018 Duo Security
+
+Redistribution and use in source and binary forms, with or without modification, are permitted provided that the
+following conditions are met:
+
+1. Redistributions of source code must retain the above copyright notice, this list of conditions and the following
+disclaimer.
+
+2. Redistributions in binary form must reproduce the above copyright notice, this list of conditions and the
+following disclaimer in the documentation and/or other materials provided with the distribution.
+
+3. Neither the name of the copyright holder nor the names of its contributors may be used to endorse or promote
+products derived from this software without specific prior written permission.
+
+THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES,
+INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL,
+SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY,
+WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE
+USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+---------------------------------------------------------------------------
+"""
+
+import gzip
+import json
+import os
+import tempfile
+import unittest
+from unittest.mock import patch
+
+from cloudtracker.datasources.local import LocalFiles, scan_log_file
+
+
+def write_log_file(root, region, day, name, records):
+    """Write records as a gzipped CloudTrail log file, where CloudTrail would deliver it"""
+    path = os.path.join(
+        root, "AWSLogs", "111111111111", "CloudTrail", region, *day.split("-")
+    )
+    os.makedirs(path, exist_ok=True)
+    with gzip.open(os.path.join(path, name), "wt") as f:
+        json.dump({"Records": records}, f)
+
+
+ALICE = "arn:aws:iam::111111111111:user/alice"
+ADMIN = "arn:aws:iam::111111111111:role/admin"
+
+
+def user_event(event_source, event_name, event_time, **extra):
+    record = {
+        "eventTime": event_time,
+        "eventSource": event_source,
+        "eventName": event_name,
+        "userIdentity": {"type": "IAMUser", "arn": ALICE, "userName": "alice"},
+    }
+    record.update(extra)
+    return record
+
+
+def role_event(event_source, event_name, event_time, access_key):
+    return {
+        "eventTime": event_time,
+        "eventSource": event_source,
+        "eventName": event_name,
+        "userIdentity": {
+            "type": "AssumedRole",
+            "arn": "arn:aws:sts::111111111111:assumed-role/admin/alice",
+            "accessKeyId": access_key,
+            "sessionContext": {"sessionIssuer": {"arn": ADMIN, "userName": "admin"}},
+        },
+    }
+
+
+class TestLocalFiles(unittest.TestCase):
+    """Test class for the local files datasource"""
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        root = self.tmp.name
+        write_log_file(
+            root,
+            "us-east-1",
+            "2018-03-01",
+            "a.json.gz",
+            [
+                user_event("s3.amazonaws.com", "CreateBucket", "2018-03-01T01:00:00Z"),
+                user_event(
+                    "s3.amazonaws.com", "DeleteBucket", "2018-03-01T02:00:00Z", errorCode="AccessDenied"
+                ),
+                user_event(
+                    "sts.amazonaws.com",
+                    "AssumeRole",
+                    "2018-03-01T03:00:00Z",
+                    requestParameters={"roleArn": ADMIN},
+                    responseElements={"credentials": {"accessKeyId": "ASIA1"}},
+                ),
+                role_event("iam.amazonaws.com", "CreateUser", "2018-03-01T04:00:00Z", "ASIA1"),
+                role_event("iam.amazonaws.com", "DeleteUser", "2018-03-01T04:00:00Z", "ASIA2"),
+            ],
+        )
+        # Outside of the date range
+        write_log_file(
+            root,
+            "us-east-1",
+            "2017-03-01",
+            "b.json.gz",
+            [user_event("ec2.amazonaws.com", "RunInstances", "2017-03-01T01:00:00Z")],
+        )
+        # Outside of the configured regions
+        write_log_file(
+            root,
+            "eu-west-1",
+            "2018-03-01",
+            "c.json.gz",
+            [user_event("ec2.amazonaws.com", "StopInstances", "2018-03-01T01:00:00Z")],
+        )
+        self.datasource = LocalFiles(
+            {"path": root, "regions": ["us-east-1"], "workers": 2},
+            {"id": 111111111111},
+            "2018-01-01",
+            "2018-12-31",
+        )
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_log_files_are_pruned(self):
+        """Test only log files within the date range and regions are read"""
+        self.assertEqual(1, len(self.datasource.log_files))
+
+    def test_get_performed(self):
+        """Test finding the actors, and what they did"""
+        self.assertEqual({"alice": True}, self.datasource.get_performed_users())
+        self.assertEqual({"admin": True}, self.datasource.get_performed_roles())
+        self.assertEqual(
+            {"s3:createbucket": True, "sts:assumerole": True},
+            self.datasource.get_performed_event_names_by_user(None, {"Arn": ALICE}),
+        )
+        self.assertEqual(
+            {"iam:createuser": True, "iam:deleteuser": True},
+            self.datasource.get_performed_event_names_by_role(None, {"Arn": ADMIN}),
+        )
+
+    def test_get_performed_event_names_by_user_in_role(self):
+        """Test only the sessions the user started in the role are included"""
+        self.assertEqual(
+            {"iam:createuser": True},
+            self.datasource.get_performed_event_names_by_user_in_role(
+                None, {"Arn": ALICE}, {"Arn": ADMIN}
+            ),
+        )
+
+    def test_index_skips_files(self):
+        """Test a file whose index doesn't contain the principal isn't opened"""
+        log_file = self.datasource.log_files[0]
+        index_path = self.datasource.index_paths[0]
+        scan = ("event", "userIdentity.arn", frozenset([ALICE]))
+
+        # The index is written the first time the file is read
+        scan_log_file(log_file, "2018-01-01", "2018-12-31", scan, index_path)
+        with open(index_path) as f:
+            self.assertEqual(
+                [
+                    "ASIA1",
+                    "ASIA2",
+                    ADMIN,
+                    ALICE,
+                    "arn:aws:sts::111111111111:assumed-role/admin/alice",
+                ],
+                f.read().splitlines(),
+            )
+
+        with patch("cloudtracker.datasources.local.read_log_file") as read_log_file:
+            read_log_file.return_value = []
+            scan_log_file(log_file, "2018-01-01", "2018-12-31", scan, index_path)
+            self.assertEqual(1, read_log_file.call_count)
+
+            unknown = ("event", "userIdentity.arn", frozenset(["arn:aws:iam::111111111111:user/bob"]))
+            self.assertEqual({}, scan_log_file(log_file, "2018-01-01", "2018-12-31", unknown, index_path))
+            self.assertEqual(1, read_log_file.call_count)
+
+    def test_stale_index(self):
+        """Test an index older than its log file is ignored and written again"""
+        log_file = self.datasource.log_files[0]
+        index_path = self.datasource.index_paths[0]
+        scan = ("event", "userIdentity.arn", frozenset([ALICE]))
+
+        os.makedirs(os.path.dirname(index_path), exist_ok=True)
+        with open(index_path, "w") as f:
+            f.write("arn:aws:iam::111111111111:user/bob")
+        mtime = os.path.getmtime(log_file)
+        os.utime(index_path, (mtime - 60, mtime - 60))
+
+        self.assertNotEqual({}, scan_log_file(log_file, "2018-01-01", "2018-12-31", scan, index_path))
+        with open(index_path) as f:
+            self.assertIn(ALICE, f.read().splitlines())
+
+    def test_get_event_frame(self):
+        """Test looking up many principals at once reads the files into an EventFrame"""
+        users = [{"Arn": ALICE}] + [
+            {"Arn": "arn:aws:iam::111111111111:user/user{}".format(i)} for i in range(40)
+        ]
+        performed = self.datasource.get_performed_event_names_by_users(None, users)
+        self.assertEqual(["userIdentity.arn"], list(self.datasource.frames))
+        self.assertEqual({"s3:createbucket": True, "sts:assumerole": True}, performed[ALICE])
+        self.assertEqual({}, performed[users[1]["Arn"]])
+        self.assertEqual(
+            {"s3:createbucket": 1, "sts:assumerole": 1},
+            self.datasource.frames["userIdentity.arn"].get_action_counts(ALICE),
+        )
+
+        # Once read, the frame answers lookups of fewer principals by the same field
+        with patch("cloudtracker.datasources.local.scan_log_file") as scan:
+            self.assertEqual(
+                {"s3:createbucket": True, "sts:assumerole": True},
+                self.datasource.get_performed_event_names_by_user(None, {"Arn": ALICE}),
+            )
+        scan.assert_not_called()
+
+    def test_get_event_frame_by_roles(self):
+        """Test an EventFrame is only given for a report when reading one is worthwhile"""
+        self.assertIsNone(self.datasource.get_event_frame_by_roles(None, [{"Arn": ADMIN}]))
+
+        roles = [{"Arn": ADMIN}] + [
+            {"Arn": "arn:aws:iam::111111111111:role/role{}".format(i)} for i in range(40)
+        ]
+        frame = self.datasource.get_event_frame_by_roles(None, roles)
+        self.assertEqual({"iam:createuser": 1, "iam:deleteuser": 1}, frame.get_action_counts(ADMIN))
+        self.assertIs(frame, self.datasource.get_event_frame_by_roles(None, [{"Arn": ADMIN}]))
+
+    def test_event_frame_matches_scan(self):
+        """Test the EventFrame finds the same events as scanning, for each field looked up by"""
+        federated_event = user_event("s3.amazonaws.com", "ListBuckets", "2018-03-02T01:00:00Z")
+        federated_event["userIdentity"] = {
+            "type": "FederatedUser",
+            "arn": "arn:aws:sts::111111111111:federated-user/bob",
+            "sessionContext": {"sessionIssuer": {"type": "IAMUser", "arn": ALICE, "userName": "alice"}},
+        }
+        write_log_file(self.tmp.name, "us-east-1", "2018-03-02", "d.json.gz", [federated_event])
+
+        users = [{"Arn": ALICE}, {"Arn": "arn:aws:sts::111111111111:federated-user/bob"}]
+        roles = [{"Arn": ADMIN}, {"Arn": ALICE}]
+        results = []
+        for frame_min_principals in (1, 1000):
+            datasource = LocalFiles(
+                {"path": self.tmp.name, "regions": ["us-east-1"], "workers": 2},
+                {"id": 111111111111},
+                "2018-01-01",
+                "2018-12-31",
+            )
+            with patch("cloudtracker.datasources.local.FRAME_MIN_PRINCIPALS", frame_min_principals):
+                results.append((
+                    datasource.get_performed_event_names_by_users(None, users),
+                    datasource.get_performed_event_names_by_roles(None, roles),
+                ))
+            self.assertEqual(2 if frame_min_principals == 1 else 0, len(datasource.frames))
+
+        self.assertEqual(results[1], results[0])
+        by_users, by_roles = results[0]
+        self.assertEqual({"s3:createbucket": True, "sts:assumerole": True}, by_users[ALICE])
+        self.assertEqual({"s3:listbuckets": True}, by_roles[ALICE])
@@ -0,0 +1,110 @@
+"""
+Copyright 2018 Duo Security
+
+Redistribution and use in source and binary forms, with or without modification, are permitted provided that the
+following conditions are met:
+
+1. Redistributions of source code must retain the above copyright notice, this list of conditions and the following
+disclaimer.
+
+2. Redistributions in binary form must reproduce the above copyright notice, this list of conditions and the
+following disclaimer in the documentation and/or other materials provided with the distribution.
+
+3. Neither the name of the copyright holder nor the names of its contributors may be used to endorse or promote
+products derived from this software without specific prior written permission.
+
+THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES,
+INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL,
+SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY,
+WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE
+USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+---------------------------------------------------------------------------
+"""
+
+import csv
+import io
+import json
+import unittest
+
+from cloudtracker import Classification
+from cloudtracker.output import DiffWriter, get_writer
+
+ADMIN = "arn:aws:iam::111111111111:role/admin"
+
+ACTIONS = {
+    "s3:createbucket": Classification.PERFORMED_AND_ALLOWED,
+    "s3:listbuckets": Classification.PERFORMED_AND_ALLOWED,
+    "iam:createuser": Classification.PERFORMED_BUT_NOT_ALLOWED,
+    "s3:deletebucket": Classification.ALLOWED_BUT_NOT_PERFORMED,
+    "s3:getobject": Classification.ALLOWED_BUT_NOT_KNOWN_IF_PERFORMED,
+}
+
+
+class TestDiffWriters(unittest.TestCase):
+    """Test class for the DiffWriters"""
+
+    def write(self, output_format, printfilter):
+        f = io.StringIO()
+        writer = get_writer(output_format, f)
+        writer.write_actions("demo", ADMIN, ACTIONS, printfilter)
+        writer.write_actors("demo", {
+            "alice": Classification.PERFORMED_AND_ALLOWED,
+            "bob": Classification.PERFORMED_BUT_NOT_ALLOWED,
+            "charlie": Classification.ALLOWED_BUT_NOT_PERFORMED,
+        })
+        writer.close()
+        return f.getvalue()
+
+    def test_json(self):
+        """Test the records are a JSON array, filtered as print_diff would"""
+        records = json.loads(self.write("json", {"show_used": False, "show_unknown": False}))
+        self.assertEqual(
+            ["iam:createuser", "s3:createbucket", "s3:deletebucket", "s3:listbuckets", "alice", "charlie"],
+            [record["name"] for record in records],
+        )
+        self.assertEqual(
+            {
+                "account": "demo",
+                "principal": ADMIN,
+                "assumed_role": None,
+                "kind": "action",
+                "name": "s3:deletebucket",
+                "classification": "ALLOWED_BUT_NOT_PERFORMED",
+                "code": 3,
+                "symbol": "-",
+            },
+            records[2],
+        )
+
+        # With nothing to write, the array is still valid JSON
+        f = io.StringIO()
+        get_writer("json", f).close()
+        self.assertEqual([], json.loads(f.getvalue()))
+
+    def test_ndjson(self):
+        """Test each record is a line of JSON"""
+        lines = self.write("ndjson", {"show_benign": False}).splitlines()
+        records = [json.loads(line) for line in lines]
+        self.assertEqual(
+            ["iam:createuser", "s3:createbucket", "alice", "charlie"],
+            [record["name"] for record in records],
+        )
+        self.assertEqual("actor", records[-1]["kind"])
+
+    def test_csv(self):
+        """Test the records are CSV with a header"""
+        rows = list(csv.DictReader(io.StringIO(self.write("csv", {"show_used": False}))))
+        self.assertEqual(7, len(rows))
+        self.assertEqual("s3:getobject", rows[3]["name"])
+        self.assertEqual("?", rows[3]["symbol"])
+        self.assertEqual("4", rows[3]["code"])
+
+    def test_write_record_required(self):
+        """Test a writer that doesn't format records can't be created"""
+        class UnformattedWriter(DiffWriter):
+            pass
+
+        with self.assertRaises(TypeError):
+            UnformattedWriter(io.StringIO())
@@ -0,0 +1,109 @@
+"""
+Copyright 2018 Duo Security
+
+Redistribution and use in source and binary forms, with or without modification, are permitted provided that the
+following conditions are met:
+
+1. Redistributions of source code must retain the above copyright notice, this list of conditions and the following
+disclaimer.
+
+2. Redistributions in binary form must reproduce the above copyright notice, this list of conditions and the
+following disclaimer in the documentation and/or other materials provided with the distribution.
+
+3. Neither the name of the copyright holder nor the names of its contributors may be used to endorse or promote
+products derived from this software without specific prior written permission.
+
+THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES,
+INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL,
+SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY,
+WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE
+USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+---------------------------------------------------------------------------
+"""
+
+import io
+import json
+import os
+import tempfile
+import unittest
+from argparse import Namespace
+from unittest.mock import patch
+
+from cloudtracker import Privileges, run
+from cloudtracker.profiling import Profiler, profiler
+
+
+class TestProfiler(unittest.TestCase):
+    """Test class for the Profiler"""
+
+    def test_disabled(self):
+        """Nothing is recorded until the profiler is enabled"""
+        p = Profiler()
+        with p.span("setup"):
+            p.count("queries")
+        self.assertEqual({}, p.get_summary()["phases"])
+        self.assertEqual({}, p.get_summary()["counters"])
+
+    def test_summary(self):
+        """Spans of the same phase are added together"""
+        p = Profiler()
+        p.enable()
+        for _ in range(2):
+            with p.span("query"):
+                p.count("queries")
+        p.count("rows", 10)
+
+        summary = json.load(io.StringIO(self.write(p, "json")))
+        self.assertEqual(2, summary["phases"]["query"]["calls"])
+        self.assertEqual({"queries": 2, "rows": 10}, summary["counters"])
+
+    def test_chrome_trace(self):
+        """Spans are complete events, and the counters a counter event"""
+        p = Profiler()
+        p.enable()
+        with p.span("athena_wait", query="q"):
+            p.count("athena_polls", 3)
+
+        trace = json.loads(self.write(p, "chrome"))
+        events = {event["ph"]: event for event in trace["traceEvents"]}
+        self.assertEqual("athena_wait", events["X"]["name"])
+        self.assertEqual({"query": "q"}, events["X"]["args"])
+        self.assertGreaterEqual(events["X"]["dur"], 0)
+        self.assertEqual({"athena_polls": 3}, events["C"]["args"])
+        self.assertEqual("thread_name", events["M"]["name"])
+
+    def test_regex_matches(self):
+        """Expanding a statement counts the regular expressions it matched"""
+        profiler.enable()
+        try:
+            Privileges({"s3:getobject": True, "s3:putobject": True}).get_actions_from_statement(
+                {"Effect": "Allow", "Action": ["s3:Get*", "s3:Put*"], "Resource": "*"}
+            )
+            self.assertEqual(4, profiler.get_summary()["counters"]["regex_matches"])
+        finally:
+            profiler.disable()
+
+    def test_failed_run(self):
+        """The profile of a run that fails is still written, and the profiler disabled"""
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            path = os.path.join(tmp_dir, "profile.json")
+            args = Namespace(profile=path, profile_format="json")
+
+            def run_command(*_):
+                with profiler.span("run_account"):
+                    raise RuntimeError("Query failed")
+
+            with patch("cloudtracker.run_command", side_effect=run_command):
+                with self.assertRaises(RuntimeError):
+                    run(args, {}, "2018-01-01", "2018-12-31")
+
+            self.assertFalse(profiler.enabled)
+            with open(path) as f:
+                self.assertIn("run_account", f.read())
+
+    def write(self, p, format):
+        f = io.StringIO()
+        p.write(f, format)
+        return f.getvalue()
@@ -0,0 +1,128 @@
+"""
+Copyright 2018 Duo Security
+
+Redistribution and use in source and binary forms, with or without modification, are permitted provided that the
+following conditions are met:
+
+1. Redistributions of source code must retain the above copyright notice, this list of conditions and the following
+disclaimer.
+
+2. Redistributions in binary form must reproduce the above copyright notice, this list of conditions and the
+following disclaimer in the documentation and/or other materials provided with the distribution.
+
+3. Neither the name of the copyright holder nor the names of its contributors may be used to endorse or promote
+products derived from this software without specific prior written permission.
+
+THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES,
+INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL,
+SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY,
+WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE
+USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+---------------------------------------------------------------------------
+"""
+
+import io
+import unittest
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+ALICE = "arn:aws:iam::111111111111:user/alice"
+BOB = "arn:aws:iam::222222222222:user/bob"
+
+
+@unittest.skipIf(numpy is None, "NumPy is not installed")
+class TestUsageMatrix(unittest.TestCase):
+    """Test class for UsageMatrix"""
+
+    def get_usage(self):
+        from cloudtracker.report import UsageMatrix
+
+        usage = UsageMatrix({"s3:getobject": True, "s3:putobject": True, "ec2:runinstances": True})
+        usage.add_principal(
+            ALICE,
+            ["s3:getobject", "s3:putobject", "s3:listobjects"],
+            {"s3:getobject": True, "ec2:runinstances": True, "sts:getcalleridentity": True},
+        )
+        usage.add_principal(BOB, ["ec2:runinstances"], {})
+        usage.build()
+        return usage
+
+    def test_counts(self):
+        """The categories match those shown by print_diff"""
+        counts = self.get_usage().get_counts()
+        self.assertEqual([3, 1], counts["allowed"].tolist())
+        self.assertEqual([1, 0], counts["used"].tolist())
+        self.assertEqual([1, 1], counts["unused"].tolist())
+        self.assertEqual([1, 0], counts["unknown"].tolist())
+        self.assertEqual([1, 0], counts["not_allowed"].tolist())
+
+    def test_write_report(self):
+        """The report has a row for each principal, and each service it has API calls in"""
+        f = io.StringIO()
+        self.get_usage().write_report(f)
+        self.assertEqual(
+            [
+                "account,principal,service,allowed,used,unused,unknown,not_allowed",
+                "111111111111,{},*,3,1,1,1,1".format(ALICE),
+                "111111111111,{},ec2,0,0,0,0,1".format(ALICE),
+                "111111111111,{},s3,3,1,1,1,0".format(ALICE),
+                "222222222222,{},*,1,0,1,0,0".format(BOB),
+                "222222222222,{},ec2,1,0,1,0,0".format(BOB),
+            ],
+            f.getvalue().splitlines(),
+        )
+
+    def test_event_frame(self):
+        """API calls performed given as an EventFrame are counted as those given as dicts"""
+        from cloudtracker.events import EventFrame
+        from cloudtracker.report import UsageMatrix
+
+        frame = EventFrame("2018-01-01")
+        for action in ("s3:getobject", "ec2:runinstances", "sts:getcalleridentity"):
+            frame.add(ALICE, action, "us-east-1", "2018-01-02", 2)
+            frame.add(ALICE, action, "us-west-2", "2018-01-03")
+        # Principals not in the matrix are left out
+        frame.add("arn:aws:iam::111111111111:user/carol", "iam:createuser", "us-east-1", "2018-01-02")
+
+        usage = UsageMatrix({"s3:getobject": True, "s3:putobject": True, "ec2:runinstances": True})
+        usage.add_principal(ALICE, ["s3:getobject", "s3:putobject", "s3:listobjects"], frame=frame)
+        usage.add_principal(BOB, ["ec2:runinstances"], frame=frame)
+        usage.build()
+
+        expected = self.get_usage()
+        self.assertEqual(expected.actions, usage.actions)
+        self.assertEqual(expected.performed.tolist(), usage.performed.tolist())
+
+    def test_renamed_actions(self):
+        """Actions CloudTrail records under another name are counted as classify_actions has them"""
+        from cloudtracker import Classification, classify_actions
+        from cloudtracker.report import UsageMatrix
+
+        recorded = {"s3:listallmybuckets": True, "s3:getbucketaccesscontrolpolicy": True}
+        allowed = ["s3:listallmybuckets", "s3:getbucketaccesscontrolpolicy"]
+        performed = {"s3:listbuckets": True}
+        usage = UsageMatrix(recorded)
+        usage.add_principal(ALICE, allowed, performed)
+        usage.build()
+
+        classified = classify_actions(performed, allowed, lambda action: action in recorded)
+        counts = usage.get_counts()
+        self.assertEqual(
+            [list(classified.values()).count(Classification.PERFORMED_AND_ALLOWED)],
+            counts["used"].tolist(),
+        )
+        self.assertEqual(
+            [list(classified.values()).count(Classification.ALLOWED_BUT_NOT_PERFORMED)],
+            counts["unused"].tolist(),
+        )
+        self.assertEqual(
+            [list(classified.values()).count(Classification.PERFORMED_BUT_NOT_ALLOWED)],
+            counts["not_allowed"].tolist(),
+        )
+        self.assertEqual([1, 1, 0], [counts[c][0] for c in ("used", "unused", "not_allowed")])
+
@@ -0,0 +1,130 @@
+"""
+Copyright 2018 Duo Security
+
+Redistribution and use in source and binary forms, with or without modification, are permitted provided that the
+following conditions are met:
+
+1. Redistributions of source code must retain the above copyright notice, this list of conditions and the following
+disclaimer.
+
+2. Redistributions in binary form must reproduce the above copyright notice, this list of conditions and the
+following disclaimer in the documentation and/or other materials provided with the distribution.
+
+3. Neither the name of the copyright holder nor the names of its contributors may be used to endorse or promote
+products derived from this software without specific prior written permission.
+
+THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES,
+INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL,
+SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY,
+WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE
+USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+---------------------------------------------------------------------------
+"""
+
+import copy
+import os
+import tempfile
+import unittest
+
+from cloudtracker.snapshots import IamSnapshot
+
+ALICE = "arn:aws:iam::111111111111:user/alice"
+BOB = "arn:aws:iam::111111111111:user/bob"
+ADMIN = "arn:aws:iam::111111111111:role/admin"
+READ_ONLY = "arn:aws:iam::aws:policy/ReadOnlyAccess"
+
+ACCOUNT_IAM = {
+    "UserDetailList": [
+        {"Arn": ALICE, "UserName": "alice", "GroupList": ["devs"],
+         "AttachedManagedPolicies": [], "UserPolicyList": []},
+        {"Arn": BOB, "UserName": "bob", "GroupList": [],
+         "AttachedManagedPolicies": [], "UserPolicyList": []},
+    ],
+    "GroupDetailList": [
+        {"GroupName": "devs", "AttachedManagedPolicies": [], "GroupPolicyList": []},
+    ],
+    "RoleDetailList": [
+        {"Arn": ADMIN, "RoleName": "admin", "RolePolicyList": [],
+         "AttachedManagedPolicies": [{"PolicyArn": READ_ONLY}]},
+    ],
+    "Policies": [
+        {"Arn": READ_ONLY, "PolicyVersionList": [
+            {"IsDefaultVersion": True, "Document": {"Statement": []}}]},
+    ],
+}
+
+
+class TestIamSnapshot(unittest.TestCase):
+    """Test class for IamSnapshot"""
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmp_dir.name, "111111111111.json")
+        self.account_iam = copy.deepcopy(ACCOUNT_IAM)
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def get_computed(self, version="v1"):
+        """Return the ARNs whose allowed actions had to be worked out"""
+        computed = []
+
+        def get_allowed_actions(actor_iam):
+            computed.append(actor_iam["Arn"])
+            return ["s3:getobject"]
+
+        snapshot = IamSnapshot(self.path, version)
+        snapshot.update(self.account_iam)
+        for actor_iam in self.account_iam["UserDetailList"] + self.account_iam["RoleDetailList"]:
+            self.assertEqual(["s3:getobject"], snapshot.get_allowed_actions(actor_iam, get_allowed_actions))
+        snapshot.save()
+        return sorted(computed)
+
+    def test_first_run(self):
+        """Without a snapshot, every principal is worked out"""
+        self.assertEqual([ADMIN, ALICE, BOB], self.get_computed())
+
+    def test_unchanged(self):
+        """Nothing is worked out again if the IAM data hasn't changed"""
+        self.get_computed()
+        self.assertEqual([], self.get_computed())
+
+    def test_group_changed(self):
+        """A change to a group affects its members"""
+        self.get_computed()
+        self.account_iam["GroupDetailList"][0]["GroupPolicyList"].append(
+            {"PolicyName": "s3", "PolicyDocument": {"Statement": []}})
+        self.assertEqual([ALICE], self.get_computed())
+
+    def test_policy_version_changed(self):
+        """A new default version of a managed policy affects those it is attached to"""
+        self.get_computed()
+        self.account_iam["Policies"][0]["PolicyVersionList"][0]["Document"] = {"Statement": [{}]}
+        self.assertEqual([ADMIN], self.get_computed())
+
+    def test_principal_changed(self):
+        """A change to the principal itself affects only that principal"""
+        self.get_computed()
+        self.account_iam["UserDetailList"][1]["GroupList"].append("devs")
+        self.assertEqual([BOB], self.get_computed())
+
+    def test_principal_removed(self):
+        """Principals that no longer exist are dropped from the snapshot"""
+        self.get_computed()
+        del self.account_iam["UserDetailList"][1]
+        self.assertEqual([], self.get_computed())
+        self.assertNotIn(BOB, IamSnapshot(self.path, "v1").allowed)
+
+    def test_new_version(self):
+        """A new API list means everything is worked out again"""
+        self.get_computed()
+        self.assertEqual([ADMIN, ALICE, BOB], self.get_computed("v2"))
+
+    def test_unreadable_snapshot(self):
+        """A snapshot that can't be read is ignored"""
+        with open(self.path, "w") as f:
+            f.write("{")
+        with self.assertLogs(level="WARNING"):
+            self.assertEqual([ADMIN, ALICE, BOB], self.get_computed())
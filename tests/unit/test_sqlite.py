@@ -0,0 +1,140 @@
+"""
+Copyright 2018 Duo Security
+
+Redistribution and use in source and binary forms, with or without modification, are permitted provided that the
+following conditions are met:
+
+1. Redistributions of source code must retain the above copyright notice, this list of conditions and the following
+disclaimer.
+
+2. Redistributions in binary form must reproduce the above copyright notice, this list of conditions and the
+following disclaimer in the documentation and/or other materials provided with the distribution.
+
+3. Neither the name of the copyright holder nor the names of its contributors may be used to endorse or promote
+products derived from this software without specific prior written permission.
+
+THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES,
+INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL,
+SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY,
+WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE
+USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+---------------------------------------------------------------------------
+"""
+
+import gzip
+import json
+import os
+import tempfile
+import unittest
+
+from cloudtracker.datasources.sqlite import SQLite
+
+ALICE = "arn:aws:iam::111111111111:user/alice"
+ADMIN = "arn:aws:iam::111111111111:role/admin"
+
+
+def write_log_file(path, records):
+    """Write records as a gzipped CloudTrail log file"""
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with gzip.open(path, "wt") as f:
+        json.dump({"Records": records}, f)
+
+
+def event(event_source, event_name, event_time, principal):
+    record = {
+        "eventTime": event_time,
+        "eventSource": event_source,
+        "eventName": event_name,
+    }
+    if principal == ALICE:
+        record["userIdentity"] = {"type": "IAMUser", "arn": ALICE, "userName": "alice"}
+    else:
+        record["userIdentity"] = {
+            "type": "AssumedRole",
+            "sessionContext": {"sessionIssuer": {"arn": principal, "userName": "admin"}},
+        }
+    return record
+
+
+class TestSQLite(unittest.TestCase):
+    """Test class for the SQLite datasource"""
+
+    account = {"id": 111111111111}
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.config = {"path": os.path.join(self.tmp.name, "cloudtracker.db"), "workers": 2}
+        self.logs = os.path.join(self.tmp.name, "logs")
+        write_log_file(
+            os.path.join(self.logs, "a.json.gz"),
+            [
+                event("s3.amazonaws.com", "CreateBucket", "2018-03-01T01:00:00Z", ALICE),
+                event("s3.amazonaws.com", "CreateBucket", "2018-03-01T02:00:00Z", ALICE),
+                event("iam.amazonaws.com", "CreateUser", "2018-03-01T02:00:00Z", ADMIN),
+                dict(
+                    event("s3.amazonaws.com", "DeleteBucket", "2018-03-01T03:00:00Z", ALICE),
+                    errorCode="AccessDenied",
+                ),
+            ],
+        )
+        SQLite(self.config, None, None, None).ingest(self.logs)
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def get_datasource(self, start="2018-01-01", end="2018-12-31"):
+        return SQLite(self.config, self.account, start, end)
+
+    def get_usage(self):
+        """Return the number of rows in the usage table, and the calls they count"""
+        return list(self.get_datasource().db.execute("SELECT count(*), sum(count) FROM usage"))
+
+    def test_ingest(self):
+        """Test the successful calls are counted per principal, API call and day"""
+        self.assertEqual([(2, 3)], self.get_usage())
+
+    def test_ingest_new_files(self):
+        """Test only the files not ingested before are read on a later ingest"""
+        write_log_file(
+            os.path.join(self.logs, "b.json.gz"),
+            [event("ec2.amazonaws.com", "RunInstances", "2017-03-01T01:00:00Z", ALICE)],
+        )
+        SQLite(self.config, None, None, None).ingest(self.logs)
+        SQLite(self.config, None, None, None).ingest(self.logs)
+        self.assertEqual([(3, 4)], self.get_usage())
+
+    def test_get_performed(self):
+        """Test finding the actors, and what they did"""
+        datasource = self.get_datasource()
+        self.assertEqual({"alice": True}, datasource.get_performed_users())
+        self.assertEqual({"admin": True}, datasource.get_performed_roles())
+        self.assertEqual(
+            {"s3:createbucket": True},
+            datasource.get_performed_event_names_by_user(None, {"Arn": ALICE}),
+        )
+        self.assertEqual(
+            {"iam:createuser": True},
+            datasource.get_performed_event_names_by_role(None, {"Arn": ADMIN}),
+        )
+
+    def test_date_range(self):
+        """Test queries are limited to the date range"""
+        datasource = self.get_datasource("2018-03-02", "2018-12-31")
+        self.assertEqual({}, datasource.get_performed_users())
+        self.assertEqual({}, datasource.get_performed_event_names_by_user(None, {"Arn": ALICE}))
+
+    def test_missing_database(self):
+        """Test querying a database that hasn't been created exits"""
+        config = dict(self.config, path=os.path.join(self.tmp.name, "missing.db"))
+        with self.assertRaises(SystemExit):
+            SQLite(config, self.account, "2018-01-01", "2018-12-31")
+        self.assertFalse(os.path.exists(config["path"]))
+
+    def test_role_assumptions_not_supported(self):
+        """Test role assumptions can't be followed, as session keys aren't stored"""
+        with self.assertRaises(Exception):
+            self.get_datasource().get_performed_event_names_by_user_in_role(
+                None, {"Arn": ALICE}, {"Arn": ADMIN}
+            )
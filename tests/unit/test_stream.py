@@ -0,0 +1,207 @@
+"""
+Copyright 2018 Duo Security
+
+Redistribution and use in source and binary forms, with or without modification, are permitted provided that the
+following conditions are met:
+
+1. Redistributions of source code must retain the above copyright notice, this list of conditions and the following
+disclaimer.
+
+2. Redistributions in binary form must reproduce the above copyright notice, this list of conditions and the
+following disclaimer in the documentation and/or other materials provided with the distribution.
+
+3. Neither the name of the copyright holder nor the names of its contributors may be used to endorse or promote
+products derived from this software without specific prior written permission.
+
+THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES,
+INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL,
+SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY,
+WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE
+USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+---------------------------------------------------------------------------
+"""
+
+import json
+import os
+import tempfile
+import unittest
+
+from cloudtracker.datasources.stream import Stream
+from cloudtracker.stream import (
+    UsageTracker,
+    consume_lines,
+    find_new_log_files,
+    mark_log_file,
+    was_used,
+)
+
+ALICE = "arn:aws:iam::111111111111:user/alice"
+
+
+def alice_event(event_source, event_name, event_time, **extra):
+    record = {
+        "eventTime": event_time,
+        "eventSource": event_source,
+        "eventName": event_name,
+        "userIdentity": {"type": "IAMUser", "arn": ALICE, "userName": "alice"},
+    }
+    record.update(extra)
+    return record
+
+
+class TestStream(unittest.TestCase):
+    """Test class for tracking usage from a stream of records"""
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.state_path = os.path.join(self.tmp.name, "state.json")
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def consume(self, *records):
+        """Consume the records as lines of JSON, and load the state they were saved to"""
+        consume_lines(UsageTracker(), [json.dumps(record) for record in records], self.state_path, 60)
+        return UsageTracker.load(self.state_path)
+
+    def get_datasource(self, start="2018-01-01", end="2018-12-31"):
+        return Stream({"state": self.state_path}, {"id": 111111111111}, start, end)
+
+    def test_consume_lines(self):
+        """Test the days each API call is seen are kept, and failed calls are skipped"""
+        tracker = self.consume(
+            alice_event("s3.amazonaws.com", "CreateBucket", "2018-03-01T01:00:00Z"),
+            alice_event("s3.amazonaws.com", "CreateBucket", "2018-05-01T01:00:00Z"),
+            alice_event("s3.amazonaws.com", "DeleteBucket", "2018-05-01T01:00:00Z", errorCode="AccessDenied"),
+        )
+        self.assertEqual(2, tracker.record_count)
+        self.assertEqual(
+            {"s3:createbucket": ["2018-03-01", "2018-05-01", 1 | 1 << 61]},
+            tracker.principals["users"][ALICE]["actions"],
+        )
+
+    def test_consume_log_file_lines(self):
+        """Test a whole CloudTrail log file on one line is read, and lines that aren't JSON are skipped"""
+        lines = [
+            "not json",
+            "",
+            json.dumps({"Records": [alice_event("monitoring.amazonaws.com", "DescribeAlarms", "2017-01-01T01:00:00Z")]}),
+        ]
+        with self.assertLogs(level="WARNING"):
+            consume_lines(UsageTracker(), lines, self.state_path, 60)
+        tracker = UsageTracker.load(self.state_path)
+        self.assertEqual(1, tracker.record_count)
+        self.assertIn("cloudwatch:describealarms", tracker.principals["users"][ALICE]["actions"])
+
+    def test_query_state(self):
+        """Test the datasource answers from the saved state"""
+        self.consume(alice_event("s3.amazonaws.com", "CreateBucket", "2018-03-01T01:00:00Z"))
+        datasource = self.get_datasource()
+        self.assertEqual({"alice": True}, datasource.get_performed_users())
+        self.assertEqual({}, datasource.get_performed_roles())
+        self.assertEqual(
+            {"s3:createbucket": True},
+            datasource.get_performed_event_names_by_user(None, {"Arn": ALICE}),
+        )
+
+    def test_query_gap_window(self):
+        """Test a date range between days an API call was seen, but in none of them, finds nothing"""
+        self.consume(
+            alice_event("s3.amazonaws.com", "CreateBucket", "2018-03-01T01:00:00Z"),
+            alice_event("s3.amazonaws.com", "CreateBucket", "2018-05-01T01:00:00Z"),
+        )
+        datasource = self.get_datasource("2018-03-02", "2018-04-30")
+        self.assertEqual({}, datasource.get_performed_users())
+        self.assertEqual({}, datasource.get_performed_event_names_by_user(None, {"Arn": ALICE}))
+
+    def test_query_other_accounts(self):
+        """Test principals of other accounts in the state aren't reported"""
+        record = alice_event("s3.amazonaws.com", "CreateBucket", "2018-03-01T01:00:00Z")
+        record["userIdentity"] = dict(record["userIdentity"], arn="arn:aws:iam::222222222222:user/alice")
+        self.consume(record)
+        self.assertEqual({}, self.get_datasource().get_performed_users())
+
+    def test_missing_state(self):
+        """Test querying without a saved state exits"""
+        with self.assertRaises(SystemExit):
+            self.get_datasource()
+
+    def test_state_with_files(self):
+        """Test state listing every file read, from before the marks were kept, is converted to marks"""
+        tracker = UsageTracker({"files": ["/logs/01/a.json.gz", "/logs/01/b.json.gz", "/logs/02/a.json.gz"]})
+        self.assertEqual(
+            {"/logs/01": [None, ["a.json.gz", "b.json.gz"]], "/logs/02": [None, ["a.json.gz"]]},
+            tracker.marks,
+        )
+
+    def test_gap_in_use(self):
+        """A date range between the first and last day an API call was seen is only used if it was seen in it"""
+        tracker = UsageTracker()
+        for event_time in ("2018-05-01T01:00:00Z", "2018-03-01T01:00:00Z", "2018-03-02T01:00:00Z"):
+            tracker.add_record(alice_event("s3.amazonaws.com", "CreateBucket", event_time))
+        seen = tracker.principals["users"][ALICE]["actions"]["s3:createbucket"]
+        self.assertEqual(["2018-03-01", "2018-05-01"], seen[:2])
+
+        self.assertFalse(was_used(seen, "2018-03-03", "2018-04-30"))
+        self.assertTrue(was_used(seen, "2018-03-02", "2018-03-02"))
+        self.assertTrue(was_used(seen, "2018-04-01", "2018-12-31"))
+        self.assertFalse(was_used(seen, "2018-05-02", "2018-12-31"))
+
+    def test_state_without_days(self):
+        """State saved before the days were kept is answered from the first and last day"""
+        seen = ["2018-03-01", "2018-05-01"]
+        self.assertTrue(was_used(seen, "2018-04-01", "2018-04-30"))
+        self.assertFalse(was_used(seen, "2018-06-01", "2018-06-30"))
+
+    def test_find_new_log_files(self):
+        """Only files not yet read are found, and old days are neither walked nor remembered"""
+        with tempfile.TemporaryDirectory() as tmp:
+            region_dir = os.path.join(tmp, "AWSLogs", "111111111111", "CloudTrail", "us-east-1", "2018", "03")
+
+            def deliver(day, name):
+                os.makedirs(os.path.join(region_dir, day), exist_ok=True)
+                path = os.path.join(region_dir, day, name)
+                open(path, "w").close()
+                return path
+
+            def read_new(marks):
+                log_files = find_new_log_files(tmp, marks)
+                for log_file in log_files:
+                    mark_log_file(marks, tmp, log_file)
+                return [os.path.relpath(log_file, region_dir) for log_file in log_files]
+
+            marks = {}
+            deliver("01", "a_20180301T0000Z.json.gz")
+            deliver("02", "a_20180302T0000Z.json.gz")
+            self.assertEqual(
+                ["01/a_20180301T0000Z.json.gz", "02/a_20180302T0000Z.json.gz"], read_new(marks)
+            )
+            self.assertEqual([], read_new(marks))
+
+            # A file delivered late to the previous day is still found
+            deliver("01", "a_20180301T2355Z.json.gz")
+            deliver("03", "a_20180303T0000Z.json.gz")
+            self.assertEqual(
+                ["01/a_20180301T2355Z.json.gz", "03/a_20180303T0000Z.json.gz"], read_new(marks)
+            )
+
+            # Days before that are no longer walked, so their marks are dropped
+            deliver("04", "a_20180304T0000Z.json.gz")
+            self.assertEqual(["04/a_20180304T0000Z.json.gz"], read_new(marks))
+            self.assertEqual([], read_new(marks))
+            self.assertNotIn(os.path.join(region_dir, "01"), marks)
+            self.assertNotIn(os.path.join(region_dir, "02"), marks)
+            self.assertIn(os.path.join(region_dir, "03"), marks)
+
+            # A file sorting before one already read, from another source, is still found
+            deliver("04", "0_20180304T0000Z.json.gz")
+            self.assertEqual(["04/0_20180304T0000Z.json.gz"], read_new(marks))
+            self.assertEqual([], read_new(marks))
+
+            # Marks from before the files read were kept have the latest file read
+            marks[os.path.join(region_dir, "04")][1] = "a_20180304T0000Z.json.gz"
+            deliver("04", "b_20180304T0000Z.json.gz")
+            self.assertEqual(["04/b_20180304T0000Z.json.gz"], read_new(marks))
+